@@ -5,10 +5,12 @@ import sys
 from glob import glob
 from pathlib import Path
 
+import numpy as np
 import torch
 
 sys.path.insert(0, '.')  # nopep8
-from dataset.dataset_utils import (get_fixed_offsets, get_video_and_audio)
+from dataset.dataset_utils import (PreprocessedCache, get_fixed_offsets, get_media_loader,
+                                   get_windowed_datapoint, load_or_build_index)
 
 
 class AudioSet(torch.utils.data.Dataset):
@@ -25,7 +27,9 @@ class AudioSet(torch.utils.data.Dataset):
                  vis_load_backend='read_video',
                  size_ratio=None,
                  attr_annot_path=None,
-                 max_attr_per_vid=None):
+                 max_attr_per_vid=None,
+                 windowed_decode=False,
+                 preprocessed_cache_dir=None):
         super().__init__()
         self.max_clip_len_sec = None
         self.split = split
@@ -37,33 +41,35 @@ class AudioSet(torch.utils.data.Dataset):
         self.seed = seed
         self.load_fixed_offsets_on = [] if load_fixed_offsets_on is None else load_fixed_offsets_on
         self.vis_load_backend = vis_load_backend
+        self.media_loader = get_media_loader(vis_load_backend)
         self.size_ratio = size_ratio
+        # the pre-decoded clips are memory-mapped and sliced lazily, the windowed decode has nothing to save
+        self.windowed_decode = windowed_decode and vis_load_backend != 'mmap'
+        self.preprocessed_cache = None
+        if preprocessed_cache_dir is not None and transforms is not None:
+            decode_params = {'vis_load_backend': vis_load_backend, 'windowed_decode': self.windowed_decode,
+                             'max_clip_len_sec': self.max_clip_len_sec}
+            self.preprocessed_cache = PreprocessedCache(preprocessed_cache_dir, transforms, decode_params)
 
         self.split2short = {'train': 'unbalanced', 'valid': 'balanced', 'test': 'eval'}
-        short2long = {'unbalanced': 'unbalanced_train_segments',
-                      'balanced': 'balanced_train_segments',
-                      'eval': 'eval_segments'}
-
-        # read meta
-        split_meta = []
-        for shortdir_vid, start, end, targets, phase in csv.reader(open(meta_path), quotechar='"'):
-            if shortdir_vid.startswith(self.split2short[split]):
-                # shortdir_vid 'unbalanced/NFap9qgsI_s' -> 'unbalanced_train_segments/NFap9qgsI_s'
-                shortdir, vid = shortdir_vid.split('/')
-                longdir_vid = '/'.join([short2long[shortdir], vid])
-                split_meta.append([longdir_vid, float(start), float(end), targets, phase])
 
-        # filter "bad" examples
-        if to_filter_bad_examples:
-            split_meta = self.filter_bad_examples(split_meta)
+        # parsing the meta (millions of rows) takes a while, the result is cached until the inputs change
+        index_inputs = [meta_path, self.splits_path / 'audioset_labels.csv']
+        index_inputs += sorted(glob('./data/filtered_examples_audioset/*.txt'))
+        index_params = [self.__class__.__name__, vids_dir, to_filter_bad_examples]
+        index = load_or_build_index(f'audioset_{split}', index_inputs, index_params, self.build_index,
+                                    self.splits_path / 'index_cache')
 
         # label maps
-        self.label2target = {l: int(t) for t, _, l in csv.reader(open(self.splits_path / 'audioset_labels.csv'))}
+        self.label2target = dict(zip(index['labels'].tolist(), index['label_targets'].tolist()))
         self.target2label = {t: l for l, t in self.label2target.items()}
-        self.video2target = {key: list(map(int, targets.split(','))) for key, _, _, targets, _ in split_meta}
+        # (multi-label) targets of all videos are concatenated, `video_targets_offsets` splits them
+        targets = index['video_targets'].tolist()
+        offsets = index['video_targets_offsets'].tolist()
+        self.video2target = {key: targets[offsets[i]:offsets[i+1]]
+                             for i, key in enumerate(index['video_ids'].tolist())}
 
-        clip_paths = [self.vids_dir / f'{k}_{int(s*1000)}_{int(e*1000)}.mp4' for k, s, e, t, p in split_meta]
-        clip_paths = sorted(clip_paths)
+        clip_paths = [Path(p) for p in index['clip_paths'].tolist()]
 
         # loading the fixed offsets. COMMENT THIS IF YOU DON'T HAVE A FILE YET
         if transforms is not None and split in load_fixed_offsets_on:
@@ -79,6 +85,40 @@ class AudioSet(torch.utils.data.Dataset):
 
         logging.info(f'{split} has {len(self.dataset)} items')
 
+    def build_index(self):
+        short2long = {'unbalanced': 'unbalanced_train_segments',
+                      'balanced': 'balanced_train_segments',
+                      'eval': 'eval_segments'}
+
+        # read meta
+        split_meta = []
+        for shortdir_vid, start, end, targets, phase in csv.reader(open(self.meta_path), quotechar='"'):
+            if shortdir_vid.startswith(self.split2short[self.split]):
+                # shortdir_vid 'unbalanced/NFap9qgsI_s' -> 'unbalanced_train_segments/NFap9qgsI_s'
+                shortdir, vid = shortdir_vid.split('/')
+                longdir_vid = '/'.join([short2long[shortdir], vid])
+                split_meta.append([longdir_vid, float(start), float(end), targets, phase])
+
+        # filter "bad" examples
+        if self.to_filter_bad_examples:
+            split_meta = self.filter_bad_examples(split_meta)
+
+        # label maps
+        label2target = {l: int(t) for t, _, l in csv.reader(open(self.splits_path / 'audioset_labels.csv'))}
+        video_targets = [list(map(int, targets.split(','))) for _, _, _, targets, _ in split_meta]
+
+        clip_paths = [self.vids_dir / f'{k}_{int(s*1000)}_{int(e*1000)}.mp4' for k, s, e, t, p in split_meta]
+        clip_paths = sorted(clip_paths)
+
+        return {
+            'labels': np.array(list(label2target.keys()), dtype=str),
+            'label_targets': np.array(list(label2target.values()), dtype=np.int64),
+            'video_ids': np.array([key for key, _, _, _, _ in split_meta], dtype=str),
+            'video_targets': np.array([t for ts in video_targets for t in ts], dtype=np.int64),
+            'video_targets_offsets': np.cumsum([0] + [len(ts) for ts in video_targets], dtype=np.int64),
+            'clip_paths': np.array([str(p) for p in clip_paths], dtype=str),
+        }
+
     def filter_bad_examples(self, audioset_meta):
         bad = set()
         base_path = Path('./data/filtered_examples_audioset')
@@ -93,8 +133,19 @@ class AudioSet(torch.utils.data.Dataset):
 
     def __getitem__(self, index):
         path = self.dataset[index]
-        rgb, audio, meta = self.load_media(path)
-        item = self.make_datapoint(path, rgb, audio, meta)
+        if self.preprocessed_cache is not None and self.split in self.load_fixed_offsets_on:
+            offset_params = self.vid2offset_params[f'{self.split2short[self.split]}/{Path(path).stem}']
+            return self.preprocessed_cache.get(path, offset_params, lambda: self.get_transformed_item(path))
+        return self.get_transformed_item(path)
+
+    def get_transformed_item(self, path):
+        if self.windowed_decode and self.transforms is not None:
+            # decodes only the frames that the temporal crop will take (full decode if it can't be planned)
+            item = get_windowed_datapoint(path, self.transforms, self.make_datapoint, self.load_media,
+                                          self.max_clip_len_sec)
+        else:
+            rgb, audio, meta = self.load_media(path)
+            item = self.make_datapoint(path, rgb, audio, meta)
         if self.transforms is not None:
             item = self.transforms(item)
         return item
@@ -122,7 +173,7 @@ class AudioSet(torch.utils.data.Dataset):
         return item
 
     def load_media(self, path):
-        rgb, audio, meta = get_video_and_audio(path, get_meta=True, end_sec=self.max_clip_len_sec)
+        rgb, audio, meta = self.media_loader(path, get_meta=True, end_sec=self.max_clip_len_sec)
         return rgb, audio, meta
 
     def __len__(self):
@@ -134,9 +185,10 @@ class AudioSetBalanced737k(AudioSet):
                  # here
                  meta_path='./data/audioset_balanced_737k.csv',
                  seed=1337, load_fixed_offsets_on=['valid', 'test'], vis_load_backend='read_video', size_ratio=None,
-                 attr_annot_path=None, max_attr_per_vid=None):
+                 attr_annot_path=None, max_attr_per_vid=None, windowed_decode=False, preprocessed_cache_dir=None):
         super().__init__(split, vids_dir, transforms, to_filter_bad_examples, splits_path, meta_path,
-                         seed, load_fixed_offsets_on, vis_load_backend, size_ratio)
+                         seed, load_fixed_offsets_on, vis_load_backend, size_ratio, windowed_decode=windowed_decode,
+                         preprocessed_cache_dir=preprocessed_cache_dir)
 
 class AudioSetBalanced540k(AudioSet):
     ''' MBT's balanced 500k (from unbalanced part) + 20k from balaced part + 20k from eval part '''
@@ -145,9 +197,10 @@ class AudioSetBalanced540k(AudioSet):
                  # here
                  meta_path='./data/audioset_balanced_540k.csv',
                  seed=1337, load_fixed_offsets_on=['valid', 'test'], vis_load_backend='read_video', size_ratio=None,
-                 attr_annot_path=None, max_attr_per_vid=None):
+                 attr_annot_path=None, max_attr_per_vid=None, windowed_decode=False, preprocessed_cache_dir=None):
         super().__init__(split, vids_dir, transforms, to_filter_bad_examples, splits_path, meta_path,
-                         seed, load_fixed_offsets_on, vis_load_backend, size_ratio)
+                         seed, load_fixed_offsets_on, vis_load_backend, size_ratio, windowed_decode=windowed_decode,
+                         preprocessed_cache_dir=preprocessed_cache_dir)
 
 
 if __name__ == '__main__':
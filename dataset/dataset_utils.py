@@ -1,14 +1,27 @@
 import csv
+import io
+import json
+import math
 import os
 import random
+import sys
+from functools import partial
 from pathlib import Path
 from glob import glob
 import shutil
+import struct
+import time
+import fcntl
 import logging
+from hashlib import md5
 
+import av
+import numpy as np
+import torch
 import torchaudio
 import torchvision
 
+from dataset.transforms import ResampleAudio, ResampleRGB, plan_decode_window
 from utils.utils import get_fixed_off_fname
 
 
@@ -54,37 +67,546 @@ def get_fixed_offsets(transforms, split, splits_path, dataset_name):
     return vid2offset_params
 
 
+class ScratchCache:
+    '''A node-local file cache in `$LOCAL_SCRATCH` shared by all processes on the node (dataloader workers,
+    ddp ranks). A miss is copied by one process while the others wait on a lock, and the copy is
+    atomic (temp file + rename), so nobody reads a half-written file. The locks are a fixed set of files
+    (a path hashes to one of `num_locks`), not one per cached file. If `$LOCAL_SCRATCH_MAX_GB` is set,
+    the least recently used files (by mtime, bumped on every hit) are evicted to stay within the budget.
+    The counters are kept in a shared-memory tensor with a row per dataloader worker (as in
+    `InstrumentedCompose`), the main process reads the totals (`get_stats`, see
+    `LoggerWithTBoard.log_scratch_cache_stats`).'''
+
+    lock_suffix = '.lock'
+    tmp_suffix = '.tmp'
+    locks_dir = '.locks'
+    METRICS = ['hits', 'misses', 'bytes_copied', 'evictions', 'bytes_evicted']
+
+    def __init__(self, cache_dir, max_bytes=None, min_age_sec=60, num_locks=1024, num_workers=0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # files used more recently than this are never evicted as someone may be about to open them
+        self.min_age_sec = min_age_sec
+        self.num_locks = num_locks
+        # this process' view of the cache size (other processes add files too, hence, rescanning)
+        self.used_bytes = None
+        self.bytes_since_scan = 0
+        # (main process + workers, metrics)
+        self.stats = torch.zeros(num_workers + 1, len(self.METRICS), dtype=torch.float64)
+        self.stats.share_memory_()
+        os.makedirs(os.path.join(self.cache_dir, self.locks_dir), exist_ok=True)
+
+    def get(self, path):
+        # a bit ugly but we need not just fname to be appended to `cache_dir` but parent folders,
+        # otherwise the same fnames in multiple folders will create a bug (the same input for multiple paths)
+        cache_path = os.path.join(self.cache_dir, Path(path).absolute().relative_to('/'))
+        if not self._touch(cache_path):
+            os.makedirs(Path(cache_path).parent, exist_ok=True)
+            with open(self._get_lock_path(cache_path), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # another process might have copied it while we were waiting for the lock
+                if not self._touch(cache_path):
+                    self._copy(path, cache_path)
+        return cache_path
+
+    def _get_lock_path(self, key):
+        lock_i = int(md5(key.encode()).hexdigest(), 16) % self.num_locks
+        return os.path.join(self.cache_dir, self.locks_dir, f'{lock_i}{self.lock_suffix}')
+
+    def _count(self, metric, value=1):
+        worker_info = torch.utils.data.get_worker_info()
+        # a cache made lazily inside of a worker has only its own row
+        row = 0 if worker_info is None or worker_info.id + 1 >= len(self.stats) else worker_info.id + 1
+        self.stats[row, self.METRICS.index(metric)] += value
+
+    def _touch(self, cache_path):
+        try:
+            os.utime(cache_path)
+        except FileNotFoundError:
+            return False
+        self._count('hits')
+        return True
+
+    def _copy(self, path, cache_path):
+        size = os.path.getsize(path)
+        self._maybe_evict(size)
+        tmp_path = f'{cache_path}{self.tmp_suffix}.{os.getpid()}'
+        try:
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, cache_path)
+        finally:
+            # e.g. if the disk is full, the partial copy would be neither counted nor evicted
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._count('misses')
+        self._count('bytes_copied', size)
+
+    def _maybe_evict(self, incoming_bytes):
+        if self.max_bytes is None:
+            return
+        # rescan if this process alone has copied 1% of the budget: the overshoot is bounded by 1% x processes
+        if self.used_bytes is not None and self.bytes_since_scan + incoming_bytes < 0.01 * self.max_bytes \
+                and self.used_bytes + incoming_bytes <= self.max_bytes:
+            self.used_bytes += incoming_bytes
+            self.bytes_since_scan += incoming_bytes
+            return
+        with open(os.path.join(self.cache_dir, self.locks_dir, 'evict' + self.lock_suffix), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            files = self._scan()
+            self.used_bytes = sum(size for _, size, _ in files)
+            self.bytes_since_scan = 0
+            now = time.time()
+            # the oldest first
+            for mtime, size, file_path in sorted(files):
+                if self.used_bytes + incoming_bytes <= self.max_bytes or now - mtime < self.min_age_sec:
+                    break
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+                self.used_bytes -= size
+                self._count('evictions')
+                self._count('bytes_evicted', size)
+            if self.used_bytes + incoming_bytes > self.max_bytes:
+                logging.warning(f'Scratch cache is over the budget ({self.used_bytes} / {self.max_bytes} bytes)')
+            self.used_bytes += incoming_bytes
+
+    def _scan(self):
+        files = []
+        for root, dirs, fnames in os.walk(self.cache_dir):
+            if root == self.cache_dir and self.locks_dir in dirs:
+                dirs.remove(self.locks_dir)
+            for fname in fnames:
+                if fname.endswith(self.lock_suffix) or f'{self.tmp_suffix}.' in fname:
+                    continue
+                file_path = os.path.join(root, fname)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, file_path))
+        return files
+
+    def get_stats(self):
+        '''The counters of this process and its dataloader workers since the start (and the hit rate)'''
+        stats = dict(zip(self.METRICS, self.stats.sum(dim=0).tolist()))
+        stats['hit_rate'] = stats['hits'] / max(stats['hits'] + stats['misses'], 1)
+        return stats
+
+
+_scratch_cache = None
+
+
+def get_scratch_cache(num_workers=0):
+    '''One cache per process, created lazily (e.g. inside of a dataloader worker). To see the counters of
+    the workers in the main process, create it there before the dataloaders start (with `num_workers`).'''
+    global _scratch_cache
+    if _scratch_cache is None:
+        max_gb = os.environ.get('LOCAL_SCRATCH_MAX_GB', None)
+        max_bytes = None if max_gb is None else int(float(max_gb) * 1024**3)
+        _scratch_cache = ScratchCache(os.environ['LOCAL_SCRATCH'], max_bytes, num_workers=num_workers)
+    return _scratch_cache
+
+
 def maybe_cache_file(path: os.PathLike):
     '''Motivation: if every job reads from a shared disk it`ll get very slow, consider an image can
     be 2MB, then with batch size 32, 16 workers in dataloader you`re already requesting 1GB!! -
     imagine this for all users and all jobs simultaneously.'''
     # checking if we are on cluster, not on a local machine
     if 'LOCAL_SCRATCH' in os.environ:
-        cache_dir = os.environ.get('LOCAL_SCRATCH')
-        # a bit ugly but we need not just fname to be appended to `cache_dir` but parent folders,
-        # otherwise the same fnames in multiple folders will create a bug (the same input for multiple paths)
-        cache_path = os.path.join(cache_dir, Path(path).relative_to('/'))
-        if not os.path.exists(cache_path):
-            os.makedirs(Path(cache_path).parent, exist_ok=True)
-            shutil.copyfile(path, cache_path)
-        return cache_path
+        return get_scratch_cache().get(path)
     else:
         return path
 
 
 def get_video_and_audio(path, get_meta=False, start_sec=0, end_sec=None):
     orig_path = path
+    wav_path = get_sidecar_wav(path)
     path = maybe_cache_file(path)
-    # (Tv, 3, H, W) [0, 255, uint8]; (Ca, Ta)
-    rgb, audio, meta = torchvision.io.read_video(str(path), start_sec, end_sec, 'sec', output_format='TCHW')
+    if wav_path is None:
+        # (Tv, 3, H, W) [0, 255, uint8]; (Ca, Ta)
+        rgb, audio, meta = torchvision.io.read_video(str(path), start_sec, end_sec, 'sec', output_format='TCHW')
+        # (Ta) <- (Ca, Ta)
+        audio = audio.mean(dim=0)
+    else:
+        # the audio is sliced from the memory-mapped .wav, only the video stream is decoded from the container
+        rgb, v_fps = read_video_stream(path, start_sec, end_sec)
+        audio, a_fps = get_audio_from_wav(wav_path, start_sec, end_sec)
+        meta = {'video_fps': v_fps, 'audio_fps': a_fps}
     assert meta['video_fps'], f'No video fps for {orig_path}'
-    # (Ta) <- (Ca, Ta)
-    audio = audio.mean(dim=0)
     # FIXME: this is legacy format of `meta` as it used to be loaded by VideoReader.
     meta = {'video': {'fps': [meta['video_fps']]}, 'audio': {'framerate': [meta['audio_fps']]}, }
     return rgb, audio, meta
 
 
+def read_video_stream(path, start_sec=0, end_sec=None, thread_type=None):
+    '''Decodes only the video stream (as `read_video` would: frames with `start_sec <= pts <= end_sec`)
+    `thread_type`: 'AUTO' enables the codec's frame and slice threads (PyAV default is single-threaded)
+    Returns: (Tv, 3, H, W) [0, 255, uint8] and the fps'''
+    with av.open(path if isinstance(path, io.IOBase) else str(path)) as container:
+        stream = container.streams.video[0]
+        if thread_type is not None:
+            stream.thread_type = thread_type
+        fps = float(stream.average_rate)
+        if start_sec > 0:
+            container.seek(int(start_sec / stream.time_base), stream=stream)
+        frames = []
+        for frame in container.decode(stream):
+            pts_sec = float(frame.pts * stream.time_base)
+            if end_sec is not None and pts_sec > end_sec:
+                break
+            if pts_sec >= start_sec:
+                frames.append(frame.to_rgb().to_ndarray())
+        if frames:
+            rgb = torch.from_numpy(np.stack(frames))
+        else:
+            rgb = torch.zeros((0, stream.height, stream.width, 3), dtype=torch.uint8)
+    # (Tv, 3, H, W) <- (Tv, H, W, 3)
+    return rgb.permute(0, 3, 1, 2), fps
+
+
+def read_video_stream_videoreader(path, start_sec=0, end_sec=None):
+    '''The same as `read_video_stream` but with the `torchvision.io.VideoReader` streaming API:
+    seeks to `start_sec` and stops after `end_sec` instead of demuxing the whole file'''
+    reader = torchvision.io.VideoReader(str(path), 'video')
+    fps = reader.get_metadata()['video']['fps'][0]
+    if start_sec > 0:
+        reader.seek(start_sec)
+    frames = []
+    # an empty window gives an empty clip, as in `read_video_stream` (the frame size is of any decoded frame)
+    frame_size = (0, 0)
+    for frame in reader:
+        frame_size = tuple(frame['data'].shape[-2:])
+        if end_sec is not None and frame['pts'] > end_sec:
+            break
+        if frame['pts'] >= start_sec:
+            # (3, H, W)
+            frames.append(frame['data'])
+    if not frames:
+        return torch.zeros((0, 3, *frame_size), dtype=torch.uint8), fps
+    return torch.stack(frames), fps
+
+
+def read_audio_stream(path, start_sec=0, end_sec=None):
+    '''Decodes only the audio stream with PyAV. Returns: (Ta,) in [-1, 1] and the sample rate'''
+    with av.open(path if isinstance(path, io.IOBase) else str(path)) as container:
+        stream = container.streams.audio[0]
+        start_i = math.ceil(start_sec * stream.rate)
+        end_i = sys.maxsize if end_sec is None else math.floor(end_sec * stream.rate) + 1
+        audio = _decode_stream_window(container, stream, start_i, end_i, stream.rate)
+        return torch.from_numpy(audio), stream.rate
+
+
+def get_video_and_audio_from_streams(path, read_video_fn, start_sec=0, end_sec=None):
+    '''Decodes the video stream with `read_video_fn` and reads the audio from the sidecar .wav
+    (or decodes it with PyAV if the .wav is missing). Outputs are in the format of `get_video_and_audio`'''
+    orig_path = path
+    wav_path = get_sidecar_wav(path)
+    path = maybe_cache_file(path)
+    rgb, v_fps = read_video_fn(path, start_sec, end_sec)
+    assert v_fps, f'No video fps for {orig_path}'
+    if wav_path is None:
+        audio, a_fps = read_audio_stream(path, start_sec, end_sec)
+    else:
+        audio, a_fps = get_audio_from_wav(wav_path, start_sec, end_sec)
+    meta = {'video': {'fps': [v_fps]}, 'audio': {'framerate': [a_fps]}, }
+    return rgb, audio, meta
+
+
+def get_video_and_audio_pyav(path, get_meta=False, start_sec=0, end_sec=None):
+    read_video_fn = partial(read_video_stream, thread_type='AUTO')
+    return get_video_and_audio_from_streams(path, read_video_fn, start_sec, end_sec)
+
+
+def get_video_and_audio_videoreader(path, get_meta=False, start_sec=0, end_sec=None):
+    return get_video_and_audio_from_streams(path, read_video_stream_videoreader, start_sec, end_sec)
+
+
+def get_sidecar_wav(path):
+    '''The re-encoding (`scripts/data/reencode_vggsound.py`, `example.reencode_video`) writes the mono
+    pcm_s16le .wav next to the .mp4. Returns its (maybe cached) path or None if it is missing.'''
+    wav_path = Path(path).with_suffix('.wav')
+    if not wav_path.exists():
+        return None
+    return str(maybe_cache_file(wav_path))
+
+
+def read_wav_mmap(path):
+    '''Parses the RIFF header and memory-maps the PCM samples (no decoding).
+    Returns: (Ta, Ca) array (integer or float32) and the sample rate'''
+    with open(path, 'rb') as f:
+        dtype, channels, sample_rate, data_offset, data_size = _parse_wav_header(f, path)
+    num_samples = min(data_size, os.path.getsize(path) - data_offset) // (channels * np.dtype(dtype).itemsize)
+    pcm = np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=(num_samples, channels))
+    return pcm, sample_rate
+
+
+def read_wav_bytes(buffer):
+    '''The same as `read_wav_mmap` but for a .wav that is already in memory (e.g. read from a tar shard)'''
+    dtype, channels, sample_rate, data_offset, data_size = _parse_wav_header(io.BytesIO(buffer), 'buffer')
+    num_samples = min(data_size, len(buffer) - data_offset) // (channels * np.dtype(dtype).itemsize)
+    pcm = np.frombuffer(buffer, dtype=dtype, count=num_samples * channels, offset=data_offset)
+    return pcm.reshape(num_samples, channels), sample_rate
+
+
+def _parse_wav_header(f, name):
+    riff, _, wave = f.read(4), f.read(4), f.read(4)
+    assert riff == b'RIFF' and wave == b'WAVE', f'Not a .wav: {name}'
+    fmt = None
+    while True:
+        chunk_id, chunk_size = f.read(4), f.read(4)
+        if len(chunk_size) < 4:
+            raise ValueError(f'No data chunk in {name}')
+        chunk_size = int.from_bytes(chunk_size, 'little')
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', f.read(16))
+            f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+        elif chunk_id == b'data':
+            data_offset = f.tell()
+            break
+        else:
+            # chunks are word-aligned
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+    assert fmt is not None, f'No fmt chunk in {name}'
+    # 1: PCM, 3: IEEE float, 0xFFFE: extensible (ffmpeg uses it for pcm_s16le with >2 channels)
+    audio_format, channels, sample_rate, _, _, bits = fmt
+    dtype = '<f4' if audio_format == 3 else f'<i{bits // 8}'
+    return dtype, channels, sample_rate, data_offset, chunk_size
+
+
+def get_audio_from_wav(path, start_sec=0, end_sec=None, start_i=None, end_i=None):
+    '''Slices samples from the memory-mapped .wav (or the .wav bytes) either by time (as `read_video`
+    does: `start_sec <= t <= end_sec`) or by sample indices. Only the slice is read from disk.
+    Returns: (Ta,) float32 in [-1, 1] and the sample rate'''
+    pcm, sample_rate = read_wav_bytes(path) if isinstance(path, bytes) else read_wav_mmap(path)
+    if start_i is None:
+        start_i = math.ceil(start_sec * sample_rate)
+        end_i = None if end_sec is None else math.floor(end_sec * sample_rate) + 1
+    audio = np.asarray(pcm[start_i:end_i], dtype=np.float32)
+    if np.issubdtype(pcm.dtype, np.integer):
+        audio /= 2 ** (8 * pcm.dtype.itemsize - 1)
+    # (Ta) <- (Ta, Ca)
+    return torch.from_numpy(audio.mean(axis=1)), sample_rate
+
+
+def get_video_and_audio_from_bytes(mp4, wav=None, end_sec=None):
+    '''Decodes a clip that is held in memory (e.g. read from a tar shard, see `dataset/sharded.py`).
+    Outputs are in the format of `get_video_and_audio`'''
+    rgb, v_fps = read_video_stream(io.BytesIO(mp4), 0, end_sec, thread_type='AUTO')
+    if wav is None:
+        audio, a_fps = read_audio_stream(io.BytesIO(mp4), 0, end_sec)
+    else:
+        audio, a_fps = get_audio_from_wav(wav, 0, end_sec)
+    meta = {'video': {'fps': [v_fps]}, 'audio': {'framerate': [a_fps]}, }
+    return rgb, audio, meta
+
+
+def get_mmap_store_paths(path):
+    '''The pre-decoded clip lives next to the .mp4 (see `scripts/data/make_mmap_store.py`)'''
+    path = str(Path(path).with_suffix(''))
+    return path + '.rgb.npy', path + '.audio.npy', path + '.meta.json'
+
+
+def get_video_and_audio_from_mmap(path, get_meta=False, start_sec=0, end_sec=None):
+    '''The same as `get_video_and_audio` but reads the frames and the audio that were decoded beforehand
+    by `scripts/data/make_mmap_store.py`. The arrays are memory-mapped, hence, the returned tensors are
+    views into the files and nothing is decoded or copied until a transform touches the data.'''
+    rgb_path, audio_path, meta_path = [maybe_cache_file(p) for p in get_mmap_store_paths(path)]
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # copy-on-write mapping: the tensors are writable (no torch warning) but the files are never modified
+    # (Tv, 3, H, W) [0, 255, uint8]; (Ta,)
+    rgb = torch.from_numpy(np.load(rgb_path, mmap_mode='c'))
+    audio = torch.from_numpy(np.load(audio_path, mmap_mode='c'))
+    # `read_video` returns the frames with `start_sec <= pts <= end_sec`
+    v_fps, a_fps = meta['video']['fps'][0], meta['audio']['framerate'][0]
+    v_end_i = None if end_sec is None else math.floor(end_sec * v_fps) + 1
+    a_end_i = None if end_sec is None else math.floor(end_sec * a_fps) + 1
+    rgb = rgb[math.ceil(start_sec * v_fps):v_end_i]
+    audio = audio[math.ceil(start_sec * a_fps):a_end_i]
+    return rgb, audio, meta
+
+
+def probe_video_and_audio(path, max_clip_len_sec=None):
+    '''Reads the stream headers only (no decoding) and returns `meta` in the same format as
+    `get_video_and_audio` does plus the number of frames (samples) in each stream. Used to plan the
+    decode window before anything is decoded.'''
+    wav_path = get_sidecar_wav(path)
+    path = maybe_cache_file(path)
+    with av.open(str(path)) as container:
+        vstream = container.streams.video[0]
+        astream = container.streams.audio[0]
+        v_fps = float(vstream.average_rate)
+        a_fps = astream.rate
+        v_len_sec = _get_stream_duration_sec(container, vstream)
+        a_len_sec = _get_stream_duration_sec(container, astream)
+        v_len_frames = vstream.frames if vstream.frames > 0 else int(v_len_sec * v_fps)
+        a_len_frames = int(a_len_sec * a_fps)
+        frame_size = (vstream.codec_context.height, vstream.codec_context.width)
+    if wav_path is not None:
+        pcm, a_fps = read_wav_mmap(wav_path)
+        a_len_frames = len(pcm)
+    assert v_fps, f'No video fps for {path}'
+    if max_clip_len_sec is not None:
+        v_len_frames = min(v_len_frames, int(max_clip_len_sec * v_fps))
+        a_len_frames = min(a_len_frames, int(max_clip_len_sec * a_fps))
+    meta = {'video': {'fps': [v_fps], 'num_frames': [v_len_frames], 'frame_size': [frame_size]},
+            'audio': {'framerate': [a_fps], 'num_frames': [a_len_frames]}, }
+    return meta
+
+
+def _get_stream_duration_sec(container, stream):
+    if stream.duration is not None:
+        return float(stream.duration * stream.time_base)
+    return container.duration / av.time_base
+
+
+def get_video_and_audio_window(path, v_range, a_range, meta, roi=None, size=None):
+    '''Seeks and decodes only the `v_range` frames and `a_range` samples (both as [start, end) indices
+    on the stream's own frame grid). If the container ends earlier than the header said, the last
+    frame (sample) is repeated to fill the window, similar to `VGGSound.load_media`.
+    If `roi` (top, left, height, width) and/or `size` (height, width) are given, only this region of the
+    frames is converted to RGB and resized to `size` (see `_make_roi_graph`).'''
+    orig_path = path
+    wav_path = get_sidecar_wav(path)
+    path = maybe_cache_file(path)
+    v_fps = meta['video']['fps'][0]
+    a_fps = meta['audio']['framerate'][0]
+    with av.open(str(path)) as container:
+        # (Tv, H, W, 3) [0, 255, uint8]; (Ta,)
+        rgb = _decode_stream_window(container, container.streams.video[0], *v_range, v_fps, roi, size)
+        if wav_path is None:
+            audio = torch.from_numpy(_decode_stream_window(container, container.streams.audio[0], *a_range, a_fps))
+    if wav_path is not None:
+        audio, _ = get_audio_from_wav(wav_path, start_i=a_range[0], end_i=a_range[1])
+    rgb = pad_by_repeating_last(torch.from_numpy(rgb), v_range[1] - v_range[0], 'video', orig_path)
+    audio = pad_by_repeating_last(audio, a_range[1] - a_range[0], 'audio', orig_path)
+    # (Tv, 3, H, W) <- (Tv, H, W, 3)
+    rgb = rgb.permute(0, 3, 1, 2)
+    return rgb, audio
+
+
+def get_resampled_window(path, v_range, a_range, meta, resample_transforms, roi=None, size=None):
+    '''The same as `get_video_and_audio_window` but `v_range` and `a_range` are on the grid of the frame rates
+    that `resample_transforms` (`ResampleRGB` and `ResampleAudio`, no resizing) resample the source streams
+    to. The source streams are decoded from the whole second before the window, where the resampling picks
+    the same frames and interpolates the same samples as it would for the whole streams, and are trimmed to
+    the window after resampling. Used at inference to skip re-encoding the video with ffmpeg.'''
+    ts = getattr(resample_transforms, 'transforms', [resample_transforms])
+    new_v_fps = next(t.new_fps for t in ts if isinstance(t, ResampleRGB))
+    new_a_fps = next(t.new_fps for t in ts if isinstance(t, ResampleAudio))
+    v_fps = meta['video']['fps'][0]
+    a_fps = meta['audio']['framerate'][0]
+    start_sec = math.floor(min(v_range[0] / new_v_fps, a_range[0] / new_a_fps))
+    # a margin for the rounding of the frame indices and the edge of the audio resampling kernel
+    end_sec = max(v_range[1] / new_v_fps, a_range[1] / new_a_fps) + 0.1
+    src_v_range = (round(start_sec * v_fps), min(math.ceil(end_sec * v_fps), meta['video']['num_frames'][0]))
+    src_a_range = (round(start_sec * a_fps), min(math.ceil(end_sec * a_fps), meta['audio']['num_frames'][0]))
+    rgb, audio = get_video_and_audio_window(path, src_v_range, src_a_range, meta, roi, size)
+    item = {'video': rgb, 'audio': audio, 'meta': {'video': {'fps': [v_fps]}, 'audio': {'framerate': [a_fps]}}}
+    item = resample_transforms(item)
+    v_first, a_first = int(start_sec * new_v_fps), int(start_sec * new_a_fps)
+    rgb = item['video'][v_range[0] - v_first:v_range[1] - v_first]
+    audio = item['audio'][a_range[0] - a_first:a_range[1] - a_first]
+    # the header may overestimate the number of frames (samples) a bit
+    rgb = pad_by_repeating_last(rgb, v_range[1] - v_range[0], 'video', path)
+    audio = pad_by_repeating_last(audio, a_range[1] - a_range[0], 'audio', path)
+    return rgb, audio
+
+
+def _decode_stream_window(container, stream, start_i, end_i, fps, roi=None, size=None):
+    # seeking lands on the closest keyframe before `start_i`, the frames before it are decoded and dropped
+    container.seek(max(0, int(start_i / fps / stream.time_base)), stream=stream)
+    graph = None
+    if stream.type == 'video' and (roi is not None or size is not None):
+        graph = _make_roi_graph(stream, roi, size)
+    chunks = []
+    first_i = None
+    for frame in container.decode(stream):
+        if frame.pts is None:
+            continue
+        frame_i = round(float(frame.pts * stream.time_base) * fps)
+        if frame_i >= end_i:
+            break
+        if stream.type == 'video':
+            if frame_i < start_i:
+                continue
+            if graph is None:
+                chunks.append(frame.to_rgb().to_ndarray())
+            else:
+                graph.push(frame)
+                chunks.append(graph.pull().to_ndarray())
+        else:
+            if frame_i + frame.samples <= start_i:
+                continue
+            first_i = frame_i if first_i is None else first_i
+            chunks.append(_audio_frame_to_mono(frame))
+    if stream.type == 'video':
+        out_h, out_w = size or (roi[2:] if roi is not None else (stream.height, stream.width))
+        return np.stack(chunks) if chunks else np.zeros((0, out_h, out_w, 3), dtype=np.uint8)
+    if not chunks:
+        return np.zeros((0,), dtype=np.float32)
+    audio = np.concatenate(chunks)
+    return audio[max(0, start_i - first_i):end_i - first_i]
+
+
+def _make_roi_graph(stream, roi=None, size=None):
+    '''ffmpeg filters that crop (`roi`: top, left, height, width) and resize (`size`: height, width) the
+    decoded (YUV) frames before the conversion to RGB, so the discarded pixels are never converted'''
+    graph = av.filter.Graph()
+    nodes = [graph.add_buffer(template=stream)]
+    if roi is not None:
+        top, left, height, width = roi
+        # `exact`: odd offsets are not rounded to the chroma subsampling
+        nodes.append(graph.add('crop', f'w={width}:h={height}:x={left}:y={top}:exact=1'))
+    if size is not None:
+        nodes.append(graph.add('scale', f'w={size[1]}:h={size[0]}:flags=bilinear'))
+    nodes.append(graph.add('format', 'pix_fmts=rgb24'))
+    nodes.append(graph.add('buffersink'))
+    graph.link_nodes(*nodes).configure()
+    return graph
+
+
+def _audio_frame_to_mono(frame):
+    # (Ca, Ta) if planar, (1, Ta*Ca) if packed
+    audio = frame.to_ndarray()
+    if not frame.format.is_planar:
+        audio = audio.reshape(-1, len(frame.layout.channels)).T
+    if np.issubdtype(audio.dtype, np.integer):
+        audio = audio.astype(np.float32) / 2 ** (8 * audio.dtype.itemsize - 1)
+    # (Ta) <- (Ca, Ta)
+    return audio.mean(axis=0).astype(np.float32)
+
+
+def pad_by_repeating_last(x, length, modality, path):
+    if len(x) == 0:
+        raise RuntimeError(f'Decoded an empty {modality} window from {path}')
+    if len(x) < length:
+        logging.info(f'{modality} window is too short, padding to {length}, path: {path}')
+        x = torch.cat([x, x[-1:].repeat(length - len(x), *[1] * (x.dim() - 1))], dim=0)
+    return x[:length]
+
+
+def get_windowed_datapoint(path, transforms, make_datapoint, load_media, max_clip_len_sec=None,
+                           min_video_frames=0, min_audio_samples=0):
+    '''Asks the transform chain which video frames and audio samples it will use (`plan_decode_window`
+    samples the offset and the start of the crop ahead of time) and decodes only those.
+    If the chain can't tell (e.g. there is no supported temporal crop in it), the whole clip is decoded
+    with `load_media` as before.'''
+    meta = probe_video_and_audio(path, max_clip_len_sec)
+    # the same as padding the clip to the minimum length (see `VGGSound.load_media`)
+    meta['video']['num_frames'][0] = max(meta['video']['num_frames'][0], min_video_frames)
+    meta['audio']['num_frames'][0] = max(meta['audio']['num_frames'][0], min_audio_samples)
+    item = make_datapoint(path, None, None, meta)
+    window = plan_decode_window(transforms, item)
+    if window is None:
+        rgb, audio, meta = load_media(path)
+        return make_datapoint(path, rgb, audio, meta)
+    item['video'], item['audio'] = get_video_and_audio_window(path, window['video'], window['audio'], meta,
+                                                              window['roi'], window['size'])
+    return item
+
+
 def get_audio_stream(path, get_meta=False):
     '''Used only in feature extractor training'''
     path = str(Path(path).with_suffix('.wav'))
@@ -99,6 +621,131 @@ def get_audio_stream(path, get_meta=False):
     else:
         return waveform
 
+def get_files_fingerprint(paths, params=()):
+    '''A hash of the paths, sizes and mtimes of the input files (and extra params, e.g. the split)'''
+    stats = []
+    for path in paths:
+        stat = os.stat(path)
+        stats.append([str(path), stat.st_size, stat.st_mtime_ns])
+    return md5(json.dumps([stats, [str(p) for p in params]]).encode()).hexdigest()
+
+
+def load_or_build_index(name, input_paths, params, build_fn, cache_dir='./data/index_cache'):
+    '''Dataset construction (parsing csvs, unioning the filtered example lists, intersecting with splits)
+    is done by every rank at every launch. Instead, `build_fn` is called once and its output (a dict of
+    numpy arrays, strings are kept as a string table) is saved to `cache_dir`. The cache is keyed by the
+    fingerprint of `input_paths` and `params`, so it is rebuilt only if any of the inputs change.'''
+    fingerprint = get_files_fingerprint(input_paths, params)
+    cache_path = Path(cache_dir) / f'{name}_{fingerprint}.npz'
+    if cache_path.exists():
+        with np.load(cache_path, allow_pickle=False) as f:
+            logging.info(f'Loaded the dataset index from {cache_path}')
+            return {k: f[k] for k in f.files}
+    index = build_fn()
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # atomic: other ranks may be building the same index at the same time
+    tmp_path = f'{cache_path}.tmp.{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **index)
+    os.replace(tmp_path, cache_path)
+    logging.info(f'Saved the dataset index to {cache_path}')
+    return index
+
+
+def get_transforms_fingerprint(transforms):
+    '''A hash of the classes and plain attributes (numbers, strings, lists) of the transforms and their
+    submodules, i.e. of the transform config'''
+    def describe(obj):
+        attrs = {k: v for k, v in vars(obj).items() if isinstance(v, (bool, int, float, str, list, tuple))}
+        if isinstance(obj, torch.nn.Module):
+            attrs['children'] = [[n, describe(m)] for n, m in obj.named_children()]
+        return [obj.__class__.__name__, attrs]
+    transforms = getattr(transforms, 'transforms', [transforms])
+    return md5(json.dumps([describe(t) for t in transforms], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _stat_or_none(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+class PreprocessedCache:
+    '''On-disk cache of the transformed (model-ready) items of the splits with fixed offsets: the inputs
+    are the same at every evaluation, so a hit skips decoding and the transforms. The key is a hash of
+    everything that changes the tensors: the transform config, the decode settings of the dataset
+    (`decode_params`, e.g. `vis_load_backend`, `windowed_decode` that crops and scales in the decoder,
+    `max_clip_len_sec`), the path, the size and mtime of the clip and of its sidecar .wav (if any), and the
+    offset row, so changing either makes new entries. The test-time transforms must be deterministic given
+    the fixed offsets (no random crops, audio jitter, etc).
+    The video is stored in fp16 and cast back to its dtype on load. Like `load_or_build_index`, the writes
+    are atomic as several workers and ranks may fill the cache at the same time. The hits and misses are
+    counted as in `ScratchCache` (see `share_stats` and `LoggerWithTBoard.log_preprocessed_cache_stats`).'''
+
+    METRICS = ['hits', 'misses']
+
+    def __init__(self, cache_dir, transforms, decode_params=None):
+        self.cache_dir = Path(cache_dir)
+        self.transforms_fingerprint = get_transforms_fingerprint(transforms)
+        self.decode_params = {} if decode_params is None else decode_params
+        self.share_stats(0)
+
+    def share_stats(self, num_workers):
+        '''Makes the counters a shared-memory tensor with a row per dataloader worker, so that the main
+        process reads the totals over the workers (`get_stats`). Should be called before the workers start.'''
+        # (main process + workers, metrics)
+        self.stats = torch.zeros(num_workers + 1, len(self.METRICS), dtype=torch.float64)
+        self.stats.share_memory_()
+
+    def _count(self, metric):
+        worker_info = torch.utils.data.get_worker_info()
+        row = 0 if worker_info is None or worker_info.id + 1 >= len(self.stats) else worker_info.id + 1
+        self.stats[row, self.METRICS.index(metric)] += 1
+
+    def get_stats(self):
+        '''The counters of this process and its dataloader workers since the start (and the hit rate)'''
+        stats = dict(zip(self.METRICS, self.stats.sum(dim=0).tolist()))
+        stats['hit_rate'] = stats['hits'] / max(stats['hits'] + stats['misses'], 1)
+        return stats
+
+    def get_path(self, path, offset_params):
+        sources = [path, Path(path).with_suffix('.wav')]
+        # a re-encoded clip or a re-extracted (or removed) .wav gets new entries
+        source_stats = [(s.st_size, s.st_mtime_ns) if s is not None else None for s in map(_stat_or_none, sources)]
+        key = [self.transforms_fingerprint, self.decode_params, str(path), source_stats, offset_params]
+        key = md5(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+        return self.cache_dir / key[:2] / f'{key}.pt'
+
+    def get(self, path, offset_params, make_item):
+        '''Loads the item for (`path`, `offset_params`) or makes it with `make_item()` and saves it'''
+        cache_path = self.get_path(path, offset_params)
+        if cache_path.exists():
+            try:
+                cached = torch.load(cache_path, map_location='cpu', weights_only=False)
+                item = cached['item']
+                item['video'] = item['video'].to(getattr(torch, cached['video_dtype']))
+                self._count('hits')
+                return item
+            except Exception as e:
+                logging.warning(f'Failed to load {cache_path} ({e}), making the item again')
+        item = make_item()
+        self.save(cache_path, item)
+        self._count('misses')
+        return item
+
+    def save(self, cache_path, item):
+        video_dtype = str(item['video'].dtype).replace('torch.', '')
+        # clone: tensors that are views (e.g. of the decoded clip) would be saved with their whole storage
+        cached = {k: v.clone() if isinstance(v, torch.Tensor) else v for k, v in item.items()}
+        if cached['video'].is_floating_point():
+            cached['video'] = cached['video'].half()
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f'{cache_path}.tmp.{os.getpid()}'
+        torch.save({'item': cached, 'video_dtype': video_dtype}, tmp_path)
+        os.replace(tmp_path, cache_path)
+
+
 def subsample_dataset(dataset: list, size_ratio: float, shuffle: bool = False):
     if size_ratio is not None and 0.0 < size_ratio < 1.0:
         logging.info(f'Subsampling dataset to {size_ratio}')
@@ -110,3 +757,21 @@ def subsample_dataset(dataset: list, size_ratio: float, shuffle: bool = False):
         dataset = dataset[:max(1, cut_off)]
         logging.info(f'Subsampled dataset to {size_ratio} (size: {len(dataset)})')
     return dataset
+
+
+# `vis_load_backend` -> a function with the same signature and outputs as `get_video_and_audio`
+VIS_LOAD_BACKENDS = {
+    'read_video': get_video_and_audio,
+    'pyav': get_video_and_audio_pyav,
+    # VideoReader was replaced by read_video (see the FIXME in `get_video_and_audio`), kept for old configs
+    'VideoReader': get_video_and_audio,
+    # the `torchvision.io.VideoReader` streaming API (needs torchvision built with the video_reader backend)
+    'videoreader': get_video_and_audio_videoreader,
+    'mmap': get_video_and_audio_from_mmap,
+}
+
+
+def get_media_loader(vis_load_backend):
+    if vis_load_backend not in VIS_LOAD_BACKENDS:
+        raise NotImplementedError(f'Unknown vis_load_backend: {vis_load_backend}. Use {list(VIS_LOAD_BACKENDS)}')
+    return VIS_LOAD_BACKENDS[vis_load_backend]
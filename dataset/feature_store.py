@@ -0,0 +1,209 @@
+import json
+import logging
+import math
+import operator
+import random
+import sys
+from functools import reduce
+from pathlib import Path
+
+import numpy as np
+import torch
+
+sys.path.insert(0, '.')  # nopep8
+from dataset.dataset_utils import get_transforms_fingerprint, subsample_dataset
+from dataset.transforms import (GenerateMultipleSegments, TemporalCropAndOffset, frames2sec,
+                                quantize_offset, sec2frames)
+
+
+def split_segment_transforms(transforms):
+    '''Splits a transform sequence around the temporal crop and the segmentation. Returns the transforms
+    applied to the whole clip before the crop, the crop (`TemporalCropAndOffset`), the segmentation
+    (`GenerateMultipleSegments`), and the transforms applied to the segments after it. The transforms
+    between the crop and the segmentation (e.g. audio augmentations in the train sequence) are dropped.'''
+    ts = list(getattr(transforms, 'transforms', transforms))
+    kinds = [type(t) for t in ts]
+    assert TemporalCropAndOffset in kinds and GenerateMultipleSegments in kinds, f'Unsupported sequence: {kinds}'
+    crop_i, seg_i = kinds.index(TemporalCropAndOffset), kinds.index(GenerateMultipleSegments)
+    assert crop_i < seg_i, f'The crop should go before the segmentation: {kinds}'
+    if seg_i - crop_i > 1:
+        logging.warning(f'Skipping the transforms between the crop and the segmentation: {ts[crop_i+1:seg_i]}')
+    return ts[:crop_i], ts[crop_i], ts[seg_i], ts[seg_i+1:]
+
+
+def make_segments(stream, starts, seg_size):
+    '''Returns the segments (len(starts), seg_size, ...) of `stream` (T, ...) that begin at `starts`
+    (a strided view if the starts are evenly spaced, see `GenerateMultipleSegments.get_segments`)'''
+    starts = torch.as_tensor(starts)
+    return GenerateMultipleSegments.get_segments(stream, torch.stack([starts, starts + seg_size], dim=1))
+
+
+def get_store_grid(crop, segmenter, vfps):
+    '''The grid of the segment starts in a feature store: the video segments start every segment step
+    (`step_size_seg`) and the audio segments at every shift that a video start plus an offset from the class
+    grid can give, i.e. the gcd of the segment step and the offsets in video frames (1 frame for the defaults).'''
+    if not crop.do_offset or crop.offset_type != 'grid':
+        raise NotImplementedError('The feature store supports only the offsets from the class grid')
+    v_step = int(segmenter.step_size_seg * segmenter.segment_size_vframes)
+    offsets_vframes = [off * vfps for off in crop.class_grid.tolist()]
+    if any(abs(off - round(off)) > 1e-3 for off in offsets_vframes):
+        raise NotImplementedError(f'The offsets should be multiples of the frame duration: {crop.class_grid}')
+    a_step = reduce(math.gcd, [abs(round(off)) for off in offsets_vframes], v_step)
+    return {
+        'vfps': int(vfps),
+        'segment_size_vframes': segmenter.segment_size_vframes,
+        'v_step_vframes': v_step,
+        'a_step_vframes': a_step,
+    }
+
+
+def get_first_segment_range(grid, n_segments, n_vsegs, n_asegs, offset_vframes):
+    '''The range [min, max] of the first video segment for which both streams of a clip with `n_vsegs` and
+    `n_asegs` segments on the store `grid` fit `n_segments` after the offset (empty if min > max)'''
+    v_step, a_step = grid['v_step_vframes'], grid['a_step_vframes']
+    a_last_start = (n_asegs - 1) * a_step - (n_segments - 1) * v_step - offset_vframes
+    first_min = max(0, math.ceil(-offset_vframes / v_step))
+    first_max = min(n_vsegs - n_segments, a_last_start // v_step)
+    return first_min, first_max
+
+
+class FeatureStoreDataset(torch.utils.data.Dataset):
+    '''Serves the segment features that `scripts/data/extract_features.py` precomputed with the frozen
+    feature extractors instead of the clips, so that only the head (`vproj`, `aproj`, `transformer`) is
+    trained, e.g. `model(vis, aud, precomputed_feats=True)` with (B, S, tv, D) and (B, S, ta, D) inputs.
+    The store has the features of all video and audio segments on the grid of `get_store_grid`. An item
+    takes `n_segments` of each for a random start and offset from the class grid (as `TemporalCropAndOffset`
+    with `offset_type: grid`), the fixed offsets of `load_fixed_offsets_on` are snapped to the grid of segment
+    starts. The random offset is drawn from the ones that fit the clip (all of them for the clips that
+    `extract_features.py` keeps), the clips that fit none (or not their fixed offset) are dropped.
+    The crop and segment parameters are read from `transforms` (the transforms are not applied; the spatial
+    crop and the augmentations are the test-time ones the store was made with).
+    `vids_dir` is the store folder (`cfg.data.vids_path`).'''
+
+    def __init__(self,
+                 split,
+                 vids_dir,
+                 transforms=None,
+                 load_fixed_offsets_on=['valid', 'test'],
+                 vis_load_backend=None,
+                 size_ratio=None,
+                 attr_annot_path=None,
+                 max_attr_per_vid=None,
+                 windowed_decode=False,
+                 preprocessed_cache_dir=None):
+        super().__init__()
+        self.split = split
+        self.store_dir = Path(vids_dir)
+        self.load_fixed_offsets_on = load_fixed_offsets_on
+        if windowed_decode or preprocessed_cache_dir is not None:
+            logging.warning('windowed_decode and preprocessed_cache_dir are ignored for the feature store')
+        assert transforms is not None, 'The crop and segment parameters are taken from the transforms'
+
+        with open(self.store_dir / f'{split}.json') as f:
+            index = json.load(f)
+        self.grid = index['grid']
+        pre, crop, segmenter, post = split_segment_transforms(transforms)
+        grid = get_store_grid(crop, segmenter, self.grid['vfps'])
+        if grid != self.grid:
+            raise ValueError(f'The store was made for another segment grid: {self.grid} vs {grid}')
+        if split != 'train' and get_transforms_fingerprint(pre + post) != index['transforms_fingerprint']:
+            logging.warning(f'The {split} transforms differ from the ones the store was made with')
+
+        self.class_grid = crop.class_grid
+        self.n_segments = segmenter.n_segments
+        # where the first segment is in the crop at test time (see `GenerateMultipleSegments`), to map the
+        # fixed `v_start_i_sec` (the start of the crop) onto the segment grid
+        seg_seq_len = self.n_segments * segmenter.step_size_seg + (1 - segmenter.step_size_seg)
+        crop_len_vframes = sec2frames(crop.crop_len_sec, self.grid['vfps'])
+        self.first_seg_shift = (crop_len_vframes - int(seg_seq_len * segmenter.segment_size_vframes)) // 2
+
+        self.shards = index['shards']
+        self.clips = []
+        for clip in index['clips']:
+            offsets = self.get_offsets(clip)
+            if len(offsets) == 0:
+                continue
+            if self.split not in self.load_fixed_offsets_on and len(offsets) < len(self.class_grid):
+                # only the (few) clips that don't fit all of the grid keep their own list
+                clip = dict(clip, offsets=offsets)
+            self.clips.append(clip)
+        if len(self.clips) < len(index['clips']):
+            dropped = len(index['clips']) - len(self.clips)
+            logging.warning(f'Dropped {dropped} {split} clips that are too short for the offsets')
+        # to keep `item['path']` relative to the original folder (`path_suffix` in `train_sync.py`)
+        self.vids_dir = index['vids_dir']
+        self.clips = subsample_dataset(self.clips, size_ratio, shuffle=split == 'train')
+        # the memory maps are opened in each dataloader worker on the first access
+        self.arrays = {}
+        # the transforms are not applied (see above), e.g. there is nothing to profile
+        self.transforms = None
+        logging.info(f'{split} has {len(self.clips)} items in {len(self.shards)} feature shards')
+
+    def __len__(self):
+        return len(self.clips)
+
+    def get_arrays(self, shard_i):
+        if shard_i not in self.arrays:
+            shard = self.shards[shard_i]
+            self.arrays[shard_i] = (np.load(self.store_dir / shard['vfeats'], mmap_mode='r'),
+                                    np.load(self.store_dir / shard['afeats'], mmap_mode='r'))
+        return self.arrays[shard_i]
+
+    def get_offsets(self, clip):
+        '''The offsets (sec) that fit the clip: its fixed offset or those of the class grid'''
+        if self.split in self.load_fixed_offsets_on:
+            offsets = [round(clip['targets']['offset_sec'], 2)]
+        else:
+            offsets = self.class_grid.tolist()
+        return [off for off in offsets if operator.le(*self._get_first_range(clip, round(off * self.grid['vfps'])))]
+
+    def _get_first_range(self, clip, offset_vframes):
+        return get_first_segment_range(self.grid, self.n_segments, clip['n_vsegs'], clip['n_asegs'], offset_vframes)
+
+    def get_first_segment(self, clip, offset_vframes, v_start_vframes=None):
+        '''The index of the first video segment: random if `v_start_vframes` is None, otherwise the closest
+        one to it. Both streams should fit `n_segments` after the offset (one of `get_offsets(clip)`).'''
+        first_min, first_max = self._get_first_range(clip, offset_vframes)
+        if v_start_vframes is None:
+            return random.randint(first_min, first_max)
+        return min(max(round(v_start_vframes / self.grid['v_step_vframes']), first_min), first_max)
+
+    def __getitem__(self, index):
+        clip = self.clips[index]
+        targets = dict(clip['targets'])
+        vfps = self.grid['vfps']
+
+        if self.split in self.load_fixed_offsets_on:
+            offset_sec = round(targets['offset_sec'], 2)
+            v_start_vframes = sec2frames(targets['v_start_i_sec'], vfps) + self.first_seg_shift
+        else:
+            offset_sec = random.choice(clip.get('offsets', self.class_grid.tolist()))
+            v_start_vframes = None
+        offset_vframes = round(offset_sec * vfps)
+        first = self.get_first_segment(clip, offset_vframes, v_start_vframes)
+
+        v_step, a_step = self.grid['v_step_vframes'], self.grid['a_step_vframes']
+        v_ids = first + np.arange(self.n_segments)
+        a_ids = (first * v_step + offset_vframes + np.arange(self.n_segments) * v_step) // a_step
+        vfeats, afeats = self.get_arrays(clip['shard'])
+        # (S, tv, D) and (S, ta, D), stored in fp16
+        vis = torch.from_numpy(vfeats[clip['row'], v_ids].astype(np.float32))
+        aud = torch.from_numpy(afeats[clip['row'], a_ids].astype(np.float32))
+
+        offset_label, offset_target = quantize_offset(self.class_grid, offset_sec)
+        targets['offset_sec'] = offset_sec
+        if self.split not in self.load_fixed_offsets_on:
+            # the start of the first segment
+            targets['v_start_i_sec'] = frames2sec(first * v_step, vfps)
+        targets['offset_label'] = offset_label
+        targets['offset_target'] = offset_target
+
+        item = {
+            'video': vis,
+            'audio': aud,
+            'meta': {'v_seg_i': int(v_ids[0]), 'a_seg_i': int(a_ids[0])},
+            'path': clip['path'],
+            'targets': targets,
+            'split': self.split,
+        }
+        return item
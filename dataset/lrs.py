@@ -10,7 +10,8 @@ import torch
 
 
 sys.path.insert(0, '.')  # nopep8
-from dataset.dataset_utils import (get_fixed_offsets, get_video_and_audio, subsample_dataset)
+from dataset.dataset_utils import (PreprocessedCache, get_fixed_offsets, get_media_loader,
+                                   get_windowed_datapoint, subsample_dataset)
 
 
 class LRS3(torch.utils.data.Dataset):
@@ -26,7 +27,9 @@ class LRS3(torch.utils.data.Dataset):
                  size_ratio=None,
                  attr_annot_path=None,
                  max_attr_per_vid=None,
-                 to_filter_bad_examples=True,):
+                 to_filter_bad_examples=True,
+                 windowed_decode=False,
+                 preprocessed_cache_dir=None):
         super().__init__()
         self.max_clip_len_sec = 11
         logging.info(f'During IO, the length of clips is limited to {self.max_clip_len_sec} sec')
@@ -37,7 +40,15 @@ class LRS3(torch.utils.data.Dataset):
         self.seed = seed
         self.load_fixed_offsets_on = [] if load_fixed_offsets_on is None else load_fixed_offsets_on
         self.vis_load_backend = vis_load_backend
+        self.media_loader = get_media_loader(vis_load_backend)
         self.size_ratio = size_ratio
+        # the pre-decoded clips are memory-mapped and sliced lazily, the windowed decode has nothing to save
+        self.windowed_decode = windowed_decode and vis_load_backend != 'mmap'
+        self.preprocessed_cache = None
+        if preprocessed_cache_dir is not None and transforms is not None:
+            decode_params = {'vis_load_backend': vis_load_backend, 'windowed_decode': self.windowed_decode,
+                             'max_clip_len_sec': self.max_clip_len_sec}
+            self.preprocessed_cache = PreprocessedCache(preprocessed_cache_dir, transforms, decode_params)
 
         split_clip_ids_path = os.path.join(splits_path, f'lrs3_{split}.txt')
         if not os.path.exists(split_clip_ids_path):
@@ -64,15 +75,35 @@ class LRS3(torch.utils.data.Dataset):
 
     def __getitem__(self, index):
         path = self.dataset[index]
-        rgb, audio, meta = get_video_and_audio(path, get_meta=True, end_sec=self.max_clip_len_sec)
+        if self.preprocessed_cache is not None and self.split in self.load_fixed_offsets_on:
+            offset_params = self.vid2offset_params[self.get_unique_id(path)]
+            return self.preprocessed_cache.get(path, offset_params, lambda: self.get_transformed_item(path))
+        return self.get_transformed_item(path)
+
+    def get_transformed_item(self, path):
+        if self.windowed_decode and self.transforms is not None:
+            # decodes only the frames that the temporal crop will take (full decode if it can't be planned)
+            item = get_windowed_datapoint(path, self.transforms, self.make_datapoint, self.load_media,
+                                          self.max_clip_len_sec)
+        else:
+            rgb, audio, meta = self.load_media(path)
+            item = self.make_datapoint(path, rgb, audio, meta)
 
+        if self.transforms is not None:
+            item = self.transforms(item)
+
+        return item
+
+    def get_unique_id(self, path):
+        return path.replace(f'{self.vids_dir}/', '').replace(self.vids_dir, '').replace('.mp4', '')
+
+    def make_datapoint(self, path, rgb, audio, meta):
         # (Tv, 3, H, W) in [0, 225], (Ta, C) in [-1, 1]
         item = {'video': rgb, 'audio': audio, 'meta': meta, 'path': path, 'targets': {}, 'split': self.split}
 
         # loading fixed offsets so we could evaluate on the same data each time (valid and test)
         if self.split in self.load_fixed_offsets_on:
-            unique_id = path.replace(f'{self.vids_dir}/', '').replace(self.vids_dir, '').replace('.mp4', '')
-            offset_params = self.vid2offset_params[unique_id]
+            offset_params = self.vid2offset_params[self.get_unique_id(path)]
             item['targets']['offset_sec'] = offset_params['offset_sec']
             item['targets']['v_start_i_sec'] = offset_params['v_start_i_sec']
             if 'oos_target' in offset_params:
@@ -80,11 +111,12 @@ class LRS3(torch.utils.data.Dataset):
                     'oos': offset_params['oos_target'], 'offset': item['targets']['offset_sec'],
                 }
 
-        if self.transforms is not None:
-            item = self.transforms(item)
-
         return item
 
+    def load_media(self, path):
+        rgb, audio, meta = self.media_loader(path, get_meta=True, end_sec=self.max_clip_len_sec)
+        return rgb, audio, meta
+
     def filter_bad_examples(self, paths):
         bad = set()
         base_path = Path('./data/filtered_examples_lrs')
@@ -142,11 +174,13 @@ class LongerLRS3(LRS3):
                  size_ratio=None,
                  attr_annot_path=None,
                  max_attr_per_vid=None,
-                 to_filter_bad_examples=True,):
+                 to_filter_bad_examples=True,
+                 windowed_decode=False,
+                 preprocessed_cache_dir=None):
         # size_ratio is not used here as we are doing it this class (avoiding double subsampling)
         super().__init__(split, vids_dir, transforms, splits_path, seed, load_fixed_offsets_on,
                          vis_load_backend, None, attr_annot_path, max_attr_per_vid,
-                         to_filter_bad_examples)
+                         to_filter_bad_examples, windowed_decode, preprocessed_cache_dir)
         # does extra filtering
         if to_filter_bad_examples:
             self.dataset = self.filter_bad_examples(self.dataset)
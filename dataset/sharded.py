@@ -0,0 +1,161 @@
+import bisect
+import itertools
+import json
+import logging
+import random
+import sys
+import tarfile
+from pathlib import Path
+
+import torch
+import torch.distributed as dist
+import webdataset as wds
+
+sys.path.insert(0, '.')  # nopep8
+from dataset.dataset_utils import get_video_and_audio_from_bytes, pad_by_repeating_last
+
+
+def count_shard_samples(path):
+    '''The number of samples in a tar shard (reads only the headers)'''
+    with tarfile.open(path) as tar:
+        return len({m.name.split('.', 1)[0] for m in tar.getmembers() if m.isfile()})
+
+
+class ShardedSyncDataset(torch.utils.data.IterableDataset):
+    '''Streams the clips that were packed into tar shards by `scripts/data/make_shards.py` instead of
+    opening millions of small files. Each rank (and each dataloader worker within it) reads its own subset
+    of the shards sequentially, the samples are shuffled in a buffer (train only). Every rank yields
+    exactly `len(self)` items (the shards are cycled if needed, as `DistributedSampler` pads) so that DDP
+    ranks don't go out of step. The other splits (and the train split if there are fewer shards than readers)
+    give each reader a contiguous range of samples instead, so every sample is yielded once, and only the
+    last rank repeats a few first ones to even out the ranks (as `DistributedSampler` does).
+    The targets (labels and fixed offsets) are stored in the shards.
+    `vids_dir` is the folder with the shards (`cfg.data.vids_path`).'''
+
+    def __init__(self,
+                 split,
+                 vids_dir,
+                 transforms=None,
+                 seed=1337,
+                 shuffle_buffer=1000,
+                 load_fixed_offsets_on=['valid', 'test'],
+                 vis_load_backend=None,
+                 size_ratio=None,
+                 attr_annot_path=None,
+                 max_attr_per_vid=None,
+                 windowed_decode=False,
+                 preprocessed_cache_dir=None):
+        super().__init__()
+        self.split = split
+        self.transforms = transforms
+        self.seed = seed
+        self.shuffle_buffer = shuffle_buffer
+        self.epoch = 0
+        # the clips are decoded from the bytes in the shard with PyAV (and the .wav if it was packed)
+        if vis_load_backend not in [None, 'read_video', 'pyav']:
+            logging.warning(f'vis_load_backend={vis_load_backend} is ignored for the sharded dataset')
+        if preprocessed_cache_dir is not None:
+            logging.warning('preprocessed_cache_dir is ignored for the sharded dataset')
+
+        with open(Path(vids_dir) / f'{split}.json') as f:
+            index = json.load(f)
+        self.shards = [str(Path(vids_dir) / s) for s in index['shards']]
+        if 'shard_sizes' in index:
+            self.shard_sizes = index['shard_sizes']
+        else:
+            logging.warning(f'{split}.json has no shard_sizes (old scripts/data/make_shards.py), counting them')
+            self.shard_sizes = [count_shard_samples(s) for s in self.shards]
+        self.num_samples = index['num_samples']
+        self.max_clip_len_sec = index['max_clip_len_sec']
+        # the same padding as in `load_media` of the original dataset (e.g. `VGGSound`)
+        self.min_video_frames = index['min_video_frames']
+        self.min_audio_samples = index['min_audio_samples']
+        # to keep `item['path']` relative to the original folder (`path_suffix` in `train_sync.py`)
+        self.vids_dir = index['vids_dir']
+        # the fixed offsets were sampled for the transforms that were used when the shards were made
+        if split in load_fixed_offsets_on and not index['has_fixed_offsets']:
+            logging.warning(f'{split} shards have no fixed offsets, the offsets will be random')
+
+        if size_ratio is not None and 0.0 < size_ratio < 1.0:
+            # shards are the smallest unit here
+            num_shards = max(1, int(len(self.shards) * size_ratio))
+            self.shards = self.shards[:num_shards]
+            self.shard_sizes = self.shard_sizes[:num_shards]
+            self.num_samples = sum(self.shard_sizes)
+        logging.info(f'{split} has {self.num_samples} items in {len(self.shards)} shards')
+
+    def set_epoch(self, epoch):
+        '''The shard order and the shuffle buffer depend on the epoch (dataloader workers are re-created
+        every epoch and get the updated copy of the dataset)'''
+        self.epoch = epoch
+
+    def __len__(self):
+        # per rank, the same as `len(DistributedSampler)`
+        world_size = dist.get_world_size() if dist.is_initialized() else 1
+        return (self.num_samples + world_size - 1) // world_size
+
+    def __iter__(self):
+        rank, world_size = (dist.get_rank(), dist.get_world_size()) if dist.is_initialized() else (0, 1)
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        num_readers = world_size * num_workers
+
+        # how many items this worker should yield: all ranks yield `len(self)` items
+        num_items = len(self) // num_workers + int(worker_id < len(self) % num_workers)
+        if self.split == 'train' and len(self.shards) >= num_readers:
+            # the same shard order across all ranks and workers, each takes its own part of it
+            shards = list(self.shards)
+            random.Random(self.seed + self.epoch).shuffle(shards)
+            shards = shards[rank * num_workers + worker_id::num_readers]
+            samples = self.cycle_samples(shards)
+        else:
+            # the ranks take contiguous ranges of `len(self)` samples and split them between their workers
+            start = rank * len(self) + worker_id * (len(self) // num_workers) + min(worker_id, len(self) % num_workers)
+            samples = self.read_samples(start, start + num_items)
+
+        if self.split == 'train':
+            rng = random.Random(self.seed + self.epoch * num_readers + rank * num_workers + worker_id)
+            samples = wds.shuffle(self.shuffle_buffer, min(100, self.shuffle_buffer), rng=rng)(samples)
+
+        for _, sample in zip(range(num_items), samples):
+            item = self.make_datapoint(sample)
+            if self.transforms is not None:
+                item = self.transforms(item)
+            yield item
+
+    def cycle_samples(self, shards):
+        '''Reads the shards sequentially and starts over if the rank needs more items (padding)'''
+        read_tar = wds.tarfile_to_samples(handler=wds.warn_and_continue)
+        while True:
+            yield from read_tar(iter([dict(url=s) for s in shards]))
+
+    def read_samples(self, start, stop):
+        '''Reads the samples with the indices [start, stop) (past the end, it wraps around to the start)
+        from the shards they are in'''
+        read_tar = wds.tarfile_to_samples(handler=wds.warn_and_continue)
+        shard_starts = list(itertools.accumulate([0] + self.shard_sizes[:-1]))
+        i = start
+        while i < stop:
+            sample_i = i % self.num_samples
+            shard_i = bisect.bisect_right(shard_starts, sample_i) - 1
+            skip = sample_i - shard_starts[shard_i]
+            n = min(self.shard_sizes[shard_i] - skip, stop - i)
+            yield from itertools.islice(read_tar(iter([dict(url=self.shards[shard_i])])), skip, skip + n)
+            i += n
+
+    def make_datapoint(self, sample):
+        info = json.loads(sample['json'])
+        rgb, audio, meta = get_video_and_audio_from_bytes(sample['mp4'], sample.get('wav', None),
+                                                          self.max_clip_len_sec)
+        rgb = pad_by_repeating_last(rgb, max(len(rgb), self.min_video_frames), 'video', info['path'])
+        audio = pad_by_repeating_last(audio, max(len(audio), self.min_audio_samples), 'audio', info['path'])
+        # (Tv, 3, H, W) in [0, 225], (Ta, C) in [-1, 1]
+        item = {
+            'video': rgb,
+            'audio': audio,
+            'meta': meta,
+            'path': info['path'],
+            'targets': info['targets'],
+            'split': self.split,
+        }
+        return item
@@ -1,6 +1,8 @@
+import fractions
 import logging
 import math
 import random
+import time
 from typing import Tuple
 import torch
 import torchvision
@@ -16,6 +18,119 @@ def frames2sec(frames, fps):
     return frames / fps
 
 
+def plan_decode_window(transforms, item):
+    '''
+    Walks the transform chain up to the first transform that crops the streams in time and lets each
+    transform tell which part of the streams it needs. `item['meta']` is expected to have the number of
+    frames in each stream (`num_frames`, see `dataset_utils.probe_video_and_audio`) while the streams are
+    not decoded yet. The random parameters of the crop (`offset_sec`, `v_start_i_sec`, audio jitter margin)
+    are sampled here, cached in `item['meta']['decode_window']` and reused by the transforms in `forward`.
+    The spatial transforms before the crop may also ask to decode only a region of the frames (`roi`) and
+    resize it (`size`) while the frames are converted to RGB (see `plan_spatial_crop`).
+    Returns None if any transform before the crop can't plan (then, the whole clip should be decoded).
+    Returns: {'video': (start_i, end_i), 'audio': (start_i, end_i), 'roi': (top, left, height, width) or None,
+              'size': (height, width) or None, ...} in frames (pixels) of each stream.
+    '''
+    frame_size = item['meta']['video'].get('frame_size', [None])[0]
+    plan = {
+        'v_fps': item['meta']['video']['fps'][0],
+        'a_fps': item['meta']['audio']['framerate'][0],
+        'v_len_frames': item['meta']['video']['num_frames'][0],
+        'a_len_frames': item['meta']['audio']['num_frames'][0],
+        # the size of the frames at the current transform (if they were decoded as planned so far)
+        'frame_size': None if frame_size is None else tuple(frame_size),
+        'roi': None,
+        'size': None,
+        # ids of the spatial transforms that are done by the decoder (their `forward` skips)
+        'done_at_decode': [],
+    }
+    for t in getattr(transforms, 'transforms', []):
+        if not hasattr(t, 'plan_decode_window'):
+            return None
+        # returns True if `t` has fixed the window
+        if t.plan_decode_window(item, plan):
+            item['meta']['decode_window'] = plan
+            return plan
+    return None
+
+
+def can_plan_spatial(plan):
+    # the frame size is known and nothing was resized yet (a crop of the resized frames is done after decoding)
+    return plan['frame_size'] is not None and plan['size'] is None
+
+
+def plan_spatial_crop(transform, plan, i, j, h, w):
+    '''Fuses the crop (i, j, h, w) of the current frames into the region of the source frames to decode'''
+    top, left = (0, 0) if plan['roi'] is None else plan['roi'][:2]
+    plan['roi'] = (top + i, left + j, h, w)
+    plan['frame_size'] = (h, w)
+    plan['done_at_decode'].append(id(transform))
+
+
+def is_done_at_decode(transform, item):
+    plan = item['meta'].get('decode_window', None)
+    return plan is not None and id(transform) in plan['done_at_decode']
+
+
+def _get_tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        return [obj]
+    if isinstance(obj, dict):
+        return [t for v in obj.values() for t in _get_tensors(v)]
+    if isinstance(obj, (list, tuple)):
+        return [t for v in obj for t in _get_tensors(v)]
+    return []
+
+
+class InstrumentedCompose(torchvision.transforms.Compose):
+    '''The same as `Compose` but records for each transform: the number of calls, wall time, bytes of the
+    tensors in the output item, and allocations (the output tensors with a storage that wasn't in the input).
+    The stats are kept in a shared-memory tensor with a row per dataloader worker (the workers get it when
+    the dataset is sent to them), so the main process reads the totals over all workers (`get_stats`).
+    `num_workers` is the `num_workers` of the dataloader; each split needs its own instance.'''
+
+    METRICS = ['calls', 'time_sec', 'out_bytes', 'allocs']
+
+    def __init__(self, transforms, num_workers: int = 0):
+        super().__init__(transforms)
+        self.names = [t.__class__.__name__ for t in transforms]
+        # (main process + workers, transforms, metrics)
+        self.stats = torch.zeros(num_workers + 1, len(transforms), len(self.METRICS), dtype=torch.float64)
+        self.stats.share_memory_()
+
+    def __call__(self, item):
+        worker_info = torch.utils.data.get_worker_info()
+        # the workers of a loader with more workers than the rows share the row of the main process
+        row = 0 if worker_info is None or worker_info.id + 1 >= len(self.stats) else worker_info.id + 1
+        stats = self.stats[row]
+        for i, t in enumerate(self.transforms):
+            in_storages = {x.untyped_storage().data_ptr() for x in _get_tensors(item)}
+            start = time.perf_counter()
+            item = t(item)
+            elapsed = time.perf_counter() - start
+            out_tensors = _get_tensors(item)
+            out_bytes = sum(x.numel() * x.element_size() for x in out_tensors)
+            allocs = sum(x.untyped_storage().data_ptr() not in in_storages for x in out_tensors)
+            stats[i] += torch.tensor([1, elapsed, out_bytes, allocs], dtype=torch.float64)
+        return item
+
+    def get_stats(self):
+        '''Per transform class (summed over the transforms of the same class and the workers):
+        {name: {'calls', 'time_share', 'total_time_sec', 'time_ms', 'out_mb', 'allocs'}} (per call if not total)'''
+        stats = self.stats.sum(dim=0)
+        totals = {}
+        for name, s in zip(self.names, stats.tolist()):
+            totals[name] = [a + b for a, b in zip(totals.get(name, [0.] * len(self.METRICS)), s)]
+        all_time_sec = max(sum(s[1] for s in totals.values()), 1e-9)
+        report = {}
+        for name, (calls, time_sec, out_bytes, allocs) in totals.items():
+            calls_ = max(calls, 1)
+            report[name] = {'calls': int(calls), 'time_share': time_sec / all_time_sec, 'total_time_sec': time_sec,
+                            'time_ms': 1000 * time_sec / calls_, 'out_mb': out_bytes / calls_ / 2 ** 20,
+                            'allocs': allocs / calls_}
+        return report
+
+
 class EqualifyFromRight(torch.nn.Module):
 
     def __init__(self, clip_max_len_sec=10):
@@ -33,12 +148,24 @@ class EqualifyFromRight(torch.nn.Module):
                      'audio': {'framerate': [float], 'duration': [float]}
                      'video': {'fps': [float], 'duration': [float]}}
         '''
+        if 'decode_window' in item['meta']:
+            # the streams are decoded only within the window that was planned on the equalified lengths
+            return item
+
         a_fps = item['meta']['audio']['framerate'][0]
         v_fps = item['meta']['video']['fps'][0]
 
         Ta = item['audio'].shape[0]
         Tv, C, H, W = item['video'].shape
 
+        a_len_frames, v_len_frames = self.get_equal_lens(Ta, Tv, a_fps, v_fps)
+
+        item['audio'] = item['audio'][:a_len_frames]
+        item['video'] = item['video'][:v_len_frames, :, :, :]
+
+        return item
+
+    def get_equal_lens(self, Ta, Tv, a_fps, v_fps):
         a_len_secs = Ta / a_fps
         v_len_secs = Tv / v_fps
         min_len = min(self.clip_max_len_sec, a_len_secs, v_len_secs)
@@ -49,11 +176,12 @@ class EqualifyFromRight(torch.nn.Module):
         # print(a_len_frames, v_len_frames)
 
         assert a_len_frames <= Ta and v_len_frames <= Tv
+        return a_len_frames, v_len_frames
 
-        item['audio'] = item['audio'][:a_len_frames]
-        item['video'] = item['video'][:v_len_frames, :, :, :]
-
-        return item
+    def plan_decode_window(self, item, plan):
+        plan['a_len_frames'], plan['v_len_frames'] = self.get_equal_lens(
+            plan['a_len_frames'], plan['v_len_frames'], plan['a_fps'], plan['v_fps'])
+        return False
 
 
 class RGBSpatialCrop(torch.nn.Module):
@@ -68,8 +196,8 @@ class RGBSpatialCrop(torch.nn.Module):
 
     @staticmethod
     def get_random_crop_sides(vid, output_size):
-        '''Slice parameters for random crop'''
-        h, w = vid.shape[-2:]
+        '''Slice parameters for random crop. `vid` can also be the (H, W) of the frames'''
+        h, w = vid.shape[-2:] if isinstance(vid, torch.Tensor) else vid
         th, tw = output_size
         if w == tw and h == th:
             return 0, 0, h, w
@@ -79,8 +207,8 @@ class RGBSpatialCrop(torch.nn.Module):
 
     @staticmethod
     def get_center_crop_sides(vid, output_size):
-        '''Slice parameters for center crop'''
-        h, w = vid.shape[-2:]
+        '''Slice parameters for center crop. `vid` can also be the (H, W) of the frames'''
+        h, w = vid.shape[-2:] if isinstance(vid, torch.Tensor) else vid
         th, tw = output_size
 
         i = int(round((h - th) / 2.))
@@ -88,24 +216,72 @@ class RGBSpatialCrop(torch.nn.Module):
         return i, j, th, tw
 
     def forward(self, item):
+        if is_done_at_decode(self, item):
+            return item
         # (Tv, C, H, W)
         vid = item['video']
-        if self.is_random:
-            i, j, h, w = self.get_random_crop_sides(vid, self.input_size)
-        else:
-            i, j, h, w = self.get_center_crop_sides(vid, self.input_size)
+        i, j, h, w = self.get_crop_sides(vid)
         item['video'] = vid[..., i:(i + h), j:(j + w)]
         return item
 
+    def get_crop_sides(self, vid):
+        if self.is_random:
+            return self.get_random_crop_sides(vid, self.input_size)
+        return self.get_center_crop_sides(vid, self.input_size)
+
+    def plan_decode_window(self, item, plan):
+        if can_plan_spatial(plan):
+            plan_spatial_crop(self, plan, *self.get_crop_sides(plan['frame_size']))
+        elif plan['frame_size'] is not None:
+            plan['frame_size'] = tuple(self.input_size)
+        return False
+
 class Resize(torchvision.transforms.Resize):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
     def forward(self, item):
+        if is_done_at_decode(self, item):
+            return item
         item['video'] = super().forward(item['video'])
         return item
 
+    def get_output_size(self, height, width):
+        if isinstance(self.size, int) or len(self.size) == 1:
+            short = self.size if isinstance(self.size, int) else self.size[0]
+            # as in torchvision (`max_size` is not planned)
+            if height <= width:
+                return short, int(short * width / height)
+            return int(short * height / width), short
+        return tuple(self.size)
+
+    def plan_decode_window(self, item, plan):
+        if plan['frame_size'] is None:
+            return False
+        size = self.get_output_size(*plan['frame_size'])
+        if can_plan_spatial(plan) and self.max_size is None:
+            plan['size'] = size
+            plan['done_at_decode'].append(id(self))
+        plan['frame_size'] = size
+        return False
+
+
+def get_resized_crop_roi(frame_size, in_size, transforms):
+    '''For the frames of `frame_size` resized to min(H, W)=`in_size` (as `Resize(in_size)`) and then center
+    cropped by the `RGBSpatialCrop` in `transforms` (e.g. the ones before the temporal crop at test time),
+    returns the region of the source frames (top, left, height, width) that the crop takes and the size of
+    the frames after both, i.e. the `roi` and `size` to decode the frames with in one step (see
+    `dataset_utils.get_video_and_audio_window`). The `roi` is None if there is no center crop.'''
+    H, W = frame_size
+    h, w = Resize(in_size).get_output_size(H, W)
+    crop = next((t for t in getattr(transforms, 'transforms', transforms) if isinstance(t, RGBSpatialCrop)), None)
+    if crop is None or crop.is_random:
+        return None, (h, w)
+    i, j, th, tw = crop.get_crop_sides((h, w))
+    top, left = round(i * H / h), round(j * W / w)
+    return (top, left, min(round(th * H / h), H - top), min(round(tw * W / w), W - left)), (th, tw)
+
 
 class RGBSpatialCropSometimesUpscale(torch.nn.Module):
     '''This (randomly) crops the input video and with prob `sometimes_p` this crop is smaller but upscaled
@@ -129,13 +305,134 @@ class RGBSpatialCropSometimesUpscale(torch.nn.Module):
             f"{item['video'].shape}: if it is applied after GenerateMultipleClips," \
             "augs should be applied to each clip separately, not to the whole video array. " \
             "Otherwise, ignore this warning (comment it)."
+        if is_done_at_decode(self, item):
+            return item
         if self.do_sometimes_upscale and self.sometimes_p > torch.rand(1):
             return self.crop_further_and_upscale(item)
         else:
             return self.crop_only(item)
 
+    def plan_decode_window(self, item, plan):
+        if not can_plan_spatial(plan):
+            # the crop is sampled in `forward` on the decoded frames (only the output size matters here)
+            if plan['frame_size'] is not None:
+                plan['frame_size'] = tuple(self.crop_only.input_size)
+            return False
+        # both the crop and the upscale can be done by the decoder
+        if self.do_sometimes_upscale and self.sometimes_p > torch.rand(1):
+            for t in self.crop_further_and_upscale.transforms:
+                t.plan_decode_window(item, plan)
+        else:
+            self.crop_only.plan_decode_window(item, plan)
+        plan['done_at_decode'].append(id(self))
+        return False
+
+
+def get_color_jitter_params(n, brightness=None, contrast=None, saturation=None, hue=None):
+    '''Samples the parameters of `torchvision.transforms.ColorJitter` for `n` images (or clips) at once.
+    The ranges are (min, max) or None as in `ColorJitter(...).brightness`.
+    Returns: the order of the 4 ops (n, 4) and the factors of each op [(n,) or None] * 4.'''
+    order = torch.rand(n, 4).argsort(dim=1)  # a uniformly random permutation for each sample, as `randperm(4)`
+    factors = [None if r is None else torch.empty(n).uniform_(r[0], r[1])
+               for r in [brightness, contrast, saturation, hue]]
+    return order, factors
+
+
+def _per_sample(factor, x):
+    return factor.view(-1, *[1] * (x.dim() - 1))
+
+
+def _blend(img1, img2, ratio):
+    # the same math as in torchvision (float32, ratio is sampled as float32 there, then cast to python float)
+    ratio = _per_sample(ratio, img1)
+    bound = 1.0 if img1.is_floating_point() else 255
+    return (ratio * img1 + (1.0 - ratio.double()).float() * img2).clamp(0, bound).to(img1.dtype)
+
+
+def _adjust_brightness(img, factor):
+    return _blend(img, torch.zeros_like(img), factor)
+
+
+def _adjust_contrast(img, factor):
+    dtype = img.dtype if img.is_floating_point() else torch.float32
+    mean = torch.mean(torchvision.transforms.functional.rgb_to_grayscale(img).to(dtype), dim=(-3, -2, -1),
+                      keepdim=True)
+    return _blend(img, mean, factor)
+
+
+def _adjust_saturation(img, factor):
+    return _blend(img, torchvision.transforms.functional.rgb_to_grayscale(img), factor)
+
+
+def _rgb2hsv(img):
+    # a copy of torchvision's float32 conversion (`torchvision.transforms._functional_tensor`), the private
+    # module is renamed across releases
+    r, g, b = img.unbind(dim=-3)
+    maxc = torch.max(img, dim=-3).values
+    minc = torch.min(img, dim=-3).values
+    # h and s are erased where `maxc == minc`, the denominators are replaced with 1 there to avoid NaNs
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = hr + hg + hb
+    h = torch.fmod((h / 6.0 + 1.0), 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def _hsv2rgb(img):
+    # a copy of torchvision's float32 conversion, see `_rgb2hsv`
+    h, s, v = img.unbind(dim=-3)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int32)
+    p = torch.clamp((v * (1.0 - s)), 0.0, 1.0)
+    q = torch.clamp((v * (1.0 - s * f)), 0.0, 1.0)
+    t = torch.clamp((v * (1.0 - s * (1.0 - f))), 0.0, 1.0)
+    i = i % 6
+    mask = i.unsqueeze(dim=-3) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    a4 = torch.stack((a1, a2, a3), dim=-4)
+    return torch.einsum('...ijk, ...xijk -> ...xjk', mask.to(dtype=img.dtype), a4)
+
+
+def _adjust_hue(img, factor):
+    orig_dtype = img.dtype
+    img = torchvision.transforms.functional.convert_image_dtype(img, torch.float32)
+    h, s, v = _rgb2hsv(img).unbind(dim=-3)
+    h = (h + _per_sample(factor, h)) % 1.0
+    img = _hsv2rgb(torch.stack((h, s, v), dim=-3))
+    return torchvision.transforms.functional.convert_image_dtype(img, orig_dtype)
+
+
+def apply_color_jitter(x, order, factors):
+    '''Applies `ColorJitter` to `x` (n, ..., C, H, W) with the parameters of each sample from
+    `get_color_jitter_params`. The result is the same as of `torchvision.transforms.functional.adjust_*`
+    applied to each sample in its order, but the ops run on all samples that have the same op at a step.'''
+    ops = [_adjust_brightness, _adjust_contrast, _adjust_saturation, _adjust_hue]
+    # not in-place: `x` might be overlapping views of the same frames (`GenerateMultipleSegments`)
+    x = x.clone(memory_format=torch.contiguous_format)
+    for step in range(len(ops)):
+        for op_i, (op, factor) in enumerate(zip(ops, factors)):
+            idx = (order[:, step] == op_i).nonzero().squeeze(1)
+            if factor is not None and len(idx) > 0:
+                x[idx] = op(x[idx], factor[idx])
+    return x
+
 
 class RandomApplyColorDistortion(torch.nn.Module):
+    '''Color jitter (with prob `p_color_jitter`) and grayscale (with prob `p_gray_scale`) for each clip
+    (..., T, C, H, W), e.g. each segment after `GenerateMultipleSegments` or each item of a batch, gets
+    its own parameters. The same distribution as `RandomApply([ColorJitter])` + `RandomGrayscale` per clip.'''
 
     def __init__(self, p_gray_scale=0., p_color_jitter=0., s=1.) -> None:
         super().__init__()
@@ -144,30 +441,30 @@ class RandomApplyColorDistortion(torch.nn.Module):
         self.s = s
         assert 0 <= self.p_color_jitter <= 1 and 0 <= self.p_gray_scale <= 1, (p_color_jitter, p_gray_scale)
         # SimCLR params
-        color_jitter = torchvision.transforms.ColorJitter(0.8*s, 0.8*s, 0.8*s, 0.2*s)
-        rand_color_jitter = torchvision.transforms.RandomApply([color_jitter], p_color_jitter)
-        rand_gray = torchvision.transforms.RandomGrayscale(p_gray_scale)
-        self.transforms = torchvision.transforms.Compose([rand_color_jitter, rand_gray])
-
-    def apply_to_single_clip(self, clip):
-        return self.transforms(clip)
-
-    def apply_to_each_clip(self, clips):
-        for i, clip in enumerate(clips):
-            clips[i] = self.apply_to_single_clip(clip)
-        return clips
+        self.color_jitter = torchvision.transforms.ColorJitter(0.8*s, 0.8*s, 0.8*s, 0.2*s)
 
     def forward(self, item):
-        has_batch_dim = len(item['video'].shape) == 5
-        if has_batch_dim:
-            fn = self.apply_to_each_clip
-        else:
-            fn = self.apply_to_single_clip
-        item['video'] = fn(item['video'])
+        video = item['video']
+        clips = video.reshape(-1, *video.shape[-4:])
+        is_jittered = torch.rand(len(clips)) < self.p_color_jitter
+        is_gray = torch.rand(len(clips)) < self.p_gray_scale
+        if not (is_jittered.any() or is_gray.any()):
+            return item
+        clips = clips.clone(memory_format=torch.contiguous_format)
+        if is_jittered.any():
+            idx = is_jittered.nonzero().squeeze(1)
+            cj = self.color_jitter
+            order, factors = get_color_jitter_params(len(idx), cj.brightness, cj.contrast, cj.saturation, cj.hue)
+            clips[idx] = apply_color_jitter(clips[idx], order, factors)
+        if is_gray.any():
+            idx = is_gray.nonzero().squeeze(1)
+            clips[idx] = torchvision.transforms.functional.rgb_to_grayscale(clips[idx], num_output_channels=3)
+        item['video'] = clips.view(video.shape)
         return item
 
 
 class ApplyColorJitterFrameWise(torch.nn.Module):
+    '''Color jitter with its own parameters for each frame (..., C, H, W)'''
 
     def __init__(self, s=1.) -> None:
         super().__init__()
@@ -175,46 +472,30 @@ class ApplyColorJitterFrameWise(torch.nn.Module):
         # SimCLR params
         self.transform = torchvision.transforms.ColorJitter(0.8*s, 0.8*s, 0.8*s, 0.2*s)
 
-    def apply_to_single_clip(self, clip):
-        for i, frame in enumerate(clip):
-            clip[i] = self.transform(frame)
-        return clip
-
-    def apply_to_each_clip(self, clips):
-        for i, clip in enumerate(clips):
-            clips[i] = self.apply_to_single_clip(clip)
-        return clips
-
     def forward(self, item):
-        has_batch_dim = len(item['video'].shape) == 5
-        if has_batch_dim:
-            fn = self.apply_to_each_clip
-        else:
-            fn = self.apply_to_single_clip
-        item['video'] = fn(item['video'])
+        video = item['video']
+        frames = video.reshape(-1, *video.shape[-3:])
+        cj = self.transform
+        order, factors = get_color_jitter_params(len(frames), cj.brightness, cj.contrast, cj.saturation, cj.hue)
+        item['video'] = apply_color_jitter(frames, order, factors).view(video.shape)
         return item
 
 
 class RandomHorizontalFlip(torchvision.transforms.RandomHorizontalFlip):
+    '''Flips each clip (..., T, C, H, W) with prob `p`'''
 
     def __init__(self, p=0.5):
         super().__init__(p)
 
-    def apply_to_single_clip(self, clip):
-        return super().forward(clip)
-
-    def apply_to_each_clip(self, clips):
-        for i, clip in enumerate(clips):
-            clips[i] = self.apply_to_single_clip(clip)
-        return clips
-
     def forward(self, item):
-        has_batch_dim = len(item['video'].shape) == 5
-        if has_batch_dim:
-            fn = self.apply_to_each_clip
-        else:
-            fn = self.apply_to_single_clip
-        item['video'] = fn(item['video'])
+        video = item['video']
+        clips = video.reshape(-1, *video.shape[-4:])
+        is_flipped = torch.rand(len(clips)) < self.p
+        if is_flipped.all():
+            item['video'] = video.flip(-1)
+        elif is_flipped.any():
+            clips = torch.where(is_flipped.view(-1, 1, 1, 1, 1), clips.flip(-1), clips)
+            item['video'] = clips.view(video.shape)
         return item
 
 
@@ -286,8 +567,6 @@ class TemporalCropAndOffset(torch.nn.Module):
     def forward(self, item):
         vid = item['video']
         aud = item['audio']
-        v_len_frames, C, H, W = vid.shape
-        a_len_frames = aud.shape[0]
 
         v_fps = int(item['meta']['video']['fps'][0])
         a_fps = int(item['meta']['audio']['framerate'][0])
@@ -295,6 +574,63 @@ class TemporalCropAndOffset(torch.nn.Module):
         v_crop_len_frames = sec2frames(self.crop_len_sec, v_fps)
         a_crop_len_frames = sec2frames(self.crop_len_sec, a_fps)
 
+        # if the streams were decoded only within the planned window (see `plan_decode_window`),
+        # the crop parameters are already sampled and the indices are shifted by the window start
+        plan = item['meta'].pop('decode_window', None)
+        if plan is None:
+            v_len_frames, C, H, W = vid.shape
+            a_len_frames = aud.shape[0]
+            v_first_i = a_first_i = 0
+            crop_params = self.get_crop_params(item, v_len_frames, a_len_frames, v_fps, a_fps)
+        else:
+            v_len_frames, a_len_frames = plan['v_len_frames'], plan['a_len_frames']
+            v_first_i, a_first_i = plan['video'][0], plan['audio'][0]
+            crop_params = plan['crop_params']
+        offset_sec, v_start_i_sec, is_oos, v_start_i, a_start_i = crop_params
+        v_end_i = v_start_i + v_crop_len_frames
+
+        if self.max_a_jitter_sec is not None and self.max_a_jitter_sec > 0:
+            a_start_i, a_jitter_i = apply_a_jitter(a_start_i, a_len_frames, a_crop_len_frames, a_fps,
+                                                   self.max_a_jitter_sec)
+            item['meta']['a_jitter_i'] = a_jitter_i
+
+        a_end_i = a_start_i + a_crop_len_frames
+
+        assert v_start_i < v_end_i and a_start_i < a_end_i
+        assert aud.shape[0] >= a_end_i - a_first_i, f'{aud.shape} {a_end_i} {item["path"]}'
+        assert vid.shape[0] >= v_end_i - v_first_i, f'{vid.shape} {v_end_i} {item["path"]}'
+
+        vid = vid[v_start_i-v_first_i:v_end_i-v_first_i, :, :, :]
+        aud = aud[a_start_i-a_first_i:a_end_i-a_first_i]
+
+        item['video'] = vid
+        item['audio'] = aud
+
+        assert item['video'].shape[0] == v_fps * self.crop_len_sec, f'{item["video"].shape} {item["path"]}'
+        assert item['audio'].shape[0] == a_fps * self.crop_len_sec, f'{item["audio"].shape} {item["path"]}'
+
+        # caching parameters
+        if self.do_offset:
+            if self.offset_type == 'grid':
+                offset_label, offset_target = quantize_offset(self.class_grid, offset_sec)
+            elif self.offset_type == 'uniform':
+                offset_label, offset_target = offset_sec, offset_sec
+            elif self.offset_type == 'uniform_binary':
+                offset_label, offset_target = offset_sec, {'oos': is_oos, 'offset': offset_sec}
+            item['targets']['offset_sec'] = offset_sec
+            item['targets']['v_start_i_sec'] = v_start_i_sec
+            item['targets']['offset_label'] = offset_label
+            # assert 'offset_target' not in item['targets'], f'{item["targets"]}. What passed it there?'
+            item['targets']['offset_target'] = offset_target
+
+        return item
+
+    def get_crop_params(self, item, v_len_frames, a_len_frames, v_fps, a_fps):
+        '''Samples (or reads fixed ones from `targets`) the offset and the start of the crop.
+        Returns: offset_sec, v_start_i_sec, is_oos, v_start_i, a_start_i (before the audio jitter)'''
+        v_crop_len_frames = sec2frames(self.crop_len_sec, v_fps)
+        is_oos = None
+
         if self.do_offset:
             # trying to get the offset parameters (for instance during valid and test we have fixed offsets)
             offset_sec = item['targets'].get('offset_sec', None)
@@ -332,7 +668,6 @@ class TemporalCropAndOffset(torch.nn.Module):
             else:
                 offset_sec = round(offset_sec, 2)
                 v_start_i = sec2frames(v_start_i_sec, v_fps)
-            v_end_i = v_start_i + v_crop_len_frames
             # `a_start_i` depends on the rounded value `v_start_i_sec`, otherwise
             # (v_start_sec) we have ±0.1 jittering
             a_start_i = sec2frames(v_start_i_sec + offset_sec, a_fps)
@@ -354,40 +689,22 @@ class TemporalCropAndOffset(torch.nn.Module):
             else:
                 raise Exception(f'{how_much_out} {item["path"]}')
 
-        if self.max_a_jitter_sec is not None and self.max_a_jitter_sec > 0:
-            a_start_i, a_jitter_i = apply_a_jitter(a_start_i, a_len_frames, a_crop_len_frames, a_fps,
-                                                   self.max_a_jitter_sec)
-            item['meta']['a_jitter_i'] = a_jitter_i
-
-        a_end_i = a_start_i + a_crop_len_frames
-
-        assert v_start_i < v_end_i and a_start_i < a_end_i
-        assert aud.shape[0] >= a_end_i, f'{aud.shape} {a_end_i} {item["path"]}'
-        assert vid.shape[0] >= v_end_i, f'{vid.shape} {v_end_i} {item["path"]}'
-
-        vid, aud = vid[v_start_i:v_end_i, :, :, :], aud[a_start_i:a_end_i]
-
-        item['video'] = vid
-        item['audio'] = aud
-
-        assert item['video'].shape[0] == v_fps * self.crop_len_sec, f'{item["video"].shape} {item["path"]}'
-        assert item['audio'].shape[0] == a_fps * self.crop_len_sec, f'{item["audio"].shape} {item["path"]}'
-
-        # caching parameters
-        if self.do_offset:
-            if self.offset_type == 'grid':
-                offset_label, offset_target = quantize_offset(self.class_grid, offset_sec)
-            elif self.offset_type == 'uniform':
-                offset_label, offset_target = offset_sec, offset_sec
-            elif self.offset_type == 'uniform_binary':
-                offset_label, offset_target = offset_sec, {'oos': is_oos, 'offset': offset_sec}
-            item['targets']['offset_sec'] = offset_sec
-            item['targets']['v_start_i_sec'] = v_start_i_sec
-            item['targets']['offset_label'] = offset_label
-            # assert 'offset_target' not in item['targets'], f'{item["targets"]}. What passed it there?'
-            item['targets']['offset_target'] = offset_target
+        return offset_sec, v_start_i_sec, is_oos, v_start_i, a_start_i
 
-        return item
+    def plan_decode_window(self, item, plan):
+        v_fps, a_fps = int(plan['v_fps']), int(plan['a_fps'])
+        v_len_frames, a_len_frames = plan['v_len_frames'], plan['a_len_frames']
+        crop_params = self.get_crop_params(item, v_len_frames, a_len_frames, v_fps, a_fps)
+        _, _, _, v_start_i, a_start_i = crop_params
+        # the audio jitter is sampled in `forward` so we keep the margin for it (clipped as in `apply_a_jitter`)
+        a_margin = 0
+        if self.max_a_jitter_sec is not None and self.max_a_jitter_sec > 0:
+            a_margin = sec2frames(self.max_a_jitter_sec, a_fps)
+        a_crop_len_frames = sec2frames(self.crop_len_sec, a_fps)
+        plan['crop_params'] = crop_params
+        plan['video'] = (v_start_i, v_start_i + sec2frames(self.crop_len_sec, v_fps))
+        plan['audio'] = (max(0, a_start_i - a_margin), min(a_len_frames, a_start_i + a_crop_len_frames + a_margin))
+        return True
 
     def get_crop_idx(self, len_frames: int, crop_len_frames: int, is_random=True):
         if len_frames == crop_len_frames:
@@ -448,10 +765,28 @@ class GenerateMultipleSegments(torch.nn.Module):
                                                             n_segments, segment_size_aframes)
 
         # segmenting original streams (n_segments, segment_size_frames, C, H, W)
-        item['video'] = torch.stack([item['video'][s:e] for s, e in v_ranges], dim=0)
-        item['audio'] = torch.stack([item['audio'][s:e] for s, e in a_ranges], dim=0)
+        item['video'] = self.get_segments(item['video'], v_ranges)
+        item['audio'] = self.get_segments(item['audio'], a_ranges)
         return item
 
+    @staticmethod
+    def get_segments(stream, ranges):
+        '''Returns (n_segments, segment_size, ...) segments of `stream` (T, ...). The evenly spaced segments
+        (as in `get_sequential_seg_ranges`) are returned as a strided view, i.e. the frames are not copied.
+        NOTE: with `step_size_seg` < 1 the segments share frames, the following transforms should not
+        modify them in-place (the first dtype conversion, e.g. `RGBToHalfToZeroOne`, makes a copy).'''
+        starts = ranges[:, 0].long()
+        seg_size = int(ranges[0, 1] - ranges[0, 0])
+        step = int(starts[1] - starts[0]) if len(starts) > 1 else 1
+        is_regular = (starts == starts[0] + step * torch.arange(len(starts))).all() \
+            and ((ranges[:, 1] - ranges[:, 0]) == seg_size).all()
+        if step > 0 and is_regular:
+            start = int(starts[0])
+            end = start + (len(starts) - 1) * step + seg_size
+            # unfold puts the window dim last: (n_segments, ..., segment_size) -> (n_segments, segment_size, ...)
+            return stream[start:end].unfold(0, seg_size, step).movedim(-1, 1)
+        return torch.stack([stream[s:e] for s, e in ranges], dim=0)
+
     def get_sequential_seg_ranges(self, v_len_frames, a_len_frames, v_fps, a_fps, n_seg, seg_size_aframes):
         # if is_start_random is True, the starting position of the 1st segment will
         # be random but respecting n_segments like so: "-CCCCCCCC---" (maybe with fixed overlap),
@@ -669,28 +1004,53 @@ class RGBNormalize(torchvision.transforms.Normalize):
         return item
 
 
-class AudioRandomVolume(torch.nn.Module):
+class RGBToFloatAndNormalize(torch.nn.Module):
+    '''`RGBToHalfToZeroOne` (or `RGBToFloatToZeroOne`) and `RGBNormalize` in one go as
+    `x * (1 / (255 * std)) - mean / std`. It is meant for `transform_sequence_{mode}_post_collate`, so that the
+    dataloader workers send uint8 frames (2-4 times smaller) and the batch is normalized on the training device.
+    This should work for any shape (..., C, H, W)'''
 
-    def __init__(self, p: float, **kwargs):
+    def __init__(self, mean, std, dtype: str = 'float16'):
         super().__init__()
-        transform = torchaudio.transforms.Vol(**kwargs)
-        self.transform = torchvision.transforms.RandomApply([transform], p)
+        self.mean = mean
+        self.std = std
+        self.dtype = getattr(torch, dtype)
+        mean = torch.as_tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+        std = torch.as_tensor(std, dtype=torch.float32).view(-1, 1, 1)
+        # not persistent: they are not part of the model ckpt
+        self.register_buffer('scale', (1 / (255 * std)).to(self.dtype), persistent=False)
+        self.register_buffer('shift', (-mean / std).to(self.dtype), persistent=False)
+        logging.info(f'RGBToFloatAndNormalize: mean={mean.flatten().tolist()}, std={std.flatten().tolist()}')
 
-    def apply_to_single_clip(self, clip):
-        return self.transform(clip)
+    def forward(self, item):
+        item['video'] = torch.addcmul(self.shift, item['video'].to(self.dtype), self.scale)
+        item['meta']['video']['norm_stats'] = {'mean': torch.as_tensor(self.mean),
+                                               'std': torch.as_tensor(self.std)}
+        return item
+
+
+def apply_to_random_clips(audio, p, fn):
+    '''Applies `fn` at once to the clips of `audio` (..., time) that were sampled with prob `p` each, e.g.
+    to each segment after `GenerateMultipleSegments`. `fn` takes (n, time) and returns the same shape.'''
+    clips = audio.reshape(-1, audio.shape[-1])
+    idx = (torch.rand(len(clips)) < p).nonzero().squeeze(1)
+    if len(idx) == 0:
+        return audio
+    # not in-place: the segments might be overlapping views of the same audio (`GenerateMultipleSegments`)
+    clips = clips.clone(memory_format=torch.contiguous_format)
+    clips[idx] = fn(clips[idx])
+    return clips.view(audio.shape)
 
-    def apply_to_each_clip(self, clips):
-        for i, clip in enumerate(clips):
-            clips[i] = self.apply_to_single_clip(clip)
-        return clips
+
+class AudioRandomVolume(torch.nn.Module):
+
+    def __init__(self, p: float, **kwargs):
+        super().__init__()
+        self.p = p
+        self.transform = torchaudio.transforms.Vol(**kwargs)
 
     def forward(self, item):
-        has_batch_dim = len(item['audio'].shape) == 2
-        if has_batch_dim:
-            fn = self.apply_to_each_clip
-        else:
-            fn = self.apply_to_single_clip
-        item['audio'] = fn(item['audio'])
+        item['audio'] = apply_to_random_clips(item['audio'], self.p, self.transform)
         return item
 
 
@@ -702,86 +1062,91 @@ class AudioRandomLowpassFilter(torch.nn.Module):
         self.cutoff_freq = cutoff_freq
         self.Q = Q
 
-    def apply_to_single_clip(self, clip, sr):
-        if self.p > torch.rand(1):
-            return torchaudio.functional.lowpass_biquad(clip, sr, self.cutoff_freq, self.Q)
-        else:
-            return clip
-
-    def apply_to_each_clip(self, clips, sr):
-        for i, clip in enumerate(clips):
-            clips[i] = self.apply_to_single_clip(clip, sr)
-        return clips
-
     def forward(self, item):
-        has_batch_dim = len(item['audio'].shape) == 2
         sr = int(item['meta']['audio']['framerate'][0])
-        if has_batch_dim:
-            fn = self.apply_to_each_clip
-        else:
-            fn = self.apply_to_single_clip
-        item['audio'] = fn(item['audio'], sr)
+        # the biquad runs on the whole (n, time) stack
+        fn = lambda clips: torchaudio.functional.lowpass_biquad(clips, sr, self.cutoff_freq, self.Q)
+        item['audio'] = apply_to_random_clips(item['audio'], self.p, fn)
         return item
 
 
 class AudioRandomPitchShift(torch.nn.Module):
-
-    def __init__(self, p: float, shift: int) -> None:
+    '''Shifts the pitch by `shift` cents (as sox `pitch`) keeping the duration: a phase-vocoder time stretch
+    by the pitch ratio followed by resampling back to the original length (as
+    `torchaudio.functional.pitch_shift`). The ratio is approximated by a fraction with a denominator
+    <= `max_denominator` (< 1 cent off within an octave), so the resampling kernel is small. The kernel
+    does not depend on the sample rate and is made once per dtype and device (`functional.pitch_shift` makes
+    one for sr -> sr / ratio on every call, e.g. 4000 x 7149 taps for 1000 cents at 16 kHz).'''
+
+    def __init__(self, p: float, shift: int, n_fft: int = 512, max_denominator: int = 300) -> None:
         super().__init__()
         self.p = p
         self.shift = shift
-
-    def apply_to_single_clip(self, wave, sr):
-        if self.p > torch.rand(1):
-            effects = [['pitch', f'{self.shift}'], ['rate', f'{sr}']]
-            wave = wave.unsqueeze(0)
-            wave, _ = torchaudio.sox_effects.apply_effects_tensor(wave, sr, effects)
-            wave = wave.squeeze(0)
-        return wave
-
-    def apply_to_each_clip(self, waves, sr):
-        for i, wave in enumerate(waves):
-            waves[i] = self.apply_to_single_clip(wave, sr)
-        return waves
+        self.n_fft = n_fft
+        self.ratio = fractions.Fraction(2 ** (shift / 1200)).limit_denominator(max_denominator)
+        self.resamplers = {}
 
     def forward(self, item):
-        has_batch_dim = len(item['audio'].shape) == 2
-        sr = int(item['meta']['audio']['framerate'][0])
-        if has_batch_dim:
-            fn = self.apply_to_each_clip
-        else:
-            fn = self.apply_to_single_clip
-        item['audio'] = fn(item['audio'], sr)
+        item['audio'] = apply_to_random_clips(item['audio'], self.p, self.pitch_shift)
         return item
 
+    def pitch_shift(self, clips):
+        hop_length = self.n_fft // 4
+        window = torch.hann_window(self.n_fft, device=clips.device, dtype=clips.dtype)
+        spec = torch.stft(clips, self.n_fft, hop_length, window=window, return_complex=True)
+        phase_advance = torch.linspace(0, math.pi * hop_length, spec.shape[-2], device=clips.device,
+                                       dtype=clips.dtype)[..., None]
+        spec = torchaudio.functional.phase_vocoder(spec, float(1 / self.ratio), phase_advance)
+        stretched = torch.istft(spec, self.n_fft, hop_length, window=window,
+                                length=round(clips.shape[-1] * self.ratio))
+        shifted = self.get_resampler(clips.dtype, clips.device)(stretched)[..., :clips.shape[-1]]
+        # the resampled length might be a sample short
+        return torch.nn.functional.pad(shifted, (0, clips.shape[-1] - shifted.shape[-1]))
+
+    def get_resampler(self, dtype, device):
+        if (dtype, device) not in self.resamplers:
+            resampler = torchaudio.transforms.Resample(self.ratio.numerator, self.ratio.denominator, dtype=dtype)
+            self.resamplers[(dtype, device)] = resampler.to(device)
+        return self.resamplers[(dtype, device)]
+
 
 class AudioRandomReverb(torch.nn.Module):
+    '''Convolves the audio (FFT) with an impulse response from a bank of `num_rirs` synthetic room impulse
+    responses (exponentially decaying noise with RT60 in `rt60_sec`) and outputs the wet signal only, as
+    sox `reverb -w`, with the loudness (RMS) of the input. The bank is made once per sample rate with a fixed
+    seed, so it is the same in all dataloader workers.'''
 
-    def __init__(self, p: float) -> None:
+    def __init__(self, p: float, rt60_sec=(0.2, 0.8), num_rirs: int = 32, seed: int = 1337) -> None:
         super().__init__()
         self.p = p
-        self.effects = [['reverb', '-w']]
-
-    def apply_to_single_clip(self, wave, fps):
-        if self.p > torch.rand(1):
-            wave = wave.unsqueeze(0)
-            wave, _ = torchaudio.sox_effects.apply_effects_tensor(wave, fps, self.effects)
-            wave = wave.mean(dim=0)
-        return wave
-
-    def apply_to_each_clip(self, waves, fps):
-        for i, wave in enumerate(waves):
-            waves[i] = self.apply_to_single_clip(wave, fps)
-        return waves
+        self.rt60_sec = rt60_sec
+        self.num_rirs = num_rirs
+        self.seed = seed
+        self.rirs = {}
+
+    def get_rirs(self, sr):
+        '''(num_rirs, max_rt60 * sr)'''
+        if sr not in self.rirs:
+            generator = torch.Generator().manual_seed(self.seed)
+            rt60 = torch.empty(self.num_rirs).uniform_(*self.rt60_sec, generator=generator)
+            t = torch.arange(int(max(self.rt60_sec) * sr)) / sr
+            # -60 dB at rt60
+            decay = torch.exp(-math.log(1000) * t[None] / rt60[:, None])
+            rirs = torch.randn(self.num_rirs, len(t), generator=generator) * decay
+            self.rirs[sr] = rirs / rirs.norm(dim=-1, keepdim=True)
+        return self.rirs[sr]
+
+    def reverberate(self, clips, sr):
+        rirs = self.get_rirs(sr).to(clips.device)
+        rirs = rirs[torch.randint(len(rirs), (len(clips), ))]
+        n = clips.shape[-1] + rirs.shape[-1] - 1
+        wet = torch.fft.irfft(torch.fft.rfft(clips, n) * torch.fft.rfft(rirs, n), n)[..., :clips.shape[-1]]
+        rms = lambda x: x.pow(2).mean(dim=-1, keepdim=True).sqrt()
+        return wet * rms(clips) / rms(wet).clamp(min=1e-8)
 
     def forward(self, item):
-        has_batch_dim = len(item['audio'].shape) == 2
         sr = int(item['meta']['audio']['framerate'][0])
-        if has_batch_dim:
-            fn = self.apply_to_each_clip
-        else:
-            fn = self.apply_to_single_clip
-        item['audio'] = fn(item['audio'], sr)
+        item['audio'] = apply_to_random_clips(item['audio'], self.p, lambda clips: self.reverberate(clips, sr))
         return item
 
 class AudioRandomGaussNoise(torch.nn.Module):
@@ -791,37 +1156,91 @@ class AudioRandomGaussNoise(torch.nn.Module):
         self.p = p
         self.amplitude = amplitude
 
-    def apply_to_single_clip(self, wave):
-        if self.p > torch.rand(1):
-            noise = torch.randn_like(wave, dtype=wave.dtype)
-            wave = wave + self.amplitude * noise
-        return wave
+    def forward(self, item):
+        fn = lambda clips: clips + self.amplitude * torch.randn_like(clips)
+        item['audio'] = apply_to_random_clips(item['audio'], self.p, fn)
+        return item
+
+
+class AudioToInt16(torch.nn.Module):
+    '''Quantizes the waveform to 16 bits (the same as in the .wav) to halve the size of the items sent from
+    the dataloader workers, e.g. if the audio features are made after collation (see
+    `transform_sequence_{mode}_post_collate`). `AudioInt16ToFloat` converts it back.'''
+
+    def __init__(self) -> None:
+        super().__init__()
+
+    def forward(self, item):
+        item['audio'] = item['audio'].mul(2 ** 15).round().clamp(-2 ** 15, 2 ** 15 - 1).to(torch.int16)
+        return item
+
 
-    def apply_to_each_clip(self, waves):
-        for i, wave in enumerate(waves):
-            waves[i] = self.apply_to_single_clip(wave)
-        return waves
+class AudioInt16ToFloat(torch.nn.Module):
+
+    def __init__(self) -> None:
+        super().__init__()
 
     def forward(self, item):
-        has_batch_dim = len(item['audio'].shape) == 2
-        if has_batch_dim:
-            fn = self.apply_to_each_clip
-        else:
-            fn = self.apply_to_single_clip
-        item['audio'] = fn(item['audio'])
+        item['audio'] = item['audio'].to(torch.float32).div(2 ** 15)
         return item
 
 
 class AudioMelSpectrogram(torch.nn.Module):
-
-    def __init__(self, **kwargs):
+    '''If `shared_stft` is True and the audio segments are overlapping views of the same crop (as made by
+    `GenerateMultipleSegments`), the spectrogram of the whole crop is computed once and the frames of each
+    segment are sliced from it (the segment step should be a multiple of `hop_length`, otherwise falls back
+    to per-segment spectrograms). The output shape is the same as with the per-segment spectrograms, and so
+    are the values except for ~`n_fft / (2 * hop_length)` frames at the inner edges of the segments: they
+    see the neighbouring audio instead of the reflection padding (see `check_shared_stft`).'''
+
+    def __init__(self, shared_stft: bool = False, **kwargs):
         super().__init__()
         self.spec = torchaudio.transforms.MelSpectrogram(**kwargs)
+        self.shared_stft = shared_stft
 
     def forward(self, item):
-        item['audio'] = self.spec(item['audio'])  # safe for batched input
+        crop = self.get_shared_crop(item['audio']) if self.shared_stft else None
+        if crop is None:
+            item['audio'] = self.spec(item['audio'])  # safe for batched input
+        else:
+            item['audio'] = self.slice_segments(self.spec(crop[0]), crop[1], item['audio'].shape[1])
         return item
 
+    def get_shared_crop(self, audio):
+        '''Returns the audio crop that the segments (n_segments, segment_size) are views of, and the step
+        between segments, or None if the segments don't overlap.'''
+        if audio.dim() != 2 or len(audio) < 2:
+            return None
+        step, sample_stride = audio.stride()
+        segment_size = audio.shape[1]
+        # rows can overlap only in a view, e.g. not if the segments were augmented one by one and stacked
+        if sample_stride != 1 or not 0 < step < segment_size or step % self.spec.hop_length != 0:
+            return None
+        crop_len = (len(audio) - 1) * step + segment_size
+        return audio.as_strided((crop_len, ), (1, )), step
+
+    def slice_segments(self, spec, step, segment_size):
+        '''(n_mels, T_crop) -> (n_segments, n_mels, T_segment)'''
+        hop_length = self.spec.hop_length
+        if self.spec.spectrogram.center:
+            segment_frames = segment_size // hop_length + 1
+        else:
+            segment_frames = (segment_size - self.spec.n_fft) // hop_length + 1
+        return spec.unfold(-1, segment_frames, step // hop_length).movedim(-2, 0)
+
+    def check_shared_stft(self, audio, eps=1e-6):
+        '''Compares the shared STFT with the per-segment one on `audio` (n_segments, segment_size) made by
+        `GenerateMultipleSegments`. Returns the max abs differences of log-mels (inside, at edges) of the
+        segments, the former should be at the level of float rounding errors.'''
+        crop = self.get_shared_crop(audio)
+        assert crop is not None, 'the segments are not overlapping views of the same crop'
+        per_segment = torch.log(self.spec(audio.contiguous()) + eps)
+        shared = torch.log(self.slice_segments(self.spec(crop[0]), crop[1], audio.shape[1]) + eps)
+        edge = math.ceil(self.spec.n_fft / 2 / self.spec.hop_length) if self.spec.spectrogram.center else 0
+        diff = (per_segment - shared).abs()
+        inside = diff[..., edge:diff.shape[-1]-edge].max().item()
+        return inside, diff.max().item()
+
 
 class AudioLog(torch.nn.Module):
 
@@ -894,15 +1313,23 @@ class ResampleAudio(torch.nn.Module):
     def __init__(self, new_fps: int):
         super().__init__()
         self.new_fps = new_fps
+        # the sinc kernel is made once per input framerate (`functional.resample` makes it on every call)
+        self.resamplers = {}
 
     def forward(self, item):
         orig_fps = int(item['meta']['audio']['framerate'][0])
         item['meta']['audio']['orig_shape'] = item['audio'].shape
         if orig_fps != self.new_fps:
-            item['audio'] = torchaudio.functional.resample(item['audio'], orig_fps, self.new_fps)
+            item['audio'] = self.get_resampler(orig_fps, item['audio'].dtype)(item['audio'])
             item['meta']['audio']['framerate'][0] = self.new_fps
         return item
 
+    def get_resampler(self, orig_fps, dtype):
+        if (orig_fps, dtype) not in self.resamplers:
+            self.resamplers[(orig_fps, dtype)] = torchaudio.transforms.Resample(orig_fps, self.new_fps,
+                                                                                 dtype=dtype)
+        return self.resamplers[(orig_fps, dtype)]
+
 class ResampleRGB(torch.nn.Module):
 
     def __init__(self, new_fps: int) -> None:
@@ -931,25 +1358,41 @@ class ResizeAndLetterboxPad(torch.nn.Module):
         self.aspect_ratio = new_w / new_h
 
     def forward(self, item):
-        item['video'] = self.resize_and_pad(item['video'])
+        # if planned, the frames were resized by the decoder and only the padding is left
+        item['video'] = self.resize_and_pad(item['video'], is_resized=is_done_at_decode(self, item))
         return item
 
-    def resize_and_pad(self, rgb: torch.Tensor):
-        _, _, height, width = rgb.shape
+    def get_scaled_size(self, height, width):
         current_aspect_ratio = width / height
         if current_aspect_ratio > self.aspect_ratio:
-            scaled_height = round(self.new_w / current_aspect_ratio)
-            rgb = torchvision.transforms.functional.resize(rgb, (scaled_height, self.new_w), antialias=None)
-            top = (self.new_h - scaled_height) // 2
-            bottom = self.new_h - (scaled_height + top)
-            rgb = torch.nn.ConstantPad2d((0, 0, top, bottom), 0)(rgb)
+            return round(self.new_w / current_aspect_ratio), self.new_w
         elif current_aspect_ratio < self.aspect_ratio:
-            scaled_width = round(self.new_h*current_aspect_ratio)
-            rgb = torchvision.transforms.functional.resize(rgb, (self.new_h, scaled_width), antialias=None)
-            left = (self.new_w - scaled_width) // 2
-            right = self.new_w - (scaled_width + left)
-            rgb = torch.nn.ConstantPad2d((left, right, 0, 0), 0)(rgb)
-        return rgb
+            return self.new_h, round(self.new_h*current_aspect_ratio)
+        return height, width
+
+    def resize_and_pad(self, rgb: torch.Tensor, is_resized: bool = False):
+        _, _, height, width = rgb.shape
+        if not is_resized:
+            if (height, width) == self.get_scaled_size(height, width):
+                return rgb
+            rgb = torchvision.transforms.functional.resize(rgb, self.get_scaled_size(height, width),
+                                                           antialias=None)
+        _, _, height, width = rgb.shape
+        top = (self.new_h - height) // 2
+        bottom = self.new_h - (height + top)
+        left = (self.new_w - width) // 2
+        right = self.new_w - (width + left)
+        return torch.nn.ConstantPad2d((left, right, top, bottom), 0)(rgb)
+
+    def plan_decode_window(self, item, plan):
+        if plan['frame_size'] is None:
+            return False
+        size = self.get_scaled_size(*plan['frame_size'])
+        if can_plan_spatial(plan) and size != plan['frame_size']:
+            plan['size'] = size
+            plan['done_at_decode'].append(id(self))
+        plan['frame_size'] = (self.new_h, self.new_w) if size != plan['frame_size'] else size
+        return False
 
 
 class ResampleResizeLetterboxPad(torch.nn.Module):
@@ -1053,6 +1496,19 @@ if __name__ == '__main__':
     input = fn(input)
     print(input['audio'].shape, input['video'].shape, input['meta']['audio'])
 
+    # shared STFT vs per-segment STFT (the setting of `configs/sync.yaml`)
+    a_fps = 16000
+    input = {
+        'video': torch.zeros(int(duration * v_fps), 3, 8, 8, dtype=torch.uint8),
+        'audio': torch.randn(int(duration * a_fps)),
+        'meta': {'video': {'fps': [v_fps]}, 'audio': {'framerate': [a_fps]}},
+        'path': 'random_noise',
+    }
+    input = GenerateMultipleSegments(segment_size_vframes=16, n_segments=14, step_size_seg=0.5)(input)
+    fn = AudioMelSpectrogram(shared_stft=True, sample_rate=a_fps, win_length=400, hop_length=160, n_fft=1024,
+                             n_mels=128)
+    print('shared STFT max abs diff (inside, at edges):', fn.check_shared_stft(input['audio']))
+
     # audio only
     input = {
         'audio': torch.arange(221184).float(),
@@ -7,10 +7,12 @@ from collections import Counter
 from glob import glob
 from pathlib import Path
 
+import numpy as np
 import torch
 
 sys.path.insert(0, '.')  # nopep8
-from dataset.dataset_utils import get_fixed_offsets, get_video_and_audio, subsample_dataset
+from dataset.dataset_utils import (PreprocessedCache, get_fixed_offsets, get_media_loader,
+                                   get_windowed_datapoint, load_or_build_index, subsample_dataset)
 
 
 class VGGSound(torch.utils.data.Dataset):
@@ -27,9 +29,13 @@ class VGGSound(torch.utils.data.Dataset):
                  vis_load_backend='read_video',
                  size_ratio=None,
                  attr_annot_path=None,
-                 max_attr_per_vid=None):
+                 max_attr_per_vid=None,
+                 windowed_decode=False,
+                 preprocessed_cache_dir=None):
         super().__init__()
         self.max_clip_len_sec = None
+        self.min_video_frames = 175
+        self.min_audio_samples = 112800
         self.split = split
         self.vids_dir = vids_dir
         self.transforms = transforms
@@ -39,27 +45,32 @@ class VGGSound(torch.utils.data.Dataset):
         self.seed = seed
         self.load_fixed_offsets_on = [] if load_fixed_offsets_on is None else load_fixed_offsets_on
         self.vis_load_backend = vis_load_backend
+        self.media_loader = get_media_loader(vis_load_backend)
         self.size_ratio = size_ratio
+        # the pre-decoded clips are memory-mapped and sliced lazily, the windowed decode has nothing to save
+        self.windowed_decode = windowed_decode and vis_load_backend != 'mmap'
+        # the transformed items of the splits with fixed offsets are the same every time, they can be cached
+        self.preprocessed_cache = None
+        if preprocessed_cache_dir is not None and transforms is not None:
+            decode_params = {'vis_load_backend': vis_load_backend, 'windowed_decode': self.windowed_decode,
+                             'max_clip_len_sec': self.max_clip_len_sec}
+            self.preprocessed_cache = PreprocessedCache(preprocessed_cache_dir, transforms, decode_params)
 
-        vggsound_meta = list(csv.reader(open(meta_path), quotechar='"'))
+        split_clip_ids_path = os.path.join(splits_path, f'vggsound_{split}.txt')
+        if not os.path.exists(split_clip_ids_path):
+            self.make_split_files()
 
-        # filter "bad" examples
-        if to_filter_bad_examples:
-            vggsound_meta = self.filter_bad_examples(vggsound_meta)
+        # parsing the meta and the filtered lists takes a while, the result is cached until the inputs change
+        index_inputs = [meta_path, split_clip_ids_path] + sorted(glob('./data/filtered_examples_vggsound*/*.txt'))
+        index_params = [self.__class__.__name__, vids_dir, to_filter_bad_examples]
+        index = load_or_build_index(f'vggsound_{split}', index_inputs, index_params, self.build_index,
+                                    os.path.join(splits_path, 'index_cache'))
 
-        unique_classes = sorted(list(set(row[2] for row in vggsound_meta)))
+        unique_classes = index['labels'].tolist()
         self.label2target = {label: target for target, label in enumerate(unique_classes)}
         self.target2label = {target: label for label, target in self.label2target.items()}
-        self.video2target = {row[0]: self.label2target[row[2]] for row in vggsound_meta}
-
-        split_clip_ids_path = os.path.join(splits_path, f'vggsound_{split}.txt')
-        if not os.path.exists(split_clip_ids_path):
-            self.make_split_files()
-        # the ugly string converts ['AdfsGsfII2yQ', '1'] into `AdfsGsfII2yQ_1000_11000`
-        meta_available = set([f'{r[0]}_{int(r[1])*1000}_{(int(r[1])+10)*1000}' for r in vggsound_meta])
-        within_split = set(open(split_clip_ids_path).read().splitlines())
-        clip_paths = [os.path.join(vids_dir, v + '.mp4') for v in meta_available.intersection(within_split)]
-        clip_paths = sorted(clip_paths)
+        self.video2target = dict(zip(index['video_ids'].tolist(), index['video_targets'].tolist()))
+        clip_paths = index['clip_paths'].tolist()
 
         if split in self.load_fixed_offsets_on:
             logging.info(f'Using fixed offset for {split}')
@@ -73,6 +84,30 @@ class VGGSound(torch.utils.data.Dataset):
         self.dataset = clip_paths
         self.dataset = subsample_dataset(self.dataset, size_ratio, shuffle=split == 'train')
 
+    def build_index(self):
+        vggsound_meta = list(csv.reader(open(self.meta_path), quotechar='"'))
+
+        # filter "bad" examples
+        if self.to_filter_bad_examples:
+            vggsound_meta = self.filter_bad_examples(vggsound_meta)
+
+        unique_classes = sorted(list(set(row[2] for row in vggsound_meta)))
+        label2target = {label: target for target, label in enumerate(unique_classes)}
+
+        split_clip_ids_path = os.path.join(self.splits_path, f'vggsound_{self.split}.txt')
+        # the ugly string converts ['AdfsGsfII2yQ', '1'] into `AdfsGsfII2yQ_1000_11000`
+        meta_available = set([f'{r[0]}_{int(r[1])*1000}_{(int(r[1])+10)*1000}' for r in vggsound_meta])
+        within_split = set(open(split_clip_ids_path).read().splitlines())
+        clip_paths = [os.path.join(self.vids_dir, v + '.mp4') for v in meta_available.intersection(within_split)]
+        clip_paths = sorted(clip_paths)
+
+        return {
+            'labels': np.array(unique_classes, dtype=str),
+            'video_ids': np.array([row[0] for row in vggsound_meta], dtype=str),
+            'video_targets': np.array([label2target[row[2]] for row in vggsound_meta], dtype=np.int64),
+            'clip_paths': np.array(clip_paths, dtype=str),
+        }
+
     def filter_bad_examples(self, vggsound_meta):
         bad = set()
         base_path = Path('./data/filtered_examples_vggsound')
@@ -85,8 +120,19 @@ class VGGSound(torch.utils.data.Dataset):
 
     def __getitem__(self, index):
         path = self.dataset[index]
-        rgb, audio, meta = self.load_media(path)
-        item = self.make_datapoint(path, rgb, audio, meta)
+        if self.preprocessed_cache is not None and self.split in self.load_fixed_offsets_on:
+            offset_params = self.vid2offset_params[Path(path).stem]
+            return self.preprocessed_cache.get(path, offset_params, lambda: self.get_transformed_item(path))
+        return self.get_transformed_item(path)
+
+    def get_transformed_item(self, path):
+        if self.windowed_decode and self.transforms is not None:
+            # decodes only the frames that the temporal crop will take (full decode if it can't be planned)
+            item = get_windowed_datapoint(path, self.transforms, self.make_datapoint, self.load_media,
+                                          self.max_clip_len_sec, self.min_video_frames, self.min_audio_samples)
+        else:
+            rgb, audio, meta = self.load_media(path)
+            item = self.make_datapoint(path, rgb, audio, meta)
         if self.transforms is not None:
             item = self.transforms(item)
         return item
@@ -116,9 +162,9 @@ class VGGSound(torch.utils.data.Dataset):
         return item
 
     def load_media(self, path):
-        rgb, audio, meta = get_video_and_audio(path, get_meta=True, end_sec=self.max_clip_len_sec)
-        min_video_frames = 175
-        min_audio_samples = 112800
+        rgb, audio, meta = self.media_loader(path, get_meta=True, end_sec=self.max_clip_len_sec)
+        min_video_frames = self.min_video_frames
+        min_audio_samples = self.min_audio_samples
         if rgb.shape[0] < min_video_frames:
             rgb = torch.cat([rgb, rgb[-1:].repeat(min_video_frames - rgb.shape[0], 1, 1, 1)], dim=0)
             logging.info(f'video length is too short, padding to {min_video_frames}, path: {path}')
@@ -200,9 +246,12 @@ class VGGSoundSparse(VGGSound):
     def __init__(self, split, vids_dir, transforms=None, to_filter_bad_examples=True,
                  splits_path='./data', meta_path='./data/vggsound.csv',
                  sparse_meta_path='./data/sparse_classes.csv', seed=1337, load_fixed_offsets_on=['valid', 'test'],
-                 vis_load_backend='read_video', size_ratio=None, attr_annot_path=None, max_attr_per_vid=None):
+                 vis_load_backend='read_video', size_ratio=None, attr_annot_path=None, max_attr_per_vid=None,
+                 windowed_decode=False,
+                 preprocessed_cache_dir=None):
         super().__init__(split, vids_dir, transforms, to_filter_bad_examples, splits_path, meta_path, seed,
-                         load_fixed_offsets_on, vis_load_backend, size_ratio)
+                         load_fixed_offsets_on, vis_load_backend, size_ratio, windowed_decode=windowed_decode,
+                         preprocessed_cache_dir=preprocessed_cache_dir)
         self.sparse_meta_path = sparse_meta_path
         sparse_meta = list(csv.reader(open(sparse_meta_path), quotechar='"', delimiter='\t'))
         sparse_classes = set([row[0] for row in sparse_meta if row[1] == 'y'])
@@ -239,10 +288,11 @@ class VGGSoundSparsePicked(VGGSoundSparse):
                  splits_path='./data', meta_path='./data/vggsound.csv',
                  sparse_meta_path='./data/picked_sparse_classes.csv', seed=1337,
                  load_fixed_offsets_on=['valid', 'test'], vis_load_backend='read_video', size_ratio=None,
-                 attr_annot_path=None, max_attr_per_vid=None):
+                 attr_annot_path=None, max_attr_per_vid=None, windowed_decode=False, preprocessed_cache_dir=None):
         super().__init__(split, vids_dir, transforms, to_filter_bad_examples, splits_path,
                          meta_path, sparse_meta_path, seed, load_fixed_offsets_on, vis_load_backend,
-                         size_ratio)
+                         size_ratio, windowed_decode=windowed_decode,
+                         preprocessed_cache_dir=preprocessed_cache_dir)
 
 
 class VGGSoundSparsePickedCleanTest(VGGSoundSparse):
@@ -251,10 +301,11 @@ class VGGSoundSparsePickedCleanTest(VGGSoundSparse):
                  splits_path='./data', meta_path='./data/vggsound.csv',
                  sparse_meta_path='./data/picked_sparse_classes.csv', seed=1337,
                  load_fixed_offsets_on=['valid', 'test'], vis_load_backend='read_video', size_ratio=None,
-                 attr_annot_path=None, max_attr_per_vid=None):
+                 attr_annot_path=None, max_attr_per_vid=None, windowed_decode=False, preprocessed_cache_dir=None):
         super().__init__(split, vids_dir, transforms, to_filter_bad_examples, splits_path,
                          meta_path, sparse_meta_path, seed, load_fixed_offsets_on, vis_load_backend,
-                         size_ratio)
+                         size_ratio, windowed_decode=windowed_decode,
+                         preprocessed_cache_dir=preprocessed_cache_dir)
 
     def filter_bad_examples(self, vggsound_meta):
         bad = set()
@@ -277,10 +328,11 @@ class VGGSoundSparsePickedCleanTestFixedOffsets(VGGSoundSparse):
                  splits_path='./data', meta_path='./data/vggsound.csv',
                  sparse_meta_path='./data/picked_sparse_classes.csv', seed=1337,
                  load_fixed_offsets_on=['valid', 'test'], vis_load_backend='read_video', size_ratio=None,
-                 attr_annot_path=None, max_attr_per_vid=None):
+                 attr_annot_path=None, max_attr_per_vid=None, windowed_decode=False, preprocessed_cache_dir=None):
         super().__init__(split, vids_dir, transforms, to_filter_bad_examples, splits_path,
                          meta_path, sparse_meta_path, seed, load_fixed_offsets_on, vis_load_backend,
-                         size_ratio)
+                         size_ratio, windowed_decode=windowed_decode,
+                         preprocessed_cache_dir=preprocessed_cache_dir)
         # redefine the dataset to only use fixed offsets
         fix_off_path = './data/vggsound_sparse_clean_fixed_offsets.csv'
         self.vid2offset_params = {}
@@ -316,10 +368,13 @@ class LongerVGGSound(VGGSound):
                  vis_load_backend='read_video',
                  size_ratio=None,
                  attr_annot_path=None,
-                 max_attr_per_vid=None):
+                 max_attr_per_vid=None,
+                 windowed_decode=False,
+                 preprocessed_cache_dir=None):
         # size_ratio=None and fixed_offsets_on=[] to avoid double subsampling and loading fixed offsets
         super().__init__(split, vids_dir, transforms, to_filter_bad_examples, splits_path, meta_path, seed,
-                         [], vis_load_backend, None, attr_annot_path, max_attr_per_vid)
+                         [], vis_load_backend, None, attr_annot_path, max_attr_per_vid, windowed_decode,
+                         preprocessed_cache_dir)
         # redefining the load_fixed_offsets_on because the parent class does not load them (see above)
         self.load_fixed_offsets_on = load_fixed_offsets_on
         # doing the extra filtering for longer than 9.5 sec
@@ -1,5 +1,7 @@
 import argparse
-import subprocess
+import copy
+import math
+import time
 from pathlib import Path
 
 import torch
@@ -7,33 +9,206 @@ import torchaudio
 import torchvision
 from omegaconf import OmegaConf
 
-from dataset.dataset_utils import get_video_and_audio
-from dataset.transforms import make_class_grid, quantize_offset
-from utils.utils import check_if_file_exists_else_download, which_ffmpeg
-from scripts.train_utils import get_model, get_transforms, prepare_inputs
-
-
-def reencode_video(path, vfps=25, afps=16000, in_size=256):
-    assert which_ffmpeg() != '', 'Is ffmpeg installed? Check if the conda environment is activated.'
-    new_path = Path.cwd() / 'vis' / f'{Path(path).stem}_{vfps}fps_{in_size}side_{afps}hz.mp4'
-    new_path.parent.mkdir(exist_ok=True)
-    new_path = str(new_path)
-    cmd = f'{which_ffmpeg()}'
-    # no info/error printing
-    cmd += ' -hide_banner -loglevel panic'
-    cmd += f' -y -i {path}'
-    # 1) change fps, 2) resize: min(H,W)=MIN_SIDE (vertical vids are supported), 3) change audio framerate
-    cmd += f" -vf fps={vfps},scale=iw*{in_size}/'min(iw,ih)':ih*{in_size}/'min(iw,ih)',crop='trunc(iw/2)'*2:'trunc(ih/2)'*2"
-    cmd += f" -ar {afps}"
-    cmd += f' {new_path}'
-    subprocess.call(cmd.split())
-    cmd = f'{which_ffmpeg()}'
-    cmd += ' -hide_banner -loglevel panic'
-    cmd += f' -y -i {new_path}'
-    cmd += f' -acodec pcm_s16le -ac 1'
-    cmd += f' {new_path.replace(".mp4", ".wav")}'
-    subprocess.call(cmd.split())
-    return new_path
+from dataset.dataset_utils import get_resampled_window, get_video_and_audio, probe_video_and_audio
+from dataset.feature_store import make_segments, split_segment_transforms
+from dataset.transforms import (ResampleAudio, ResampleRGB, Resize, frames2sec, get_resized_crop_roi, make_class_grid,
+                                quantize_offset, sec2frames)
+from utils.utils import check_if_file_exists_else_download, patch_config, reencode_video
+from scripts.train_utils import get_model, get_post_collate_transforms, get_transforms, prepare_inputs
+
+
+def maybe_reencode_video(path, vfps=25, afps=16000, in_size=256):
+    '''Checks if the provided video has the correct frame rates and size, and re-encodes it with ffmpeg if not'''
+    v, _, info = torchvision.io.read_video(path, pts_unit='sec')
+    _, H, W, _ = v.shape
+    if info['video_fps'] != vfps or info['audio_fps'] != afps or min(H, W) != in_size:
+        print(f'Reencoding. vfps: {info["video_fps"]} -> {vfps};', end=' ')
+        print(f'afps: {info["audio_fps"]} -> {afps};', end=' ')
+        print(f'{(H, W)} -> min(H, W)={in_size}')
+        return reencode_video(path, vfps, afps, in_size)
+    print(f'Skipping reencoding. vfps: {info["video_fps"]}; afps: {info["audio_fps"]}; min(H, W)={in_size}')
+    return path
+
+def make_resample_transforms(vfps=25, afps=16000, in_size=256):
+    '''The in-process alternative to `reencode_video` (no ffmpeg subprocess and temp files): the frames are
+    picked at `vfps`, resized to min(H, W)=`in_size` (if given), and the audio is resampled to `afps`.
+    Keep the instance around: `ResampleAudio` caches the resampling kernel.'''
+    resize = [] if in_size is None else [Resize(in_size, antialias=True)]
+    return torchvision.transforms.Compose([ResampleRGB(new_fps=vfps), *resize, ResampleAudio(new_fps=afps)])
+
+def load_item(vid_path, v_start_i_sec, offset_sec, resample_transforms=None, vfps=25, afps=16000, in_size=256):
+    '''Decodes the video (once) and makes an item (dict) to apply the test transforms to. If
+    `resample_transforms` is None, the video is re-encoded with ffmpeg (if needed) and decoded from the new file.'''
+    if resample_transforms is None:
+        vid_path = maybe_reencode_video(vid_path, vfps, afps, in_size)
+    # rgb: (Tv, 3, H, W) in [0, 225], audio: (Ta,) in [-1, 1]
+    rgb, audio, meta = get_video_and_audio(vid_path, get_meta=True)
+
+    # NOTE: here is how it works:
+    # For instance, if the model is trained on 5sec clips, the provided video is 9sec, and `v_start_i_sec=1.3`
+    # the transform will crop out a 5sec-clip from 1.3 to 6.3 seconds and shift the start of the audio
+    # track by `args.offset_sec` seconds. It means that if `offset_sec` > 0, the audio will
+    # start by `offset_sec` earlier than the rgb track.
+    # It is a good idea to use something in [-`max_off_sec`, `max_off_sec`] (-2, +2) seconds (see `grid`)
+    item = dict(
+        video=rgb, audio=audio, meta=meta, path=vid_path, split='test',
+        targets={'v_start_i_sec': v_start_i_sec, 'offset_sec': offset_sec, },
+    )
+    if resample_transforms is not None:
+        item = resample_transforms(item)
+    return item
+
+def load_item_window(vid_path, v_start_i_sec, offsets_sec, test_transforms, resample_transforms, in_size=256):
+    '''The same item as `load_item` with the in-process resampling, but only the part of the video that the
+    crop at `v_start_i_sec` needs with any of the audio shifts `offsets_sec` is decoded, and only the region
+    of the frames that the test-time center crop takes, resized to the crop while decoding (see
+    `dataset_utils.get_resampled_window`). `resample_transforms` should not resize the frames
+    (`make_resample_transforms` with `in_size=None`). The offset of the item is the first of `offsets_sec`,
+    `v_start_i_sec` in its targets is relative to the start of the decoded part.'''
+    pre, crop, _, _ = split_segment_transforms(test_transforms)
+    meta = probe_video_and_audio(vid_path)
+    roi, size = get_resized_crop_roi(meta['video']['frame_size'][0], in_size, pre)
+    vfps = next(t.new_fps for t in resample_transforms.transforms if isinstance(t, ResampleRGB))
+    afps = next(t.new_fps for t in resample_transforms.transforms if isinstance(t, ResampleAudio))
+    # starts on a whole second (a bit before the crop) for the same frames as if the whole video was resampled
+    start_sec = max(0, math.floor(v_start_i_sec + min(0, *offsets_sec) - 0.1))
+    end_sec = v_start_i_sec + crop.crop_len_sec + max(0, *offsets_sec) + 0.1
+    v_range = (start_sec * vfps, math.ceil(end_sec * vfps))
+    a_range = (start_sec * afps, math.ceil(end_sec * afps))
+    # rgb: (Tv, 3, H, W) in [0, 225], audio: (Ta,) in [-1, 1]
+    rgb, audio = get_resampled_window(vid_path, v_range, a_range, meta, resample_transforms, roi, size)
+    return dict(
+        video=rgb, audio=audio, meta={'video': {'fps': [vfps]}, 'audio': {'framerate': [afps]}}, path=vid_path,
+        split='test', targets={'v_start_i_sec': round(v_start_i_sec - start_sec, 6), 'offset_sec': offsets_sec[0]},
+    )
+
+def copy_item(item, **targets):
+    '''A copy of `item` (before the test transforms) with the `targets` updated, e.g. another offset for the
+    same crop. The decoded streams are shared, the transforms replace them in the copy instead of modifying
+    them in-place.'''
+    return dict(item, meta=copy.deepcopy(item['meta']), targets=dict(item['targets'], **targets))
+
+def predict(model, cfg, device, item, test_transforms, post_collate_transforms):
+    '''Applies the test-time transform to the item and runs the model. Returns the transformed item,
+    model inputs and the offset logits'''
+    item = test_transforms(item)
+
+    # prepare inputs for inference
+    batch = torch.utils.data.default_collate([item])
+    aud, vid, targets = prepare_inputs(batch, device, post_collate_transforms=post_collate_transforms)
+
+    # TODO:
+    # sanity check: we will take the input to the `model` and recontruct make a video from it.
+    # Use this check to make sure the input makes sense (audio should be ok but shifted as you specified)
+    # reconstruct_video_from_input(aud, vid, batch['meta'], args.vid_path, args.v_start_i_sec, args.offset_sec,
+    #                              vfps, afps)
+
+    # forward pass
+    with torch.set_grad_enabled(False):
+        with torch.autocast('cuda', enabled=cfg.training.use_half_precision):
+            _, logits = model(vid, aud)
+    return item, aud, vid, logits
+
+def make_sweep_inputs(item, test_transforms, offsets):
+    '''Makes the segments of the crop at `v_start_i_sec` with the audio shifted by each of `offsets` (sec),
+    the same as `test_transforms` would make them for each offset. The audio segments that several offsets
+    share (they start on the same sample) are made once.
+    Returns the transformed item with the video (S, Tv, C, H, W) and the U distinct audio segments
+    (U, 1, F, Ta), and the (N, S) indices of the audio segments of each offset.'''
+    pre, crop, segmenter, post = split_segment_transforms(test_transforms)
+    for t in pre:
+        item = t(item)
+    v_fps = int(item['meta']['video']['fps'][0])
+    a_fps = int(item['meta']['audio']['framerate'][0])
+    v_len_frames, a_len_frames = len(item['video']), len(item['audio'])
+    v_start_i_sec = item['targets']['v_start_i_sec']
+
+    # the crop starts for each offset as `TemporalCropAndOffset` gets them for the fixed offsets
+    a_crop_starts = []
+    for off in offsets:
+        crop_item = dict(item, targets={'v_start_i_sec': v_start_i_sec, 'offset_sec': off})
+        _, _, _, v_crop_start, a_crop_start = crop.get_crop_params(crop_item, v_len_frames, a_len_frames,
+                                                                   v_fps, a_fps)
+        a_crop_starts.append(a_crop_start)
+    # and the segments within the crop as `GenerateMultipleSegments` makes them
+    seg_vframes = segmenter.segment_size_vframes
+    seg_aframes = sec2frames(frames2sec(seg_vframes, v_fps), a_fps)
+    v_ranges, a_ranges = segmenter.get_sequential_seg_ranges(
+        sec2frames(crop.crop_len_sec, v_fps), sec2frames(crop.crop_len_sec, a_fps), v_fps, a_fps,
+        segmenter.n_segments, seg_aframes)
+    v_starts = v_crop_start + v_ranges[:, 0].long()
+    a_starts = torch.tensor(a_crop_starts)[:, None] + a_ranges[:, 0].long()
+    if v_starts[-1] + seg_vframes > v_len_frames:
+        raise ValueError(f'The crop at {v_start_i_sec} sec does not fit in the video ({v_len_frames} frames)')
+    if a_starts.min() < 0 or a_starts.max() + seg_aframes > a_len_frames:
+        raise ValueError(f'Some of the offsets {offsets} shift the audio out of the track')
+
+    a_starts, aud_ids = torch.unique(a_starts, return_inverse=True)
+    item['video'] = make_segments(item['video'], v_starts, seg_vframes)
+    item['audio'] = make_segments(item['audio'], a_starts, seg_aframes)
+    for t in post:
+        item = t(item)
+    return item, aud_ids
+
+def predict_offset_sweep(model, cfg, device, item, test_transforms, post_collate_transforms, offsets):
+    '''Runs the model on the crop at `v_start_i_sec` with each audio shift from `offsets` (sec) in one batch
+    (see `Synchformer.forward_shifts`): the visual features are extracted once, the audio features once per
+    distinct segment. Returns the offset logits (N, cls), the same as `predict` with each offset.'''
+    item, aud_ids = make_sweep_inputs(item, test_transforms, offsets)
+    # the segments go as a batch of one (the post-collate transforms expect the batch dim)
+    batch = dict(item, video=item['video'][None], audio=item['audio'][None])
+    aud, vid, _ = prepare_inputs(batch, device, get_targets=False, post_collate_transforms=post_collate_transforms)
+    with torch.set_grad_enabled(False):
+        with torch.autocast('cuda', enabled=cfg.training.use_half_precision):
+            logits = model.forward_shifts(vid, aud[0], aud_ids.to(device))
+    return logits
+
+def decode_offset_sweep(logits, grid, offsets):
+    '''Prints the prediction for each shift and what it says about the offset of the original video: with
+    the audio shifted by `off`, the model should predict the original offset plus `off`'''
+    probs = torch.softmax(logits.float(), dim=-1)
+    print('Offset sweep (shift: predicted offset (p) -> implied original offset):')
+    for off, p in zip(offsets, probs):
+        pred = p.argmax().item()
+        print(f'{off:+.2f}: {grid[pred]:+.2f} (p={p[pred]:.4f}) -> {grid[pred] - off:+.2f}')
+    return probs
+
+def report_parity(model, cfg, device, args, test_transforms, post_collate_transforms, vfps=25, afps=16000,
+                  in_size=256):
+    '''Runs the ffmpeg re-encoding, the in-process resampling of the whole video and of the decoded window
+    (the default) on the same video and prints how much the model inputs and the predictions differ from
+    the ffmpeg ones (and the time each path takes to make the item)'''
+    resample_transforms = make_resample_transforms(vfps, afps, in_size)
+    window_resample_transforms = make_resample_transforms(vfps, afps, None)
+    loaders = {
+        'ffmpeg': lambda: load_item(args.vid_path, args.v_start_i_sec, args.offset_sec, None, vfps, afps, in_size),
+        'in-process': lambda: load_item(args.vid_path, args.v_start_i_sec, args.offset_sec, resample_transforms,
+                                        vfps, afps, in_size),
+        'windowed': lambda: load_item_window(args.vid_path, args.v_start_i_sec, [args.offset_sec],
+                                             test_transforms, window_resample_transforms, in_size),
+    }
+    outputs = {}
+    for name, load in loaders.items():
+        start = time.perf_counter()
+        item = load()
+        load_sec = time.perf_counter() - start
+        _, aud, vid, logits = predict(model, cfg, device, item, test_transforms, post_collate_transforms)
+        outputs[name] = {'load_sec': load_sec, 'aud': aud.float(), 'vid': vid.float(),
+                         'probs': torch.softmax(logits.float(), dim=-1)}
+    ref = outputs['ffmpeg']
+    for name in ['in-process', 'windowed']:
+        new = outputs[name]
+        print()
+        print(f'Parity (ffmpeg vs {name}):')
+        print(f'load time (sec): {ref["load_sec"]:.3f} vs {new["load_sec"]:.3f}')
+        for k in ['vid', 'aud', 'probs']:
+            if ref[k].shape != new[k].shape:
+                print(f'{k}: shape mismatch {tuple(ref[k].shape)} vs {tuple(new[k].shape)}')
+                continue
+            diff = (ref[k] - new[k]).abs()
+            print(f'{k}: max abs diff {diff.max().item():.4f}; mean abs diff {diff.mean().item():.4f}')
+        same_top1 = (ref['probs'].argmax(-1) == new['probs'].argmax(-1)).all().item()
+        print(f'top-1 prediction is the same: {same_top1}')
 
 def decode_single_video_prediction(off_logits, grid, item):
     label = item['targets']['offset_label'].item()
@@ -88,15 +263,6 @@ def reconstruct_video_from_input(aud, vid, meta, orig_vid_path, v_start_i_sec, o
     # save the reconstructed input
     torchvision.io.write_video(save_vid_path, vid_rec, vfps, audio_array=aud_rec, audio_fps=afps, audio_codec='aac')
 
-def patch_config(cfg):
-    # the FE ckpts are already in the model ckpt
-    cfg.model.params.afeat_extractor.params.ckpt_path = None
-    cfg.model.params.vfeat_extractor.params.ckpt_path = None
-    # old checkpoints have different names
-    cfg.model.params.transformer.target = cfg.model.params.transformer.target\
-                                             .replace('.modules.feature_selector.', '.sync_model.')
-    return cfg
-
 def main(args):
     vfps = 25
     afps = 16000
@@ -114,18 +280,7 @@ def main(args):
     # patch config
     cfg = patch_config(cfg)
 
-    # checking if the provided video has the correct frame rates
     print(f'Using video: {args.vid_path}')
-    v, _, info = torchvision.io.read_video(args.vid_path, pts_unit='sec')
-    _, H, W, _ = v.shape
-    if info['video_fps'] != vfps or info['audio_fps'] != afps or min(H, W) != in_size:
-        print(f'Reencoding. vfps: {info["video_fps"]} -> {vfps};', end=' ')
-        print(f'afps: {info["audio_fps"]} -> {afps};', end=' ')
-        print(f'{(H, W)} -> min(H, W)={in_size}')
-        args.vid_path = reencode_video(args.vid_path, vfps, afps, in_size)
-    else:
-        print(f'Skipping reencoding. vfps: {info["video_fps"]}; afps: {info["audio_fps"]}; min(H, W)={in_size}')
-
     device = torch.device(args.device)
 
     # load the model
@@ -134,49 +289,52 @@ def main(args):
     model.load_state_dict(ckpt['model'])
     model.eval()
 
-    # load visual and audio streams
-    # rgb: (Tv, 3, H, W) in [0, 225], audio: (Ta,) in [-1, 1]
-    rgb, audio, meta = get_video_and_audio(args.vid_path, get_meta=True)
-
-    # making an item (dict) to apply transformations
-    # NOTE: here is how it works:
-    # For instance, if the model is trained on 5sec clips, the provided video is 9sec, and `v_start_i_sec=1.3`
-    # the transform will crop out a 5sec-clip from 1.3 to 6.3 seconds and shift the start of the audio
-    # track by `args.offset_sec` seconds. It means that if `offset_sec` > 0, the audio will
-    # start by `offset_sec` earlier than the rgb track.
-    # It is a good idea to use something in [-`max_off_sec`, `max_off_sec`] (-2, +2) seconds (see `grid`)
-    item = dict(
-        video=rgb, audio=audio, meta=meta, path=args.vid_path, split='test',
-        targets={'v_start_i_sec': args.v_start_i_sec, 'offset_sec': args.offset_sec, },
-    )
-
     # making the offset class grid similar to the one used in transforms
     max_off_sec = cfg.data.max_off_sec
     num_cls = cfg.model.params.transformer.params.off_head_cfg.params.out_features
     grid = make_class_grid(-max_off_sec, max_off_sec, num_cls)
-    if not (min(grid) <= item['targets']['offset_sec'] <= max(grid)):
-        print(f'WARNING: offset_sec={item["targets"]["offset_sec"]} is outside the trained grid: {grid}')
+    if not (min(grid) <= args.offset_sec <= max(grid)):
+        print(f'WARNING: offset_sec={args.offset_sec} is outside the trained grid: {grid}')
+    # the shifts of the original audio for --sweep, from the class grid by default
+    offsets = args.sweep_offsets or [round(off, 2) for off in grid.tolist()]
 
-    # applying the test-time transform
-    item = get_transforms(cfg, ['test'])['test'](item)
+    test_transforms = get_transforms(cfg, ['test'])['test']
+    post_collate_transforms = get_post_collate_transforms(cfg, device, ['test'])['test']
 
-    # prepare inputs for inference
-    batch = torch.utils.data.default_collate([item])
-    aud, vid, targets = prepare_inputs(batch, device)
-
-    # TODO:
-    # sanity check: we will take the input to the `model` and recontruct make a video from it.
-    # Use this check to make sure the input makes sense (audio should be ok but shifted as you specified)
-    # reconstruct_video_from_input(aud, vid, batch['meta'], args.vid_path, args.v_start_i_sec, args.offset_sec,
-    #                              vfps, afps)
+    # the video is decoded once (only the part and the region of the frames that the test transforms use)
+    # and resampled in-process unless the ffmpeg re-encoding is asked for
+    if args.reencode:
+        item = load_item(args.vid_path, args.v_start_i_sec, args.offset_sec, None, vfps, afps, in_size)
+    else:
+        item = load_item_window(args.vid_path, args.v_start_i_sec, [args.offset_sec] + (offsets if args.sweep else []),
+                                test_transforms, make_resample_transforms(vfps, afps, None), in_size)
 
-    # forward pass
-    with torch.set_grad_enabled(False):
-        with torch.autocast('cuda', enabled=cfg.training.use_half_precision):
-            _, logits = model(vid, aud)
+    # applying the test-time transform and running the model
+    # the decoded streams are shared with the sweep below (`predict` transforms a copy)
+    pred_item, aud, vid, logits = predict(model, cfg, device, copy_item(item), test_transforms,
+                                          post_collate_transforms)
 
     # simply prints the results of the prediction
-    decode_single_video_prediction(logits, grid, item)
+    decode_single_video_prediction(logits, grid, pred_item)
+
+    if args.sweep:
+        start = time.perf_counter()
+        sweep_logits = predict_offset_sweep(model, cfg, device, copy_item(item, offset_sec=0.0), test_transforms,
+                                            post_collate_transforms, offsets)
+        print()
+        print(f'{len(offsets)} shifts in {time.perf_counter() - start:.3f} sec')
+        decode_offset_sweep(sweep_logits, grid, offsets)
+        if args.parity:
+            # a separate full forward per shift
+            ref_logits = []
+            for off in offsets:
+                ref_logits.append(predict(model, cfg, device, copy_item(item, offset_sec=off), test_transforms,
+                                          post_collate_transforms)[-1])
+            diff = (torch.softmax(torch.cat(ref_logits).float(), -1) - torch.softmax(sweep_logits.float(), -1))
+            print(f'Sweep vs forward per shift: max abs diff of probs {diff.abs().max().item():.4f}')
+
+    if args.parity:
+        report_parity(model, cfg, device, args, test_transforms, post_collate_transforms, vfps, afps, in_size)
 
 
 if __name__ == '__main__':
@@ -186,5 +344,10 @@ if __name__ == '__main__':
     parser.add_argument('--offset_sec', type=float, default=0.0)
     parser.add_argument('--v_start_i_sec', type=float, default=0.0)
     parser.add_argument('--device', default='cuda:0')
+    parser.add_argument('--reencode', action='store_true', help='Re-encode with ffmpeg instead of resampling')
+    parser.add_argument('--parity', action='store_true', help='Compare the ffmpeg and in-process resampling')
+    parser.add_argument('--sweep', action='store_true', help='Also run the crop with many audio shifts at once')
+    parser.add_argument('--sweep_offsets', type=float, nargs='+', default=None,
+                        help='The audio shifts (sec) for --sweep (the offset class grid by default)')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,270 @@
+import argparse
+import csv
+import json
+import math
+import time
+from pathlib import Path
+
+import torch
+import torchvision
+from omegaconf import OmegaConf
+
+from dataset.dataset_utils import get_resampled_window, get_video_and_audio_window, probe_video_and_audio
+from dataset.feature_store import make_segments, split_segment_transforms
+from dataset.transforms import (EqualifyFromRight, ResampleAudio, ResampleRGB, frames2sec, get_resized_crop_roi,
+                                make_class_grid, sec2frames)
+from scripts.train_utils import get_model, get_post_collate_transforms, get_transforms, prepare_inputs
+from utils.utils import check_if_file_exists_else_download, patch_config, reencode_video
+
+
+class SegmentFeatureStream:
+    '''Decodes a (long) video in chunks and yields the features of its consecutive segments, i.e. the
+    segments `GenerateMultipleSegments` would make from the whole video: one every `step_size_seg` of the
+    segment length with the audio aligned to the video. Only `chunk_segs` segments worth of frames are
+    decoded at a time, so the memory does not depend on the duration. The segments are transformed as
+    at test time (see `transform_sequence_test`) except for the temporal crop.
+    If `resample_transforms` (`ResampleRGB` and `ResampleAudio`) are given, the source video is decoded as is
+    and each chunk is resampled in-process, and only the region of the frames that the test-time center crop
+    of the frames resized to min(H, W)=`in_size` takes is decoded (see `dataset_utils.get_resampled_window`).
+    Otherwise, the video should have the frame rates and the size the model expects (e.g. re-encoded).'''
+
+    def __init__(self, model, path, test_transforms, post_collate_transforms, device, chunk_segs=64,
+                 seg_batch=32, use_half_precision=True, resample_transforms=None, in_size=256):
+        self.model = model
+        self.path = path
+        self.post_collate_transforms = post_collate_transforms
+        self.device = device
+        self.chunk_segs = chunk_segs
+        self.seg_batch = seg_batch
+        self.use_half_precision = use_half_precision
+        pre, _, segmenter, self.post = split_segment_transforms(test_transforms)
+        # the streams are cut into chunks here instead of trimming them to `clip_max_len_sec`
+        self.pre = [t for t in pre if not isinstance(t, EqualifyFromRight)]
+
+        self.resample_transforms = resample_transforms
+        self.meta = probe_video_and_audio(path)
+        v_len_frames = self.meta['video']['num_frames'][0]
+        a_len_frames = self.meta['audio']['num_frames'][0]
+        if resample_transforms is None:
+            self.v_fps = int(self.meta['video']['fps'][0])
+            self.a_fps = int(self.meta['audio']['framerate'][0])
+            self.roi, self.size = None, None
+        else:
+            ts = resample_transforms.transforms
+            self.v_fps = next(t.new_fps for t in ts if isinstance(t, ResampleRGB))
+            self.a_fps = next(t.new_fps for t in ts if isinstance(t, ResampleAudio))
+            v_len_frames = int(v_len_frames / self.meta['video']['fps'][0] * self.v_fps)
+            a_len_frames = int(a_len_frames / self.meta['audio']['framerate'][0] * self.a_fps)
+            self.roi, self.size = get_resized_crop_roi(self.meta['video']['frame_size'][0], in_size, self.pre)
+        self.seg_vframes = segmenter.segment_size_vframes
+        self.seg_aframes = sec2frames(frames2sec(self.seg_vframes, self.v_fps), self.a_fps)
+        self.step_vframes = int(segmenter.step_size_seg * self.seg_vframes)
+        self.step_aframes = int(segmenter.step_size_seg * self.seg_aframes)
+        # segments that fit into both streams
+        self.num_segments = min(math.floor((v_len_frames - self.seg_vframes) / self.step_vframes),
+                                math.floor((a_len_frames - self.seg_aframes) / self.step_aframes)) + 1
+
+    def __len__(self):
+        return max(0, self.num_segments)
+
+    def segment_start_sec(self, seg_i):
+        return frames2sec(seg_i * self.step_vframes, self.v_fps)
+
+    def __iter__(self):
+        for first in range(0, len(self), self.chunk_segs):
+            n = min(self.chunk_segs, len(self) - first)
+            yield self.extract_chunk(first, n)
+
+    @torch.no_grad()
+    def extract_chunk(self, first, n):
+        '''Returns the features of the segments [first, first + n): (n, tv, D) and (n, ta, D)'''
+        v_range = (first * self.step_vframes, (first + n - 1) * self.step_vframes + self.seg_vframes)
+        a_range = (first * self.step_aframes, (first + n - 1) * self.step_aframes + self.seg_aframes)
+        if self.resample_transforms is None:
+            rgb, audio = get_video_and_audio_window(self.path, v_range, a_range, self.meta)
+        else:
+            rgb, audio = get_resampled_window(self.path, v_range, a_range, self.meta, self.resample_transforms,
+                                              self.roi, self.size)
+        item = dict(video=rgb, audio=audio, meta={'video': {'fps': [self.v_fps]}, 'audio': {'framerate': [self.a_fps]}},
+                    path=str(self.path), split='test', targets={})
+        for t in self.pre:
+            item = t(item)
+        item['video'] = make_segments(item['video'], torch.arange(n) * self.step_vframes, self.seg_vframes)
+        item['audio'] = make_segments(item['audio'], torch.arange(n) * self.step_aframes, self.seg_aframes)
+        for t in self.post:
+            item = t(item)
+
+        # the segments go as a batch of one (the post-collate transforms expect the batch dim)
+        batch = dict(item, video=item['video'][None], audio=item['audio'][None])
+        aud, vid, _ = prepare_inputs(batch, self.device, get_targets=False,
+                                     post_collate_transforms=self.post_collate_transforms)
+        with torch.autocast('cuda', enabled=self.use_half_precision):
+            vfeats = [self.model.extract_vfeats(vid[:, i:i+self.seg_batch], for_loop=False)[0]
+                      for i in range(0, n, self.seg_batch)]
+            afeats = [self.model.extract_afeats(aud[:, i:i+self.seg_batch], for_loop=False)[0]
+                      for i in range(0, n, self.seg_batch)]
+        return torch.cat(vfeats), torch.cat(afeats)
+
+
+@torch.no_grad()
+def track_offsets(model, stream, n_segments, hop_segs, batch_size=16, use_half_precision=True):
+    '''Tiles the video with windows of `n_segments` segments (the input length of the model) every
+    `hop_segs` segments and yields the offset probabilities (cls,) of each window with its first segment.
+    The overlapping windows share the features of their common segments (`stream` extracts each once),
+    and the windows go through the head (`vproj`, `aproj`, `transformer`) in batches of `batch_size`.'''
+    num_windows = (len(stream) - n_segments) // hop_segs + 1
+    vbuf, abuf, buf_first = None, None, 0  # features of the segments from `buf_first` on
+    window_i = 0
+    for vfeats, afeats in stream:
+        vbuf = vfeats if vbuf is None else torch.cat([vbuf, vfeats])
+        abuf = afeats if abuf is None else torch.cat([abuf, afeats])
+        # the windows whose segments are all extracted by now
+        ready = [w for w in range(window_i, num_windows) if w * hop_segs + n_segments <= buf_first + len(vbuf)]
+        for i in range(0, len(ready), batch_size):
+            firsts = [w * hop_segs - buf_first for w in ready[i:i+batch_size]]
+            vis = torch.stack([vbuf[f:f+n_segments] for f in firsts])
+            aud = torch.stack([abuf[f:f+n_segments] for f in firsts])
+            with torch.autocast('cuda', enabled=use_half_precision):
+                _, logits = model.forward_feats(vis, aud)
+            probs = torch.softmax(logits.float(), dim=-1).cpu()
+            for w, p in zip(ready[i:i+batch_size], probs):
+                yield w * hop_segs, p
+        window_i += len(ready)
+        # dropping the features that the next windows don't need
+        drop = min(window_i * hop_segs, buf_first + len(vbuf)) - buf_first
+        vbuf, abuf, buf_first = vbuf[drop:], abuf[drop:], buf_first + drop
+
+
+def smooth_probs(probs, kernel=5):
+    '''Moving average of the window probabilities (N, cls) over `kernel` neighbouring windows'''
+    if kernel <= 1 or len(probs) < 2:
+        return probs
+    pad = kernel // 2
+    padded = torch.cat([probs[:1].expand(pad, -1), probs, probs[-1:].expand(pad, -1)])
+    return padded.unfold(0, 2 * pad + 1, 1).mean(dim=-1)
+
+
+def summarize_timeline(starts_sec, probs, grid, window_sec, smooth=5):
+    '''The per-window records and the global estimate: the product of the window posteriors (the mean
+    of the log-probabilities), so a few windows with the wrong prediction don't move it much'''
+    smoothed = smooth_probs(probs, smooth)
+    windows = []
+    for start, p, sp in zip(starts_sec, probs, smoothed):
+        windows.append({
+            'start_sec': round(start, 3),
+            'end_sec': round(start + window_sec, 3),
+            'offset_sec': round(grid[p.argmax()].item(), 2),
+            'prob': round(p.max().item(), 4),
+            'smoothed_offset_sec': round(grid[sp.argmax()].item(), 2),
+            'smoothed_prob': round(sp.max().item(), 4),
+            'probs': [round(v, 4) for v in p.tolist()],
+        })
+    global_probs = torch.softmax(torch.log(probs + 1e-8).mean(dim=0), dim=-1)
+    summary = {
+        'offset_sec': round(grid[global_probs.argmax()].item(), 2),
+        'prob': round(global_probs.max().item(), 4),
+        'probs': [round(v, 4) for v in global_probs.tolist()],
+        'num_windows': len(windows),
+    }
+    return windows, summary
+
+
+def save_timeline(out_path, vid_path, grid, windows, summary):
+    '''Writes `{out_path}.json` (everything) and `{out_path}.csv` (a row per window)'''
+    out_path = Path(out_path)
+    out_path.parent.mkdir(exist_ok=True, parents=True)
+    grid = [round(v, 2) for v in grid.tolist()]
+    with open(out_path.with_suffix('.json'), 'w') as f:
+        json.dump({'vid_path': str(vid_path), 'grid': grid, 'global': summary, 'windows': windows}, f, indent=2)
+    with open(out_path.with_suffix('.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['start_sec', 'end_sec', 'offset_sec', 'prob', 'smoothed_offset_sec', 'smoothed_prob']
+                        + [f'p({off})' for off in grid])
+        for w in windows:
+            writer.writerow([w['start_sec'], w['end_sec'], w['offset_sec'], w['prob'], w['smoothed_offset_sec'],
+                             w['smoothed_prob']] + w['probs'])
+
+
+def maybe_reencode_long_video(path, vfps=25, afps=16000, in_size=256):
+    '''The same as `example.maybe_reencode_video` but reads only the stream headers'''
+    meta = probe_video_and_audio(path)
+    H, W = meta['video']['frame_size'][0]
+    if meta['video']['fps'][0] != vfps or meta['audio']['framerate'][0] != afps or min(H, W) != in_size:
+        print(f'Reencoding to {vfps} fps, {afps} Hz, min(H, W)={in_size}')
+        return reencode_video(path, vfps, afps, in_size)
+    return path
+
+
+def main(args):
+    vfps = 25
+    afps = 16000
+    in_size = 256
+    cfg_path = f'./logs/sync_models/{args.exp_name}/cfg-{args.exp_name}.yaml'
+    ckpt_path = f'./logs/sync_models/{args.exp_name}/{args.exp_name}.pt'
+
+    # if the model does not exist try to download it from the server
+    check_if_file_exists_else_download(cfg_path)
+    check_if_file_exists_else_download(ckpt_path)
+    cfg = patch_config(OmegaConf.load(cfg_path))
+    device = torch.device(args.device)
+
+    _, model = get_model(cfg, device)
+    ckpt = torch.load(ckpt_path, map_location=torch.device('cpu'), weights_only=False)
+    model.load_state_dict(ckpt['model'])
+    model.eval()
+
+    test_transforms = get_transforms(cfg, ['test'])['test']
+    post_collate_transforms = get_post_collate_transforms(cfg, device, ['test'])['test']
+    if args.reencode:
+        vid_path, resample_transforms = maybe_reencode_long_video(args.vid_path, vfps, afps, in_size), None
+    else:
+        # each chunk is resampled in-process (the resampling kernel of `ResampleAudio` is made once)
+        vid_path = args.vid_path
+        resample_transforms = torchvision.transforms.Compose([ResampleRGB(vfps), ResampleAudio(afps)])
+    stream = SegmentFeatureStream(model, vid_path, test_transforms, post_collate_transforms, device,
+                                  args.chunk_segs, args.seg_batch, cfg.training.use_half_precision,
+                                  resample_transforms, in_size)
+
+    n_segments = cfg.data.n_segments
+    # the hop is rounded to the segment step, otherwise the windows would not share the segments
+    hop_segs = max(1, round(args.hop_sec / stream.segment_start_sec(1)))
+    window_sec = frames2sec((n_segments - 1) * stream.step_vframes + stream.seg_vframes, stream.v_fps)
+    if len(stream) < n_segments:
+        raise ValueError(f'The video is shorter than one window ({window_sec} sec)')
+    print(f'{len(stream)} segments, windows of {window_sec} sec every {stream.segment_start_sec(hop_segs)} sec')
+
+    max_off_sec = cfg.data.max_off_sec
+    num_cls = cfg.model.params.transformer.params.off_head_cfg.params.out_features
+    grid = make_class_grid(-max_off_sec, max_off_sec, num_cls)
+
+    start = time.perf_counter()
+    starts_sec, probs = [], []
+    for first_seg, p in track_offsets(model, stream, n_segments, hop_segs, args.batch_size,
+                                      cfg.training.use_half_precision):
+        starts_sec.append(stream.segment_start_sec(first_seg))
+        probs.append(p)
+        print(f'{starts_sec[-1]:.2f} sec: {grid[p.argmax()]:+.2f} (p={p.max():.4f})')
+    elapsed = time.perf_counter() - start
+
+    windows, summary = summarize_timeline(starts_sec, torch.stack(probs), grid, window_sec, args.smooth)
+    out_path = args.out_path or Path.cwd() / 'vis' / f'{Path(args.vid_path).stem}_offsets'
+    save_timeline(out_path, args.vid_path, grid, windows, summary)
+    print(f'{len(windows)} windows in {elapsed:.1f} sec')
+    print(f'Global offset estimate: {summary["offset_sec"]:+.2f} (p={summary["prob"]:.4f})')
+    print(f'Timeline: {Path(out_path).with_suffix(".json")}, {Path(out_path).with_suffix(".csv")}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tracks the audio-visual offset along a long video')
+    parser.add_argument('--exp_name', required=True, help='In a format: xx-xx-xxTxx-xx-xx')
+    parser.add_argument('--vid_path', required=True, help='A path to .mp4 video')
+    parser.add_argument('--out_path', default=None, help='Where to save the timeline (.json and .csv)')
+    parser.add_argument('--hop_sec', type=float, default=2.0, help='The step between the windows')
+    parser.add_argument('--smooth', type=int, default=5, help='Windows in the moving average of the timeline')
+    parser.add_argument('--batch_size', type=int, default=16, help='Windows per forward pass of the head')
+    parser.add_argument('--chunk_segs', type=int, default=64, help='Segments decoded at a time')
+    parser.add_argument('--seg_batch', type=int, default=32, help='Segments per forward pass of the extractors')
+    parser.add_argument('--device', default='cuda:0')
+    parser.add_argument('--reencode', action='store_true', help='Re-encode with ffmpeg instead of resampling')
+    args = parser.parse_args()
+    main(args)
@@ -22,6 +22,7 @@ class AST(torch.nn.Module):
                  add_global_repr: bool = True,
                  agg_segments_module: str = None,
                  max_segments: int = None,
+                 attn_implementation: str = 'sdpa',
                  ) -> None:
         '''
             extract_features: if True, then the model will return the features instead of head's output
@@ -35,6 +36,8 @@ class AST(torch.nn.Module):
             agg_segments_module: if specified, then the model will use this module for segments aggregation
             max_segments: if specified, the initialization of PE in the global agg module will use this value.
                           This should correspond to the max number of segments per video (if None, 16 is used)
+            attn_implementation: 'sdpa' (fused attention, falls back to 'eager' if `head_mask` or
+                                 `output_attentions` are used) or 'eager' (explicit matmul-softmax-matmul)
         '''
         super().__init__()
         self.extract_features = extract_features
@@ -49,11 +52,13 @@ class AST(torch.nn.Module):
         if ckpt_path == 'MIT/ast-finetuned-audioset-10-10-0.4593':
             revision = 'c1c0c66'  # fixing the revision for compatibility (V4.27.4)
             self.config = ASTConfig.from_pretrained(ckpt_path, revision=revision)
-            full_model = ASTForAudioClassification.from_pretrained(ckpt_path, revision=revision)
+            self.config._attn_implementation = attn_implementation
+            full_model = ASTForAudioClassification.from_pretrained(ckpt_path, revision=revision, config=self.config)
             logging.info(f'Loaded AST from {ckpt_path}')
         else:
             self.config = ASTConfig()
             self.config.num_labels = 527  # 2 by default, audioset has 527 labels
+            self.config._attn_implementation = attn_implementation
             full_model = ASTForAudioClassification(self.config)
             logging.info('Initialized AST from scratch with the AST AudioSet config')
 
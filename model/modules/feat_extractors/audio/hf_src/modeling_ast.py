@@ -184,6 +184,46 @@ class ASTSelfAttention(nn.Module):
         return outputs
 
 
+class ASTSdpaSelfAttention(ASTSelfAttention):
+    """
+    The same as `ASTSelfAttention` but the attention is `torch.nn.functional.scaled_dot_product_attention` (as in
+    the later upstream versions). Falls back to the eager path if the attention probabilities are requested or
+    `head_mask` is used.
+    """
+
+    def forward(
+        self, hidden_states, tok_mask: Optional[torch.Tensor] = None,
+        head_mask: Optional[torch.Tensor] = None, output_attentions: bool = False
+    ) -> Union[Tuple[torch.Tensor, torch.Tensor], Tuple[torch.Tensor]]:
+        if output_attentions or head_mask is not None:
+            return super().forward(hidden_states, tok_mask, head_mask, output_attentions)
+
+        key_layer = self.transpose_for_scores(self.key(hidden_states))
+        value_layer = self.transpose_for_scores(self.value(hidden_states))
+        query_layer = self.transpose_for_scores(self.query(hidden_states))
+
+        # tok_mask is (BS, N): 1s - keep; broadcasts to (BS, H, N, N)
+        attn_mask = None if tok_mask is None else (tok_mask != 0)[:, None, None, :]
+
+        context_layer = nn.functional.scaled_dot_product_attention(
+            query_layer, key_layer, value_layer, attn_mask=attn_mask,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )
+
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        context_layer = context_layer.view(new_context_layer_shape)
+
+        return (context_layer,)
+
+
+# `config._attn_implementation` selects the class; 'eager' if it is not set (e.g. older `transformers`)
+AST_SELF_ATTENTION_CLASSES = {
+    "eager": ASTSelfAttention,
+    "sdpa": ASTSdpaSelfAttention,
+}
+
+
 # Copied from transformers.models.vit.modeling_vit.ViTSelfOutput with ViT->AST
 class ASTSelfOutput(nn.Module):
     """
@@ -207,7 +247,8 @@ class ASTSelfOutput(nn.Module):
 class ASTAttention(nn.Module):
     def __init__(self, config: ASTConfig) -> None:
         super().__init__()
-        self.attention = ASTSelfAttention(config)
+        attn_implementation = getattr(config, "_attn_implementation", None) or "eager"
+        self.attention = AST_SELF_ATTENTION_CLASSES[attn_implementation](config)
         self.output = ASTSelfOutput(config)
         self.pruned_heads = set()
 
@@ -392,6 +433,7 @@ class ASTPreTrainedModel(PreTrainedModel):
     base_model_prefix = "audio_spectrogram_transformer"
     main_input_name = "input_values"
     supports_gradient_checkpointing = True
+    _supports_sdpa = True
 
     # Copied from transformers.models.deit.modeling_deit.DeiTPreTrainedModel._init_weights
     def _init_weights(self, module: Union[nn.Linear, nn.Conv2d, nn.LayerNorm]) -> None:
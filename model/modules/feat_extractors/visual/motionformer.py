@@ -44,7 +44,8 @@ class MotionFormer(VisionTransformer):
                  agg_time_module: str = None,
                  add_global_repr: bool = True,
                  agg_segments_module: str = None,
-                 max_segments: int = None,):
+                 max_segments: int = None,
+                 attn_backend: str = 'reference',):
         self.extract_features = extract_features
         self.ckpt_path = ckpt_path
         self.factorize_space_time = factorize_space_time
@@ -99,6 +100,9 @@ class MotionFormer(VisionTransformer):
         mformer_cfg.VIT.USE_ORIGINAL_TRAJ_ATTN_CODE = True
         mformer_cfg.VIT.APPROX_ATTN_TYPE = 'none'  # guessing
         mformer_cfg.VIT.APPROX_ATTN_DIM = 64  # from ckpt['cfg']
+        # 'reference' (the original einsum attention) or 'sdpa' (fused kernels, the outputs differ by float
+        # rounding), see `vit_helper.sdpa_attn`
+        mformer_cfg.VIT.ATTN_BACKEND = attn_backend
 
         # finally init VisionTransformer with the cfg
         super().__init__(mformer_cfg)
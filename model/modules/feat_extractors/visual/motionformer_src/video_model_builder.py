@@ -97,6 +97,7 @@ class VisionTransformer(nn.Module):
                     attn_drop=self.attn_drop_rate,
                     drop_path=dpr[i],
                     norm_layer=norm_layer,
+                    attn_backend=cfg.VIT.get('ATTN_BACKEND', 'reference'),
                 )
                 for i in range(self.depth)
             ])
@@ -112,7 +113,8 @@ class VisionTransformer(nn.Module):
                     attn_drop=self.attn_drop_rate,
                     drop_path=dpr[i],
                     norm_layer=norm_layer,
-                    use_original_code=self.cfg.VIT.USE_ORIGINAL_TRAJ_ATTN_CODE
+                    use_original_code=self.cfg.VIT.USE_ORIGINAL_TRAJ_ATTN_CODE,
+                    attn_backend=cfg.VIT.get('ATTN_BACKEND', 'reference'),
                 )
                 for i in range(self.depth)
             ])
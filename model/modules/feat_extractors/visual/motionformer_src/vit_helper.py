@@ -42,6 +42,19 @@ def qkv_attn(q, k, v, tok_mask: torch.Tensor = None):
     return out
 
 
+def sdpa_attn(q, k, v, tok_mask: torch.Tensor = None, dropout_p: float = 0.0):
+    '''The same as `qkv_attn` but with the fused kernel (the attention matrix is not materialized) and
+    q is not pre-scaled. q, k, v are (B, H, N, d); tok_mask broadcasts to (B, H, N) (1s - keep)'''
+    attn_mask = None if tok_mask is None else (tok_mask != 0).unsqueeze(-2)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+
+
+def with_heads(einops_pattern: str, heads: str = 'h d'):
+    ''''b (f n) d' -> 'b (f n) h d': splits the channels of a divided attention pattern into heads'''
+    assert einops_pattern.endswith(' d'), einops_pattern
+    return einops_pattern[:-1] + heads
+
+
 class JointSpaceTimeAttention(nn.Module):
     def __init__(
         self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0.
@@ -79,9 +92,12 @@ class JointSpaceTimeAttention(nn.Module):
 
 class DividedAttention(nn.Module):
     def __init__(
-        self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0.
+        self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0., attn_backend='reference'
     ):
         super().__init__()
+        # 'sdpa' or 'reference' (einsum -> softmax -> einsum, e.g. for numerical comparison)
+        assert attn_backend in ['sdpa', 'reference'], f'Unknown attn_backend: {attn_backend}'
+        self.attn_backend = attn_backend
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim ** -0.5
@@ -98,6 +114,8 @@ class DividedAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
 
     def forward(self, x, einops_from, einops_to, tok_mask: torch.Tensor = None, **einops_dims):
+        if self.attn_backend == 'sdpa':
+            return self.forward_sdpa(x, einops_from, einops_to, tok_mask, **einops_dims)
         # num of heads variable
         h = self.num_heads
 
@@ -157,10 +175,57 @@ class DividedAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def forward_sdpa(self, x, einops_from, einops_to, tok_mask: torch.Tensor = None, **einops_dims):
+        '''The same as `forward` but q, k, v are kept in (batch, heads, tokens, d) views of the projection
+        instead of being rearranged into `(b h) n d` copies, and the attention is the fused kernel'''
+        B, N, C = x.shape
+        h = self.num_heads
+        # (B, N, 3, h, d)
+        qkv = self.qkv(x).view(B, N, 3, h, C // h)
+        q, k, v = map(lambda t: t.transpose(1, 2), qkv.unbind(dim=2))
+
+        # let CLS token attend to key / values of all patches across time and space: (B, h, 1, d)
+        cls_mask = None if tok_mask is None else tok_mask[:, None]
+        cls_out = sdpa_attn(q[:, :, 0:1], k, v, tok_mask=cls_mask)
+
+        # rearrange across time or space (a single copy for q, k, v): (B*r, s, 3, h, d)
+        qkv_ = rearrange(qkv[:, 1:], f'{with_heads(einops_from, "t h d")} -> {with_heads(einops_to, "t h d")}',
+                         **einops_dims)
+        # expand CLS token keys and values across time or space and concat
+        r = qkv_.shape[0] // B
+        cls_kv = repeat(qkv[:, 0:1, 1:], 'b () t h d -> (b r) () t h d', r=r)
+        kv_ = torch.cat((cls_kv, qkv_[:, :, 1:]), dim=1)
+        q_, k_, v_ = map(lambda t: t.transpose(1, 2), (qkv_[:, :, 0], kv_[:, :, 0], kv_[:, :, 1]))
+
+        # the same for masking (if provided)
+        mask_ = None
+        if tok_mask is not None:
+            # since mask does not have the latent dim (d), we need to remove it from einops dims
+            mask_ = rearrange(tok_mask[:, 1:], f'{einops_from} -> {einops_to}'.replace(' d', ''), **einops_dims)
+            mask_ = torch.cat((repeat(tok_mask[:, 0:1], 'b () -> (b r) ()', r=r), mask_), dim=1)[:, None]
+
+        # attention: (B*r, h, s, d)
+        out = sdpa_attn(q_, k_, v_, tok_mask=mask_)
+
+        # merge back time or space, concat back the cls token, and merge back the heads
+        out = rearrange(out.transpose(1, 2), f'{with_heads(einops_to)} -> {with_heads(einops_from)}',
+                        **einops_dims)
+        out = torch.cat((cls_out.transpose(1, 2), out), dim=1).view(B, N, C)
+
+        ## to out
+        x = self.proj(out)
+        x = self.proj_drop(x)
+        return x
+
 
 class TrajectoryAttention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0., use_original_code=True):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0., use_original_code=True,
+                 attn_backend='reference'):
         super().__init__()
+        # 'sdpa' or 'reference' (einsum -> softmax -> einsum, e.g. for numerical comparison). Used for the
+        # CLS and the full (approx='none') spatial attention
+        assert attn_backend in ['sdpa', 'reference'], f'Unknown attn_backend: {attn_backend}'
+        self.attn_backend = attn_backend
         self.num_heads = num_heads
         self.head_dim = dim // num_heads
         self.scale = self.head_dim ** -0.5
@@ -184,6 +249,9 @@ class TrajectoryAttention(nn.Module):
         F = num_frames
         h = self.num_heads
 
+        if self.attn_backend == 'sdpa' and approx == 'none':
+            return self.forward_sdpa(x, seq_len, num_frames)
+
         # project x to q, k, v vaalues
         q, k, v = self.qkv(x).chunk(3, dim=-1)
 
@@ -253,6 +321,35 @@ class TrajectoryAttention(nn.Module):
 
         # Temporal attention: query is the similarity-aggregated patch
         x = rearrange(x, '(b h) s f d -> b s f (h d)', b=B)
+        return self.temporal_attn(x, cls_out, num_frames)
+
+    def forward_sdpa(self, x, seq_len=196, num_frames=8):
+        '''The same as `forward` (approx='none') but q, k, v are views of the projection and the CLS and
+        the spatial attention are the fused kernel: the (s, f*n) attention matrix is not materialized'''
+        B, N, C = x.shape
+        h = self.num_heads
+        # (B, h, N, d)
+        q, k, v = map(lambda t: t.transpose(1, 2), self.qkv(x).view(B, N, 3, h, C // h).unbind(dim=2))
+
+        # let CLS token attend to key / values of all patches across time and space
+        cls_out = sdpa_attn(q[:, :, 0:1], k, v).transpose(1, 2).reshape(B, 1, C)
+
+        # every patch attends to the patches of each frame separately (the frames are folded into heads):
+        # (B, h*f, s, d) queries, (B, h*f, n, d) keys and values
+        q_ = q[:, :, 1:].unsqueeze(2).expand(-1, -1, num_frames, -1, -1).flatten(1, 2)
+        k_, v_ = map(lambda t: rearrange(t[:, :, 1:], 'b h (f n) d -> b (h f) n d', f=num_frames, n=seq_len),
+                     (k, v))
+        dropout_p = self.attn_drop.p if self.training else 0.0
+        x = sdpa_attn(q_, k_, v_, dropout_p=dropout_p)
+
+        # Temporal attention: query is the similarity-aggregated patch
+        x = rearrange(x, 'b (h f) s d -> b s f (h d)', h=h, f=num_frames)
+        return self.temporal_attn(x, cls_out, num_frames)
+
+    def temporal_attn(self, x, cls_out, num_frames):
+        B = x.shape[0]
+        F = num_frames
+        h = self.num_heads
         x_diag = rearrange(x, 'b (g n) f d -> b g n f d', g=F)
         x_diag = torch.diagonal(x_diag, dim1=-4, dim2=-2)
         x_diag = rearrange(x_diag, f'b n d f -> b (f n) d', f=F)
@@ -280,7 +377,7 @@ class TrajectoryAttention(nn.Module):
 
 def get_attention_module(
     attn_type='joint', dim=768, num_heads=12, qkv_bias=False,
-    attn_drop=0., proj_drop=0., use_original_code=True
+    attn_drop=0., proj_drop=0., use_original_code=True, attn_backend='reference'
 ):
     if attn_type == 'joint':
         attn = JointSpaceTimeAttention(
@@ -290,7 +387,7 @@ def get_attention_module(
         attn = TrajectoryAttention(
             dim, num_heads=num_heads, qkv_bias=qkv_bias,
             attn_drop=attn_drop, proj_drop=proj_drop,
-            use_original_code=use_original_code)
+            use_original_code=use_original_code, attn_backend=attn_backend)
     return attn
 
 
@@ -300,14 +397,14 @@ class Block(nn.Module):
             self, dim=768, num_heads=12, attn_type='trajectory',
             mlp_ratio=4., qkv_bias=False, drop=0., attn_drop=0.,
             drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm,
-            use_original_code=True
+            use_original_code=True, attn_backend='reference'
         ):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.attn = get_attention_module(
             attn_type=attn_type, dim=dim, num_heads=num_heads,
             qkv_bias=qkv_bias, attn_drop=attn_drop, proj_drop=drop,
-            use_original_code=use_original_code
+            use_original_code=use_original_code, attn_backend=attn_backend
         )
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -334,7 +431,7 @@ class DividedSpaceTimeBlock(nn.Module):
     def __init__(
         self, dim=768, num_heads=12, attn_type='divided',
         mlp_ratio=4., qkv_bias=False, drop=0., attn_drop=0.,
-        drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm
+        drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, attn_backend='reference'
     ):
         super().__init__()
 
@@ -347,11 +444,11 @@ class DividedSpaceTimeBlock(nn.Module):
 
         self.attn = DividedAttention(
             dim, num_heads=num_heads, qkv_bias=qkv_bias,
-            attn_drop=attn_drop, proj_drop=drop)
+            attn_drop=attn_drop, proj_drop=drop, attn_backend=attn_backend)
 
         self.timeattn = DividedAttention(
             dim, num_heads=num_heads, qkv_bias=qkv_bias,
-            attn_drop=attn_drop, proj_drop=drop)
+            attn_drop=attn_drop, proj_drop=drop, attn_backend=attn_backend)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -33,15 +33,24 @@ class SelfAttention(nn.Module):
     A vanilla multi-head masked self-attention layer with a projection at the end.
     It is possible to use torch.nn.MultiheadAttention here but I am including an
     explicit implementation here to show that there is nothing too scary here.
+    `config.attn_backend`: 'sdpa' (fused kernel, does not materialize the (T, T) attention) or 'reference'
+    (the explicit implementation, e.g. for numerical comparison). `config.fused_qkv`: one Linear for q, k, v;
+    checkpoints with separate `query`, `key`, `value` are converted when loaded (and vice versa).
     """
 
     def __init__(self, config):
         super().__init__()
         assert config.n_embd % config.n_head == 0
+        self.attn_backend = getattr(config, 'attn_backend', 'sdpa')
+        assert self.attn_backend in ['sdpa', 'reference'], f'Unknown attn_backend: {self.attn_backend}'
+        self.fused_qkv = getattr(config, 'fused_qkv', False)
         # key, query, value projections for all heads
-        self.key = nn.Linear(config.n_embd, config.n_embd)
-        self.query = nn.Linear(config.n_embd, config.n_embd)
-        self.value = nn.Linear(config.n_embd, config.n_embd)
+        if self.fused_qkv:
+            self.qkv = nn.Linear(config.n_embd, 3 * config.n_embd)
+        else:
+            self.key = nn.Linear(config.n_embd, config.n_embd)
+            self.query = nn.Linear(config.n_embd, config.n_embd)
+            self.value = nn.Linear(config.n_embd, config.n_embd)
         # regularization
         self.attn_drop = nn.Dropout(config.attn_pdrop)
         self.resid_drop = nn.Dropout(config.resid_pdrop)
@@ -59,15 +68,23 @@ class SelfAttention(nn.Module):
         B, T, C = x.size()
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        k = self.key(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
-        q = self.query(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
-        v = self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
-
-        # self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        # att = att.masked_fill(self.mask[:, :, :T, :T] == 0, float('-inf'))
-        att = F.softmax(att, dim=-1)
-        y = self.attn_drop(att) @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        if self.fused_qkv:
+            # (3, B, nh, T, hs)
+            q, k, v = self.qkv(x).view(B, T, 3, self.n_head, C // self.n_head).permute(2, 0, 3, 1, 4)
+        else:
+            k = self.key(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
+            q = self.query(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
+            v = self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
+
+        if self.attn_backend == 'sdpa':
+            dropout_p = self.attn_drop.p if self.training else 0.0
+            y = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)  # (B, nh, T, hs)
+        else:
+            # self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+            # att = att.masked_fill(self.mask[:, :, :T, :T] == 0, float('-inf'))
+            att = F.softmax(att, dim=-1)
+            y = self.attn_drop(att) @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
         y = y.transpose(1, 2).contiguous().view(B, T, C)  # re-assemble all head outputs side by side
 
         # output projection
@@ -75,6 +92,17 @@ class SelfAttention(nn.Module):
 
         return y
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the state dict adapter: separate q, k, v projections <-> the fused one
+        names = ['query', 'key', 'value']
+        for p in ['weight', 'bias']:
+            if self.fused_qkv and f'{prefix}query.{p}' in state_dict:
+                state_dict[f'{prefix}qkv.{p}'] = torch.cat([state_dict.pop(f'{prefix}{n}.{p}') for n in names])
+            elif not self.fused_qkv and f'{prefix}qkv.{p}' in state_dict:
+                for n, w in zip(names, state_dict.pop(f'{prefix}qkv.{p}').chunk(3)):
+                    state_dict[f'{prefix}{n}.{p}'] = w
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class Block(nn.Module):
     """ an unassuming Transformer block """
@@ -243,13 +271,13 @@ class Transformer(nn.Module):
     def __init__(self, vis_pos_emb_module, aud_pos_emb_module, num_offset_cls,
                  visual_block_shape, audio_block_shape, pre_norm_cfg,
                  n_layer=12, n_head=8, n_embd=256, tok_pdrop=0., embd_pdrop=0., resid_pdrop=0., attn_pdrop=0.,
-                 n_unmasked=0):
+                 n_unmasked=0, attn_backend='sdpa', fused_qkv=False):
         super().__init__()
         config = Config(num_offset_cls=num_offset_cls,
                         audio_block_shape=audio_block_shape, visual_block_shape=visual_block_shape,
                         embd_pdrop=embd_pdrop, resid_pdrop=resid_pdrop, attn_pdrop=attn_pdrop,
                         tok_pdrop=tok_pdrop, n_layer=n_layer, n_head=n_head, n_embd=n_embd,
-                        n_unmasked=n_unmasked)
+                        n_unmasked=n_unmasked, attn_backend=attn_backend, fused_qkv=fused_qkv)
         self.config = config
         # input embedding stem
         self.OFF_tok = nn.Parameter(torch.randn(1, 1, n_embd))
@@ -342,6 +370,13 @@ if __name__ == '__main__':
     print('x', x.shape)
     print('x.shape', pos_enc(x).shape)
 
+    # the sdpa attention (and the fused qkv) vs the reference implementation with the same weights
+    ref_attn = SelfAttention(Config(n_embd=512, n_head=8, attn_pdrop=0., resid_pdrop=0., attn_backend='reference'))
+    attn = SelfAttention(Config(n_embd=512, n_head=8, attn_pdrop=0., resid_pdrop=0., fused_qkv=True))
+    attn.load_state_dict(ref_attn.state_dict())
+    x = torch.rand(3, 2000, 512)
+    print('sdpa vs reference max abs diff:', (attn(x) - ref_attn(x)).abs().max().item())
+
     ############################################################################
     # from omegaconf import OmegaConf
     # from time import time
@@ -36,7 +36,8 @@ class Synchformer(torch.nn.Module):
         self.transformer = instantiate_from_config(transformer)
 
     def forward(self, vis: torch.Tensor, aud: torch.Tensor, targets: torch.Tensor = None, for_loop=False,
-                vis_mask: torch.Tensor = None, aud_mask: torch.Tensor = None, loss_fn=None):
+                vis_mask: torch.Tensor = None, aud_mask: torch.Tensor = None, loss_fn=None,
+                precomputed_feats: bool = False):
         '''
         Args:
             vis (torch.Tensor): RGB frames (B, S, Tv, C, H, W)
@@ -46,12 +47,19 @@ class Synchformer(torch.nn.Module):
                              (speed-memory tradeoff).
             vis_mask (torch.Tensor): mask for the visual tokens (as input)
             aud_mask (torch.Tensor): mask for the audio tokens (as input)
+            precomputed_feats (bool): `vis` and `aud` are the segment features (B, S, tv, D) and (B, S, ta, D)
+                                      precomputed with the frozen extractors (see `dataset.feature_store`)
         Returns:
             tuple(Tensor, Tensor), Tensor: loss values, logits
         '''
-        vis = self.extract_vfeats(vis, for_loop, vis_mask=vis_mask)
-        aud = self.extract_afeats(aud, for_loop, aud_mask=aud_mask)
-
+        if not precomputed_feats:
+            vis = self.extract_vfeats(vis, for_loop, vis_mask=vis_mask)
+            aud = self.extract_afeats(aud, for_loop, aud_mask=aud_mask)
+        return self.forward_feats(vis, aud, targets, loss_fn)
+
+    def forward_feats(self, vis: torch.Tensor, aud: torch.Tensor, targets: torch.Tensor = None, loss_fn=None):
+        '''The forward pass of the head (`vproj`, `aproj`, `transformer`) on the segment features
+        (B, S, tv, D) and (B, S, ta, D) of the feature extractors. Returns the loss values and the logits.'''
         vis = self.vproj(vis)
         aud = self.aproj(aud)
 
@@ -69,6 +77,25 @@ class Synchformer(torch.nn.Module):
 
         return loss, logits
 
+    def forward_shifts(self, vis: torch.Tensor, aud: torch.Tensor, aud_ids: torch.Tensor = None, for_loop=False):
+        '''The logits for one video crop with N audio tracks (e.g. N candidate shifts) in one batch: the visual
+        features are extracted once and shared by all N.
+        Args:
+            vis (torch.Tensor): RGB frames (1, S, Tv, C, H, W)
+            aud (torch.Tensor): audio spectrograms (N, S, 1, F, Ta), or the U distinct segments (U, 1, F, Ta)
+                                if `aud_ids` is given (the shifts that start a segment on the same frame share it)
+            aud_ids (torch.Tensor): (N, S) indices into the segments of `aud`
+        Returns:
+            Tensor: logits (N, cls)
+        '''
+        vis = self.extract_vfeats(vis, for_loop)
+        if aud_ids is not None:
+            aud = self.extract_afeats(aud.unsqueeze(0), for_loop)[0][aud_ids]  # (N, S, ta, D)
+        else:
+            aud = self.extract_afeats(aud, for_loop)
+        _, logits = self.forward_feats(vis.expand(len(aud), -1, -1, -1), aud)
+        return logits
+
     def extract_vfeats(self, vis, for_loop, vis_mask=None):
         B, S, Tv, C, H, W = vis.shape
         vis = vis.permute(0, 1, 3, 2, 4, 5)  # (B, S, C, Tv, H, W)
@@ -118,10 +145,12 @@ class GlobalTransformer(torch.nn.Module):
     '''Same as in SparseSync but without the selector transformers and the head'''
 
     def __init__(self, tok_pdrop, embd_pdrop, resid_pdrop, attn_pdrop, n_layer, n_head, n_embd,
-                 pos_emb_cfg=None, off_head_cfg=None) -> None:
+                 pos_emb_cfg=None, off_head_cfg=None, attn_backend='sdpa', fused_qkv=False) -> None:
         super().__init__()
+        # attn_backend: 'sdpa' or 'reference'; fused_qkv: one Linear for q, k, v (see `SelfAttention`)
         self.config = Config(embd_pdrop=embd_pdrop, resid_pdrop=resid_pdrop, attn_pdrop=attn_pdrop,
-                             n_layer=n_layer, n_head=n_head, n_embd=n_embd)
+                             n_layer=n_layer, n_head=n_head, n_embd=n_embd, attn_backend=attn_backend,
+                             fused_qkv=fused_qkv)
         # input norm
         self.vis_in_lnorm = torch.nn.LayerNorm(self.config.n_embd)
         self.aud_in_lnorm = torch.nn.LayerNorm(self.config.n_embd)
@@ -176,9 +205,9 @@ class GlobalTransformer(torch.nn.Module):
 class GlobalTransformerWithSyncabilityHead(GlobalTransformer):
 
     def __init__(self, tok_pdrop, embd_pdrop, resid_pdrop, attn_pdrop, n_layer, n_head, n_embd,
-                 pos_emb_cfg=None, off_head_cfg=None) -> None:
+                 pos_emb_cfg=None, off_head_cfg=None, attn_backend='sdpa', fused_qkv=False) -> None:
         super().__init__(tok_pdrop, embd_pdrop, resid_pdrop, attn_pdrop, n_layer, n_head, n_embd, pos_emb_cfg,
-                         off_head_cfg)
+                         off_head_cfg, attn_backend, fused_qkv)
         # remove the off_head from the parent class
         self.off_head = torch.nn.Identity()  # this class is used only during ftuning so this is not needed
         self.sync_head = torch.nn.Linear(self.config.n_embd, 2)
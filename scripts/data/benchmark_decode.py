@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import resource
+import argparse
+import multiprocessing as mp
+
+sys.path.insert(0, '.')  # nopep8
+from dataset.dataset_utils import VIS_LOAD_BACKENDS, get_media_loader
+
+
+def run_backend(backend, paths, end_sec, queue):
+    """在独立进程中用一个后端解码所有视频，这样峰值内存(RSS)只属于这个后端"""
+    load = get_media_loader(backend)
+    errors = 0
+    # 预热：第一次调用会加载编解码器等
+    try:
+        load(paths[0], get_meta=True, end_sec=end_sec)
+    except Exception as e:
+        queue.put({'backend': backend, 'error': str(e)})
+        return
+    start = time.perf_counter()
+    for path in paths:
+        try:
+            rgb, audio, meta = load(path, get_meta=True, end_sec=end_sec)
+            # 内存映射的后端只返回视图，这里强制读取数据，与真正的解码公平比较
+            rgb.sum(), audio.sum()
+        except Exception:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    # Linux 上 ru_maxrss 的单位是 KB
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put({'backend': backend, 'clips_per_sec': len(paths) / elapsed, 'peak_rss_mb': peak_rss_mb,
+               'errors': errors, 'error': None})
+
+
+def benchmark(folder, backends, num_clips, end_sec):
+    """依次对每个后端测量每秒解码的视频数和峰值内存"""
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            if f.lower().endswith('.mp4'):
+                paths.append(os.path.join(root, f))
+    paths = sorted(paths)[:num_clips]
+    assert paths, f'在 {folder} 中未找到任何mp4文件'
+    print(f"使用 {len(paths)} 个视频测试后端: {backends}\n")
+
+    # spawn: 每个后端从干净的进程开始，避免互相影响峰值内存
+    ctx = mp.get_context('spawn')
+    results = []
+    for backend in backends:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_backend, args=(backend, paths, end_sec, queue))
+        proc.start()
+        results.append(queue.get())
+        proc.join()
+
+    print("=" * 60)
+    print(f"{'后端':<14}{'视频/秒':>12}{'峰值RSS(MB)':>16}{'失败数':>10}")
+    print("=" * 60)
+    for r in results:
+        if r['error']:
+            print(f"{r['backend']:<14} 不可用: {r['error']}")
+        else:
+            print(f"{r['backend']:<14}{r['clips_per_sec']:>12.2f}{r['peak_rss_mb']:>16.1f}{r['errors']:>10d}")
+    print("=" * 60)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='比较不同 vis_load_backend 的解码速度和内存')
+    parser.add_argument('folder', type=str, help='包含MP4文件的文件夹路径')
+    parser.add_argument('--backends', nargs='+', default=list(VIS_LOAD_BACKENDS), help='要测试的后端')
+    parser.add_argument('--num_clips', type=int, default=200, help='测试的视频数量')
+    parser.add_argument('--end_sec', type=float, default=None, help='只读取前 end_sec 秒（与数据集的 max_clip_len_sec 相同）')
+    args = parser.parse_args()
+
+    benchmark(args.folder, args.backends, args.num_clips, args.end_sec)
@@ -0,0 +1,82 @@
+import sys
+import math
+import time
+import argparse
+
+import torch
+import torchaudio
+
+sys.path.insert(0, '.')  # nopep8
+from dataset.transforms import AudioRandomPitchShift
+
+
+def pitch_shift_sox(clips, sr, shift):
+    """原来的实现：每个片段单独调用 sox 的 pitch 效果"""
+    effects = [['pitch', f'{shift}'], ['rate', f'{sr}']]
+    out = torch.empty_like(clips)
+    for i, wave in enumerate(clips):
+        wave, _ = torchaudio.sox_effects.apply_effects_tensor(wave[None], sr, effects)
+        out[i] = wave[0, :clips.shape[-1]]
+    return out
+
+
+def pitch_shift_functional(clips, sr, shift):
+    """torchaudio.functional.pitch_shift：每次调用都重新生成 sr -> sr / ratio 的重采样核"""
+    return torchaudio.functional.pitch_shift(clips, sr, shift, bins_per_octave=1200)
+
+
+def estimate_freqs(clips, sr, pad=16):
+    """用加窗并补零的FFT的峰值估计每个片段的主频率"""
+    spec = torch.fft.rfft(clips * torch.hann_window(clips.shape[-1]), n=clips.shape[-1] * pad).abs()
+    return spec.argmax(dim=-1) * sr / (clips.shape[-1] * pad)
+
+
+def benchmark(sr, shift, n_segments, segment_sec, repeats, seed=0):
+    """比较三种实现的速度（每秒处理的片段数）和音高误差（音分）。输入是频率随机的正弦波片段"""
+    torch.manual_seed(seed)
+    freqs = torch.empty(n_segments).uniform_(200, 800)
+    t = torch.arange(int(segment_sec * sr)) / sr
+    clips = torch.sin(2 * math.pi * freqs[:, None] * t)
+    expected = freqs * 2 ** (shift / 1200)
+
+    cached = AudioRandomPitchShift(p=1.0, shift=shift)
+    methods = {
+        'sox': lambda x: pitch_shift_sox(x, sr, shift),
+        'functional': lambda x: pitch_shift_functional(x, sr, shift),
+        'cached': cached.pitch_shift,
+    }
+    print(f"{n_segments} 个 {segment_sec} 秒的片段, {sr} Hz, 音高偏移 {shift} 音分, 缓存的比例: {cached.ratio}\n")
+    print("=" * 60)
+    print(f"{'实现':<14}{'片段/秒':>12}{'平均误差(音分)':>18}{'最大误差':>12}")
+    print("=" * 60)
+    results = {}
+    for name, fn in methods.items():
+        try:
+            # 预热：第一次调用会生成缓存的重采样核
+            out = fn(clips)
+        except Exception as e:
+            print(f"{name:<14} 不可用: {e}")
+            continue
+        start = time.perf_counter()
+        for _ in range(repeats):
+            out = fn(clips)
+        elapsed = time.perf_counter() - start
+        cents = 1200 * torch.log2(estimate_freqs(out, sr) / expected)
+        results[name] = {'segments_per_sec': n_segments * repeats / elapsed,
+                         'mean_cents': cents.abs().mean().item(), 'max_cents': cents.abs().max().item()}
+        r = results[name]
+        print(f"{name:<14}{r['segments_per_sec']:>12.1f}{r['mean_cents']:>18.2f}{r['max_cents']:>12.2f}")
+    print("=" * 60)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='比较音高偏移增强 (AudioRandomPitchShift) 与 sox 基线的速度和精度')
+    parser.add_argument('--sr', type=int, default=16000, help='采样率')
+    parser.add_argument('--shift', type=int, default=1000, help='音高偏移（音分），与 configs 中的设置相同')
+    parser.add_argument('--n_segments', type=int, default=14, help='片段数（一个样本的片段数）')
+    parser.add_argument('--segment_sec', type=float, default=0.64, help='片段长度（秒）')
+    parser.add_argument('--repeats', type=int, default=10, help='重复次数')
+    args = parser.parse_args()
+
+    benchmark(args.sr, args.shift, args.n_segments, args.segment_sec, args.repeats)
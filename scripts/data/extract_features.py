@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import argparse
+from pathlib import Path
+from tqdm import tqdm
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+sys.path.insert(0, '.')  # nopep8
+from dataset.dataset_utils import get_transforms_fingerprint
+from dataset.feature_store import (get_first_segment_range, get_store_grid, make_segments,
+                                   split_segment_transforms)
+from dataset.transforms import frames2sec, sec2frames
+from scripts.train_utils import get_datasets, get_post_collate_transforms, get_transforms
+from utils.utils import instantiate_from_config
+
+
+@torch.no_grad()
+def extract_clip(model, item, pre, post, post_collate, grid, device, seg_batch=32):
+    """提取一个视频在网格上所有片段的特征: 视频 (Kv, tv, D), 音频 (Ka, ta, D), float16
+
+    片段的变换与测试时相同 (中心裁剪, 无数据增强)，只是不做时间裁剪，所有起点的片段都被保留
+    """
+    for t in pre:
+        item = t(item)
+    v_fps = int(item['meta']['video']['fps'][0])
+    a_fps = int(item['meta']['audio']['framerate'][0])
+    assert v_fps == grid['vfps'], f'{item["path"]}: {v_fps} fps, 需要 {grid["vfps"]} fps'
+    seg_vframes = grid['segment_size_vframes']
+    seg_aframes = sec2frames(frames2sec(seg_vframes, v_fps), a_fps)
+    a_step = sec2frames(frames2sec(grid['a_step_vframes'], v_fps), a_fps)
+    # 所有起点在网格上的片段
+    item['video'] = make_segments(item['video'], torch.arange(0, len(item['video']) - seg_vframes + 1,
+                                                              grid['v_step_vframes']), seg_vframes)
+    item['audio'] = make_segments(item['audio'], torch.arange(0, len(item['audio']) - seg_aframes + 1, a_step),
+                                  seg_aframes)
+    for t in post:
+        item = t(item)
+
+    vis, aud = item['video'].to(device), item['audio'].to(device)
+    if device.type != 'cuda':
+        # 视频是 fp16 (RGBToHalfToZeroOne)，CPU 上没有 autocast
+        vis = vis.float()
+    if post_collate is not None:
+        # 这些变换作用于整个batch，这里batch里只有一个视频
+        batch = post_collate(dict(item, video=vis[None], audio=aud[None]))
+        vis, aud = batch['video'][0], batch['audio'][0]
+
+    # 每次只送 seg_batch 个片段进特征提取器，避免长视频显存不够
+    with torch.autocast(device.type, enabled=device.type == 'cuda'):
+        vfeats = [model.extract_vfeats(vis[None, i:i+seg_batch], for_loop=False)[0]
+                  for i in range(0, len(vis), seg_batch)]
+        afeats = [model.extract_afeats(aud[None, i:i+seg_batch], for_loop=False)[0]
+                  for i in range(0, len(aud), seg_batch)]
+    return torch.cat(vfeats).half().cpu().numpy(), torch.cat(afeats).half().cpu().numpy()
+
+
+def fits_offsets(grid, n_segments, n_vsegs, n_asegs, offsets_sec):
+    """在每个偏移下，视频和音频是否都能放下 n_segments 个片段"""
+    for offset_sec in offsets_sec:
+        first_min, first_max = get_first_segment_range(grid, n_segments, n_vsegs, n_asegs,
+                                                       round(offset_sec * grid['vfps']))
+        if first_min > first_max:
+            return False
+    return True
+
+
+def write_shard(out_dir, name, vfeats, afeats):
+    """把一个分片的特征写成可内存映射的 .npy (clips, K_max, t, D)，较短的视频在末尾补零"""
+    for key, feats in [('vfeats', vfeats), ('afeats', afeats)]:
+        path = out_dir / f'{name}.{key}.npy'
+        tmp_path = out_dir / f'{name}.{key}.tmp.npy'
+        shape = (len(feats), max(len(f) for f in feats), *feats[0].shape[1:])
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=shape)
+        for i, f in enumerate(feats):
+            array[i, :len(f)] = f
+        array.flush()
+        del array
+        os.replace(tmp_path, path)
+
+
+def extract_split(cfg_path, split, out_dir, ckpt_path=None, shard_size=256, seg_batch=32,
+                  num_slices=1, slice_id=0):
+    """对一个数据集划分(split)的所有视频提取片段特征，写入特征库 (dataset.feature_store.FeatureStoreDataset)
+
+    每个分片包含: {split}-XXXXXX.vfeats.npy, .afeats.npy (float16) 和 .json (视频路径、标签、固定偏移、片段数)
+    分片的 .json 最后写入，存在即说明该分片已完成（支持断点续跑，也可以用多个切片并行运行）
+    所有分片完成后写入索引 {split}.json
+    太短的视频（在某个偏移下放不下 n_segments 个片段）不写入特征库，记为失败
+    """
+    cfg = OmegaConf.load(cfg_path)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # 训练集也用测试时的变换（中心裁剪，无随机性），特征对所有epoch都一样
+    transforms = get_transforms(cfg, ['test'])['test']
+    pre, crop, segmenter, post = split_segment_transforms(transforms)
+    grid = get_store_grid(crop, segmenter, cfg.data.vfps)
+    post_collate = get_post_collate_transforms(cfg, device, ['test'])['test']
+    dataset = get_datasets(cfg, {'train': transforms, 'test': transforms}, [split])[split]
+    is_fixed_offset = split in cfg.data.dataset.params.load_fixed_offsets_on
+    assert hasattr(dataset, 'dataset'), '需要原始视频的数据集 (不支持 tar 分片)'
+    print(f"片段网格: {grid}")
+
+    model = instantiate_from_config(cfg.model)
+    if ckpt_path is not None:
+        ckpt = torch.load(ckpt_path, map_location='cpu')
+        model.load_state_dict(ckpt['model'])
+    model = model.to(device).eval()
+
+    paths = list(dataset.dataset)
+    num_shards = (len(paths) + shard_size - 1) // shard_size
+    print(f"{split}: {len(paths)} 个视频, {num_shards} 个分片 -> {out_dir}")
+
+    failed = []
+    for shard_i in range(slice_id, num_shards, num_slices):
+        name = f'{split}-{shard_i:06d}'
+        if (out_dir / f'{name}.json').exists():
+            continue
+        clips, vfeats, afeats = [], [], []
+        for path in tqdm(paths[shard_i*shard_size:(shard_i+1)*shard_size], desc=f"分片 {shard_i}/{num_shards}"):
+            try:
+                rgb, audio, meta = dataset.load_media(path)
+                item = dataset.make_datapoint(path, rgb, audio, meta)
+                targets = item['targets']
+                v, a = extract_clip(model, item, pre, post, post_collate, grid, device, seg_batch)
+            except Exception as e:
+                failed.append((path, str(e)))
+                continue
+            # 与 TemporalCropAndOffset 相同：训练时所有偏移都要放得下，否则训练时会采样到放不下的偏移
+            offsets = [round(targets['offset_sec'], 2)] if is_fixed_offset else crop.class_grid.tolist()
+            if not fits_offsets(grid, segmenter.n_segments, len(v), len(a), offsets):
+                failed.append((path, '太短，放不下所有偏移'))
+                continue
+            clips.append({'path': str(path), 'targets': targets, 'n_vsegs': len(v), 'n_asegs': len(a)})
+            vfeats.append(v)
+            afeats.append(a)
+        if clips:
+            write_shard(out_dir, name, vfeats, afeats)
+        with open(out_dir / f'{name}.tmp.json', 'w') as f:
+            json.dump({'vfeats': f'{name}.vfeats.npy', 'afeats': f'{name}.afeats.npy', 'clips': clips}, f)
+        os.replace(out_dir / f'{name}.tmp.json', out_dir / f'{name}.json')
+
+    print(f"失败: {len(failed)}")
+    for path, error in failed:
+        print(f"  - {path}: {error}")
+
+    shard_paths = [out_dir / f'{split}-{i:06d}.json' for i in range(num_shards)]
+    if not all(p.exists() for p in shard_paths):
+        print("还有未完成的分片（其他切片），索引将由最后完成的切片写入")
+        return failed
+
+    index = {'shards': [], 'clips': []}
+    for shard_path in shard_paths:
+        with open(shard_path) as f:
+            shard = json.load(f)
+        if not shard['clips']:
+            continue
+        for row, clip in enumerate(shard['clips']):
+            index['clips'].append(dict(clip, shard=len(index['shards']), row=row))
+        index['shards'].append({'vfeats': shard['vfeats'], 'afeats': shard['afeats']})
+    index.update({
+        'grid': grid,
+        'transforms_fingerprint': get_transforms_fingerprint(pre + post),
+        'vids_dir': str(dataset.vids_dir),
+        'config': str(cfg_path),
+        'ckpt_path': None if ckpt_path is None else str(ckpt_path),
+    })
+    with open(out_dir / f'{split}.json', 'w') as f:
+        json.dump(index, f)
+    print(f"完成: {len(index['clips'])} 个视频, {len(index['shards'])} 个分片, 索引: {out_dir / f'{split}.json'}")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='用冻结的特征提取器预先提取片段特征（只训练transformer头）')
+    parser.add_argument('--config', type=str, required=True, help='训练配置 (例如 ./configs/sync.yaml，需设置 data.vids_path)')
+    parser.add_argument('--ckpt', type=str, default=None, help='Synchformer 检查点（不设置则使用配置里的特征提取器权重）')
+    parser.add_argument('--split', type=str, nargs='+', default=['train', 'valid', 'test'], help='数据集划分')
+    parser.add_argument('--out_dir', type=str, required=True, help='输出文件夹（训练时作为 data.vids_path）')
+    parser.add_argument('--shard_size', type=int, default=256, help='每个分片的视频数')
+    parser.add_argument('--seg_batch', type=int, default=32, help='特征提取时每次处理的片段数')
+    parser.add_argument('--num_slices', type=int, default=1, help='切片总数（分片在切片间均分）')
+    parser.add_argument('--slice_id', type=int, default=0, help='当前处理的切片id（从0开始）')
+    args = parser.parse_args()
+
+    for split in args.split:
+        extract_split(args.config, split, args.out_dir, args.ckpt, args.shard_size, args.seg_batch,
+                      args.num_slices, args.slice_id)
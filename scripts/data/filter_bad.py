@@ -9,12 +9,13 @@ def load_results(input_path):
         return json.load(f)
 
 
-def filter_and_save(results, output_dir='./data/filtered_examples_vggsound_shorter'):
-    """筛选并保存bad文件"""
+def filter_and_save(results, output_dir='./data/filtered_examples_vggsound_shorter', threshold=9.5):
+    """筛选并保存bad文件
+
+    results: read_duration.py 的结果（解码或 --probe 模式的索引都可以）
+    """
     os.makedirs(output_dir, exist_ok=True)
     
-    threshold = 9.5
-    
     # 筛选视频时长小于9.5秒的
     video_short = []
     for r in results:
@@ -37,18 +38,25 @@ def filter_and_save(results, output_dir='./data/filtered_examples_vggsound_short
             error_files.append(filename)
     
     # 保存视频时长过短的文件
-    video_short_path = os.path.join(output_dir, 'video_less_than_9.5s.txt')
+    video_short_path = os.path.join(output_dir, f'video_less_than_{threshold}s.txt')
     with open(video_short_path, 'w', encoding='utf-8') as f:
         for filename in sorted(video_short):
             f.write(f"{filename}\n")
     print(f"视频时长 < {threshold}s: {len(video_short)} 个，已保存到 {video_short_path}")
     
     # 保存音频时长过短的文件
-    audio_short_path = os.path.join(output_dir, 'audio_less_than_9.5s.txt')
+    audio_short_path = os.path.join(output_dir, f'audio_less_than_{threshold}s.txt')
     with open(audio_short_path, 'w', encoding='utf-8') as f:
         for filename in sorted(audio_short):
             f.write(f"{filename}\n")
     print(f"音频时长 < {threshold}s: {len(audio_short)} 个，已保存到 {audio_short_path}")
+
+    # 视频或音频过短（LongerVGGSound 读取的列表）
+    short_path = os.path.join(output_dir, f'less_than_{threshold}s.txt')
+    with open(short_path, 'w', encoding='utf-8') as f:
+        for filename in sorted(set(video_short) | set(audio_short)):
+            f.write(f"{filename}\n")
+    print(f"视频或音频时长 < {threshold}s: {len(set(video_short) | set(audio_short))} 个，已保存到 {short_path}")
     
     # 保存读取失败的文件
     error_path = os.path.join(output_dir, 'read_error.txt')
@@ -72,13 +80,14 @@ def main():
     parser.add_argument('--output-dir', '-o', type=str, 
                         default='./data/filtered_examples_vggsound_shorter',
                         help='输出目录')
+    parser.add_argument('--threshold', '-t', type=float, default=9.5, help='时长阈值（秒）')
     args = parser.parse_args()
     
     print(f"加载结果: {args.input}")
     results = load_results(args.input)
     print(f"共 {len(results)} 条记录")
     
-    filter_and_save(results, args.output_dir)
+    filter_and_save(results, args.output_dir, args.threshold)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import argparse
+from pathlib import Path
+from multiprocessing import Pool, cpu_count
+from tqdm import tqdm
+import numpy as np
+
+sys.path.insert(0, '.')  # nopep8
+from dataset.dataset_utils import get_video_and_audio, get_mmap_store_paths
+
+
+def save_array(path, array):
+    """先写临时文件再重命名，避免中断后留下不完整的文件"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def convert_video(vid_path):
+    """将单个(已重编码的)视频解码并保存为可内存映射的数组: 帧 (Tv, 3, H, W) uint8, 音频 (Ta,) float32"""
+    rgb_path, audio_path, meta_path = get_mmap_store_paths(vid_path)
+    try:
+        # meta.json 最后写入，存在即说明该视频已转换完成（支持断点续跑）
+        if not os.path.exists(meta_path):
+            # 与训练时 `get_video_and_audio` 的输出完全一致
+            rgb, audio, meta = get_video_and_audio(vid_path, get_meta=True)
+            save_array(rgb_path, rgb.numpy())
+            save_array(audio_path, audio.numpy().astype(np.float32))
+            with open(f'{meta_path}.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(f'{meta_path}.tmp', meta_path)
+        rgb = np.load(rgb_path, mmap_mode='r')
+        audio = np.load(audio_path, mmap_mode='r')
+        return {'path': vid_path, 'video_shape': list(rgb.shape), 'audio_shape': list(audio.shape), 'error': None}
+    except Exception as e:
+        return {'path': vid_path, 'video_shape': None, 'audio_shape': None, 'error': str(e)}
+
+
+def convert_folder(folder, num_workers=None):
+    """多进程转换文件夹(含子文件夹)下所有mp4文件，数组保存在mp4旁边（见 `get_mmap_store_paths`）"""
+    mp4_files = []
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            if f.lower().endswith('.mp4'):
+                mp4_files.append(os.path.join(root, f))
+    mp4_files.sort()
+
+    if num_workers is None:
+        num_workers = max(1, cpu_count() - 1)
+    print(f"找到 {len(mp4_files)} 个MP4文件，使用 {num_workers} 个进程转换...\n")
+
+    results = []
+    with Pool(num_workers) as pool:
+        for result in tqdm(pool.imap(convert_video, mp4_files), total=len(mp4_files), desc="转换视频"):
+            results.append(result)
+
+    failed = [r for r in results if r['error']]
+    print(f"\n成功: {len(results) - len(failed)}/{len(results)}")
+    print(f"失败: {len(failed)}/{len(results)}")
+    for r in failed:
+        print(f"  - {r['path']}: {r['error']}")
+
+    # 索引: 相对路径 -> 数组形状，便于检查存储是否完整
+    index = {os.path.relpath(r['path'], folder): {'video_shape': r['video_shape'], 'audio_shape': r['audio_shape']}
+             for r in results if not r['error']}
+    index_path = os.path.join(folder, 'mmap_index.json')
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    print(f"\n索引已保存到: {index_path}")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='将重编码后的视频预解码为内存映射数组 (vis_load_backend: mmap)')
+    parser.add_argument('folder', type=str, help='包含MP4文件的文件夹路径（重编码后的 25fps/16kHz 视频）')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='进程数')
+    args = parser.parse_args()
+
+    convert_folder(args.folder, args.workers)
@@ -0,0 +1,80 @@
+import sys
+import json
+import random
+import argparse
+from glob import glob
+from pathlib import Path
+from tqdm import tqdm
+import webdataset as wds
+from omegaconf import OmegaConf
+
+sys.path.insert(0, '.')  # nopep8
+from dataset.sharded import count_shard_samples
+from scripts.train_utils import get_datasets, get_transforms
+
+
+def make_shards(cfg_path, split, out_dir, max_size_gb=1.0, max_count=2000, seed=1337):
+    """将一个数据集划分(split)的视频打包成tar分片 (dataset.sharded.ShardedSyncDataset)
+
+    每个样本包含: mp4 (原始字节), wav (如果存在), json (路径、标签和固定偏移参数)
+    数据集、过滤和固定偏移与训练配置(cfg_path)完全一致
+    """
+    cfg = OmegaConf.load(cfg_path)
+    # 与训练时相同的变换，固定偏移文件的名称取决于变换的参数
+    dataset = get_datasets(cfg, get_transforms(cfg), [split])[split]
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    # 分片是顺序读取的，所以训练集需要在写入前打乱，否则同一类别的视频会在同一个分片中
+    order = list(range(len(dataset.dataset)))
+    if split == 'train':
+        random.Random(seed).shuffle(order)
+    print(f"{split}: {len(order)} 个视频 -> {out_dir}")
+
+    num_samples = 0
+    pattern = str(out_dir / f'{split}-%06d.tar')
+    with wds.ShardWriter(pattern, maxsize=int(max_size_gb * 1024**3), maxcount=max_count) as sink:
+        for i in tqdm(order, desc="写入分片"):
+            path = dataset.dataset[i]
+            # 只需要标签和固定偏移，不解码视频
+            item = dataset.make_datapoint(path, None, None, None)
+            sample = {
+                # 路径中可能有 '/' 和 '.'，不能用作 key
+                '__key__': f'{i:09d}',
+                'mp4': Path(path).read_bytes(),
+                'json': json.dumps({'path': str(path), 'targets': item['targets']}).encode('utf-8'),
+            }
+            wav_path = Path(path).with_suffix('.wav')
+            if wav_path.exists():
+                sample['wav'] = wav_path.read_bytes()
+            sink.write(sample)
+            num_samples += 1
+
+    shards = sorted(glob(str(out_dir / f'{split}-*.tar')))
+    index = {
+        'shards': [Path(p).name for p in shards],
+        # to give each reader its own range of samples (valid and test, see `ShardedSyncDataset`)
+        'shard_sizes': [count_shard_samples(p) for p in shards],
+        'num_samples': num_samples,
+        'vids_dir': str(dataset.vids_dir),
+        'max_clip_len_sec': dataset.max_clip_len_sec,
+        'min_video_frames': getattr(dataset, 'min_video_frames', 0),
+        'min_audio_samples': getattr(dataset, 'min_audio_samples', 0),
+        'has_fixed_offsets': split in dataset.load_fixed_offsets_on,
+    }
+    with open(out_dir / f'{split}.json', 'w') as f:
+        json.dump(index, f, indent=2)
+    print(f"完成: {num_samples} 个样本, {len(index['shards'])} 个分片, 索引: {out_dir / f'{split}.json'}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='将同步训练的数据集打包成tar分片')
+    parser.add_argument('--config', type=str, required=True, help='训练配置 (例如 ./configs/sync.yaml，需设置 data.vids_path)')
+    parser.add_argument('--split', type=str, nargs='+', default=['train', 'valid', 'test'], help='数据集划分')
+    parser.add_argument('--out_dir', type=str, required=True, help='输出文件夹（训练时作为 data.vids_path）')
+    parser.add_argument('--max_size_gb', type=float, default=1.0, help='每个分片的最大大小(GB)')
+    parser.add_argument('--max_count', type=int, default=2000, help='每个分片的最大样本数')
+    args = parser.parse_args()
+
+    for split in args.split:
+        make_shards(args.config, split, args.out_dir, args.max_size_gb, args.max_count)
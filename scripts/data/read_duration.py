@@ -4,6 +4,7 @@ import json
 from multiprocessing import Pool, cpu_count
 from functools import partial
 from tqdm import tqdm
+import av
 import torchvision.io
 
 
@@ -56,8 +57,93 @@ def get_video_info(vid_path):
         }
 
 
-def process_videos(folder, num_workers=None):
-    """多进程处理所有视频"""
+def probe_video_info(vid_path):
+    """只读取容器头和数据包时间戳（不解码），输出格式与 get_video_info 相同"""
+    try:
+        with av.open(vid_path) as container:
+            vstreams = container.streams.video
+            astreams = container.streams.audio
+            streams = list(vstreams[:1]) + list(astreams[:1])
+            # 每个流最后一个数据包的结束时间 = 时长；视频数据包数 = 帧数
+            end_sec = {s.index: 0.0 for s in streams}
+            start_sec = {s.index: None for s in streams}
+            video_packets = 0
+            for packet in container.demux(streams):
+                if packet.pts is None:
+                    continue
+                stream = packet.stream
+                pts_sec = float(packet.pts * stream.time_base)
+                dur_sec = float((packet.duration or 0) * stream.time_base)
+                end_sec[stream.index] = max(end_sec[stream.index], pts_sec + dur_sec)
+                if start_sec[stream.index] is None or pts_sec < start_sec[stream.index]:
+                    start_sec[stream.index] = pts_sec
+                if stream.type == 'video':
+                    video_packets += 1
+
+            def duration(stream):
+                return end_sec[stream.index] - (start_sec[stream.index] or 0.0)
+
+            if vstreams:
+                vstream = vstreams[0]
+                video_fps = float(vstream.average_rate) if vstream.average_rate else None
+                video_duration = duration(vstream)
+                video_resolution = f"{vstream.codec_context.width}x{vstream.codec_context.height}"
+            else:
+                video_fps, video_duration, video_resolution = None, None, None
+            if astreams:
+                astream = astreams[0]
+                audio_sample_rate = astream.rate
+                audio_duration = duration(astream)
+                audio_samples = round(audio_duration * audio_sample_rate)
+            else:
+                audio_sample_rate, audio_duration, audio_samples = None, None, 0
+
+        return {
+            'path': vid_path,
+            'filename': os.path.basename(vid_path),
+            'video_duration': video_duration,
+            'video_fps': video_fps,
+            'video_frames': video_packets if vstreams else None,
+            'video_resolution': video_resolution,
+            'audio_duration': audio_duration,
+            'audio_sample_rate': audio_sample_rate,
+            'audio_samples': audio_samples,
+            'error': None
+        }
+    except Exception as e:
+        return {
+            'path': vid_path,
+            'filename': os.path.basename(vid_path),
+            'video_duration': None,
+            'video_fps': None,
+            'video_frames': None,
+            'video_resolution': None,
+            'audio_duration': None,
+            'audio_sample_rate': None,
+            'audio_samples': None,
+            'error': str(e)
+        }
+
+
+def get_file_key(vid_path):
+    """索引的键: 文件修改时间和大小，变化后需要重新读取"""
+    stat = os.stat(vid_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def with_file_key(info_fn, vid_path):
+    info = info_fn(vid_path)
+    info['file_key'] = get_file_key(vid_path)
+    return info
+
+
+def process_videos(folder, num_workers=None, probe=False, previous=None, output_path=None, save_every=10000):
+    """多进程处理所有视频
+
+    probe: 只读取容器头和数据包时间戳，不解码（快很多）
+    previous: 之前的结果，路径和修改时间都没变的视频不再处理（增量更新）
+    output_path: 每处理 save_every 个视频保存一次，中断后可以继续
+    """
     if num_workers is None:
         num_workers = max(1, cpu_count() - 1)
     
@@ -69,21 +155,33 @@ def process_videos(folder, num_workers=None):
                 mp4_files.append(os.path.join(root, f))
     
     mp4_files.sort()
-    print(f"找到 {len(mp4_files)} 个MP4文件，使用 {num_workers} 个进程处理...\n")
-    
-    results = []
+
+    # 增量: 复用没有变化的视频的结果
+    path2result = {}
+    if previous:
+        for r in previous:
+            if 'file_key' in r and os.path.exists(r['path']) and r['file_key'] == get_file_key(r['path']):
+                path2result[r['path']] = r
+    todo = [p for p in mp4_files if p not in path2result]
+    print(f"找到 {len(mp4_files)} 个MP4文件，其中 {len(todo)} 个需要处理，使用 {num_workers} 个进程...\n")
+
+    worker_func = partial(with_file_key, probe_video_info if probe else get_video_info)
     with Pool(num_workers) as pool:
-        for result in tqdm(pool.imap(get_video_info, mp4_files), total=len(mp4_files), desc="处理视频"):
-            results.append(result)
+        for i, result in enumerate(tqdm(pool.imap(worker_func, todo, chunksize=16), total=len(todo), desc="处理视频")):
+            path2result[result['path']] = result
+            if output_path is not None and (i + 1) % save_every == 0:
+                save_results(list(path2result.values()), output_path, verbose=False)
     
-    return results
+    return [path2result[p] for p in mp4_files]
 
 
-def save_results(results, output_path):
-    """保存结果到JSON文件"""
-    with open(output_path, 'w', encoding='utf-8') as f:
+def save_results(results, output_path, verbose=True):
+    """保存结果到JSON文件（先写临时文件再重命名）"""
+    with open(f'{output_path}.tmp', 'w', encoding='utf-8') as f:
         json.dump(results, f, ensure_ascii=False, indent=2)
-    print(f"\n结果已保存到: {output_path}")
+    os.replace(f'{output_path}.tmp', output_path)
+    if verbose:
+        print(f"\n结果已保存到: {output_path}")
 
 
 def load_results(input_path):
@@ -247,6 +345,7 @@ def main():
     parser.add_argument('--output', '-o', type=str, default='video_info.json', help='输出JSON文件路径')
     parser.add_argument('--load', '-l', type=str, help='从已有JSON文件加载结果')
     parser.add_argument('--workers', '-w', type=int, default=None, help='进程数')
+    parser.add_argument('--probe', action='store_true', help='只读取容器头和数据包时间戳，不解码（快很多）')
     args = parser.parse_args()
     
     if args.load:
@@ -255,8 +354,9 @@ def main():
         results = load_results(args.load)
         print(f"加载了 {len(results)} 条记录")
     elif args.folder:
-        # 处理视频文件夹
-        results = process_videos(args.folder, args.workers)
+        # 处理视频文件夹（如果输出文件已存在，只处理新的或修改过的视频）
+        previous = load_results(args.output) if os.path.exists(args.output) else None
+        results = process_videos(args.folder, args.workers, args.probe, previous, args.output)
         save_results(results, args.output)
     else:
         parser.print_help()
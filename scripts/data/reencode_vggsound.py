@@ -1,53 +1,59 @@
+import os
+import sys
+import json
+import time
 import subprocess
+from glob import glob
 from pathlib import Path
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
 from shutil import which as which_ffmpeg
 import functools
 
+sys.path.insert(0, '.')  # nopep8
+from utils.utils import get_reencode_cmd
 
-def reencode_video(path, output_dir, vfps=25, afps=16000, in_size=256):
-    """对单个视频进行重编码"""
+
+def reencode_video(path, output_dir, vfps=25, afps=16000, in_size=256, timeout=600):
+    """对单个视频进行重编码: 一次 ffmpeg 调用同时输出 mp4 和 wav
+
+    先写入临时文件，成功后再重命名，所以输出目录里不会有不完整的文件
+    """
+    start = time.time()
+    new_path = Path(output_dir) / f'{Path(path).stem}.mp4'
+    tmp_path = new_path.with_suffix('.tmp.mp4')
+    tmp_wav_path = new_path.with_suffix('.tmp.wav')
     try:
-        assert which_ffmpeg('ffmpeg') != '', 'Is ffmpeg installed? Check if the conda environment is activated.'
         ffmpeg_path = which_ffmpeg('ffmpeg')
-        
-        new_path = Path(output_dir) / f'{Path(path).stem}.mp4'
-        new_path.parent.mkdir(exist_ok=True, parents=True)
-        if new_path.exists():
-            return (True, Path(path).name, None)
-        new_path = str(new_path)
-        
-        
-        cmd = f'{ffmpeg_path}'
-        cmd += ' -hide_banner -loglevel panic'
-        cmd += f' -y -i {path}'
-        cmd += f" -vf fps={vfps},scale=iw*{in_size}/'min(iw,ih)':ih*{in_size}/'min(iw,ih)',crop='trunc(iw/2)'*2:'trunc(ih/2)'*2"
-        cmd += f" -ar {afps}"
-        cmd += f' {new_path}'
-        subprocess.call(cmd.split())
-        
-        cmd = f'{ffmpeg_path}'
-        cmd += ' -hide_banner -loglevel panic'
-        cmd += f' -y -i {new_path}'
-        cmd += f' -acodec pcm_s16le -ac 1'
-        cmd += f' {new_path.replace(".mp4", ".wav")}'
-        subprocess.call(cmd.split())
-        
-        return (True, Path(path).name, None)
+        assert ffmpeg_path, 'Is ffmpeg installed? Check if the conda environment is activated.'
+        cmd = get_reencode_cmd(path, tmp_path, tmp_wav_path, vfps, afps, in_size, ffmpeg_path)
+        # 参数以列表传入（不经过shell），路径中有空格也没问题
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        if result.returncode != 0:
+            error = result.stderr.decode('utf-8', errors='replace').strip().splitlines()
+            raise RuntimeError(error[-1] if error else f'ffmpeg exit code {result.returncode}')
+        os.replace(tmp_wav_path, new_path.with_suffix('.wav'))
+        os.replace(tmp_path, new_path)
+        return (True, Path(path).name, None, time.time() - start)
+    except subprocess.TimeoutExpired:
+        return (False, Path(path).name, f'超时 ({timeout}s)', time.time() - start)
     except Exception as e:
-        return (False, Path(path).name, str(e))
+        return (False, Path(path).name, str(e), time.time() - start)
+    finally:
+        for p in [tmp_path, tmp_wav_path]:
+            if p.exists():
+                p.unlink()
 
 
 def get_slice(files, num_slices, slice_id):
     """将文件列表均分成num_slices份，返回第slice_id份"""
     if slice_id < 0 or slice_id >= num_slices:
         raise ValueError(f"slice_id必须在[0, {num_slices-1}]范围内，当前为{slice_id}")
-    
+
     total = len(files)
     base_size = total // num_slices
     remainder = total % num_slices
-    
+
     # 前remainder个切片多分一个文件
     if slice_id < remainder:
         start = slice_id * (base_size + 1)
@@ -55,14 +61,30 @@ def get_slice(files, num_slices, slice_id):
     else:
         start = remainder * (base_size + 1) + (slice_id - remainder) * base_size
         end = start + base_size
-    
+
     return files[start:end]
 
 
-def reencode_folder(input_dir, output_dir, vfps=25, afps=16000, in_size=256, 
-                    num_workers=None, num_slices=1, slice_id=0):
+def load_done(output_dir):
+    """从所有切片的manifest中读取已成功完成的文件名"""
+    done = set()
+    for manifest_path in glob(str(Path(output_dir) / 'manifest_*.jsonl')):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中断时最后一行可能不完整
+                    continue
+                if record['ok']:
+                    done.add(record['name'])
+    return done
+
+
+def reencode_folder(input_dir, output_dir, vfps=25, afps=16000, in_size=256,
+                    num_workers=None, num_slices=1, slice_id=0, timeout=600, adopt_existing=False):
     """对文件夹下所有mp4文件进行重编码
-    
+
     Args:
         input_dir: 输入文件夹路径
         output_dir: 输出文件夹路径
@@ -72,70 +94,94 @@ def reencode_folder(input_dir, output_dir, vfps=25, afps=16000, in_size=256,
         num_workers: 进程数量
         num_slices: 切片总数（将文件均分成多少份）
         slice_id: 当前处理的切片id（从0开始）
+        timeout: 每个视频的超时时间（秒）
+        adopt_existing: 把输出目录中已有的 mp4+wav 记录到manifest中（用于没有manifest的旧输出）
+
+    已完成的视频记录在 output_dir/manifest_{slice_id}.jsonl 中，重新运行时跳过（断点续跑）
     """
     input_dir = Path(input_dir)
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True, parents=True)
-    
+
     # 获取所有mp4文件并排序（确保每次运行顺序一致）
     all_mp4_files = sorted(list(input_dir.glob('*.mp4')))
-    
+
     if not all_mp4_files:
         print(f"在 {input_dir} 中未找到任何mp4文件")
         return
-    
+
     print(f"总共找到 {len(all_mp4_files)} 个mp4文件")
-    
+
     # 获取当前切片的文件
     mp4_files = get_slice(all_mp4_files, num_slices, slice_id)
     print(f"切片 {slice_id}/{num_slices}: 处理 {len(mp4_files)} 个文件 (索引 {all_mp4_files.index(mp4_files[0]) if mp4_files else 'N/A'} - {all_mp4_files.index(mp4_files[-1]) if mp4_files else 'N/A'})")
-    
+
     if not mp4_files:
         print(f"切片 {slice_id} 没有分配到文件")
         return []
-    
+
+    manifest_path = output_dir / f'manifest_{slice_id}.jsonl'
+    done = load_done(output_dir)
+    if adopt_existing:
+        with open(manifest_path, 'a', encoding='utf-8') as manifest:
+            for p in mp4_files:
+                new_path = output_dir / f'{p.stem}.mp4'
+                if p.name not in done and new_path.exists() and new_path.with_suffix('.wav').exists():
+                    manifest.write(json.dumps({'name': p.name, 'ok': True, 'error': None, 'sec': 0.0}) + '\n')
+                    done.add(p.name)
+    todo = [p for p in mp4_files if p.name not in done]
+    print(f"已完成 {len(mp4_files) - len(todo)} 个，剩余 {len(todo)} 个")
+
+    if not todo:
+        return []
+
     if num_workers is None:
-        num_workers = min(cpu_count(), len(mp4_files))
-    
+        num_workers = min(cpu_count(), len(todo))
+
     worker_func = functools.partial(
         reencode_video,
         output_dir=output_dir,
         vfps=vfps,
         afps=afps,
-        in_size=in_size
+        in_size=in_size,
+        timeout=timeout,
     )
-    
+
     failed_files = []
     success_count = 0
-    
-    with Pool(num_workers) as pool:
-        results = list(tqdm(
-            pool.imap(worker_func, mp4_files),
-            total=len(mp4_files),
-            desc=f"重编码视频 (切片 {slice_id}/{num_slices})"
-        ))
-    
-    for success, filename, error in results:
-        if success:
-            success_count += 1
-        else:
-            failed_files.append((filename, error))
-    
+    start = time.time()
+
+    with Pool(num_workers) as pool, open(manifest_path, 'a', encoding='utf-8') as manifest:
+        pbar = tqdm(pool.imap_unordered(worker_func, todo), total=len(todo),
+                    desc=f"重编码视频 (切片 {slice_id}/{num_slices})")
+        for success, filename, error, sec in pbar:
+            # 每完成一个就写入manifest，中断后可以继续
+            manifest.write(json.dumps({'name': filename, 'ok': success, 'error': error, 'sec': round(sec, 3)}) + '\n')
+            manifest.flush()
+            if success:
+                success_count += 1
+            else:
+                failed_files.append((filename, error))
+            pbar.set_postfix(clips_per_sec=f'{(success_count + len(failed_files)) / (time.time() - start):.2f}',
+                             failed=len(failed_files))
+    elapsed = time.time() - start
+
     print(f"\n切片 {slice_id} 处理完成!")
-    print(f"成功: {success_count}/{len(mp4_files)}")
-    print(f"失败: {len(failed_files)}/{len(mp4_files)}")
-    
+    print(f"成功: {success_count}/{len(todo)}")
+    print(f"失败: {len(failed_files)}/{len(todo)}")
+    print(f"速度: {len(todo) / elapsed:.2f} 个视频/秒 (用时 {elapsed:.0f} 秒)")
+
     if failed_files:
         print("\n失败的文件:")
         for filename, error in failed_files:
             print(f"  - {filename}: {error}")
-    
+
     return failed_files
 
 
 if __name__ == '__main__':
     import argparse
-    
+
     parser = argparse.ArgumentParser(description='批量重编码视频文件')
     parser.add_argument('--input_dir', type=str, required=True, help='输入文件夹路径')
     parser.add_argument('--output_dir', type=str, required=True, help='输出文件夹路径')
@@ -145,9 +191,11 @@ if __name__ == '__main__':
     parser.add_argument('--num_workers', type=int, default=None, help='进程数量')
     parser.add_argument('--num_slices', type=int, default=1, help='切片总数（将文件均分成多少份）')
     parser.add_argument('--slice_id', type=int, default=0, help='当前处理的切片id（从0开始）')
-    
+    parser.add_argument('--timeout', type=int, default=600, help='每个视频的超时时间（秒）')
+    parser.add_argument('--adopt_existing', action='store_true', help='把已有的输出(mp4+wav)记录为已完成')
+
     args = parser.parse_args()
-    
+
     reencode_folder(
         input_dir=args.input_dir,
         output_dir=args.output_dir,
@@ -156,5 +204,7 @@ if __name__ == '__main__':
         in_size=args.in_size,
         num_workers=args.num_workers,
         num_slices=args.num_slices,
-        slice_id=args.slice_id
-    )
\ No newline at end of file
+        slice_id=args.slice_id,
+        timeout=args.timeout,
+        adopt_existing=args.adopt_existing,
+    )
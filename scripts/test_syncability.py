@@ -18,7 +18,8 @@ from model.modules.feat_extractors.train_clip_src.training.train import AverageM
 
 from scripts.train_utils import (broadcast_obj, calc_cls_metrics, gather_dict, get_batch_sizes,
                                  get_curr_time_w_random_shift, get_datasets,
-                                 get_device, get_loaders, get_model, get_transforms, is_master,
+                                 get_device, get_loaders, get_model, get_post_collate_transforms,
+                                 get_transforms, is_master,
                                  prepare_inputs, set_seed)
 from utils.utils import cfg_sanity_check_and_patch
 from sklearn.metrics import roc_curve, roc_auc_score
@@ -212,6 +213,7 @@ def test_syncability():
 
     set_seed(cfg_sync.training.seed)  # same seed for all workers for model init
     transforms = get_transforms(cfg_sync)  # getting away with only sync transforms for both
+    post_collate_transforms = get_post_collate_transforms(cfg_sync, device, ['test'])['test']
     model_sync, model_sync_without_ddp = get_model(cfg_sync, device)
     if do_tier_offset_preds_by_sync:
         model_off, model_off_without_ddp = get_model(cfg_off, device)
@@ -275,7 +277,7 @@ def test_syncability():
 
         num_samples = 0
         for i, batch in enumerate(loaders[phase]):
-            aud, vid, targets = prepare_inputs(batch, device, phase)
+            aud, vid, targets = prepare_inputs(batch, device, phase, post_collate_transforms=post_collate_transforms)
             data_time_m.update(time.time() - end)
             with torch.set_grad_enabled(False):
                 with torch.autocast('cuda', enabled=cfg_sync.training.use_half_precision):
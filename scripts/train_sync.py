@@ -1,4 +1,5 @@
 import math
+import os
 import time
 import shutil
 import logging
@@ -8,10 +9,12 @@ from omegaconf import OmegaConf
 import torch
 import torch.distributed as dist
 
+from dataset.dataset_utils import get_scratch_cache
+from dataset.feature_store import FeatureStoreDataset
 from utils.logger import LoggerWithTBoard
 from scripts.train_utils import (EarlyStopper, AverageMeter,
                                  broadcast_obj, get_batch_sizes, get_curr_time_w_random_shift, get_datasets,
-                                 get_device, get_loaders, get_lr_scheduler,
+                                 get_device, get_loaders, get_lr_scheduler, get_post_collate_transforms,
                                  get_model, get_optimizer, get_transforms,
                                  init_ddp, is_master, load_ckpt,
                                  make_backward_and_optim_step, prepare_inputs,
@@ -52,9 +55,25 @@ def train(cfg):
     lr_scheduler = get_lr_scheduler(cfg, optimizer)
 
     set_seed(cfg.training.seed + global_rank)
+    # made before the dataloader workers start so that the main process sees their counters
+    scratch_cache = get_scratch_cache(cfg.training.num_workers) if 'LOCAL_SCRATCH' in os.environ else None
     batch_sizes = get_batch_sizes(cfg, num_gpus)
-    transforms = get_transforms(cfg)
+    transforms = get_transforms(cfg, ['train', 'valid', 'test'])
+    post_collate_transforms = get_post_collate_transforms(cfg, device)
     datasets = get_datasets(cfg, transforms)
+    # the items of the feature store are (S, t, D) segment features, the model skips the extractors
+    precomputed_feats = isinstance(datasets['train'], FeatureStoreDataset)
+    if precomputed_feats:
+        extractors = [cfg.model.params.afeat_extractor, cfg.model.params.vfeat_extractor]
+        assert not any(e.is_trainable for e in extractors), 'Only the head can be trained on the feature store'
+        # the store was made with them (`extract_features.py`)
+        if any(t is not None for t in post_collate_transforms.values()):
+            logging.info('Skipping the post-collate transforms on the feature store')
+        post_collate_transforms = {phase: None for phase in post_collate_transforms}
+    for dataset in datasets.values():
+        if getattr(dataset, 'preprocessed_cache', None) is not None:
+            # before the dataloader workers start so that the main process sees their counters
+            dataset.preprocessed_cache.share_stats(cfg.training.num_workers)
     loaders = get_loaders(cfg, datasets, batch_sizes)
 
     logger.log_param_num(global_rank, model)
@@ -124,7 +143,10 @@ def train(cfg):
             iter_time_m = AverageMeter()
             end = time.time()
 
-            if dist.is_initialized():
+            if isinstance(loaders[phase].dataset, torch.utils.data.IterableDataset):
+                # shards split across ranks and shuffled inside of the dataset (see `dataset/sharded.py`)
+                loaders[phase].dataset.set_epoch(epoch)
+            elif dist.is_initialized():
                 loaders[phase].sampler.set_epoch(epoch)
 
             # how many times to iterate through a evaluation se (makes estimates more robust for small dsets)
@@ -159,13 +181,16 @@ def train(cfg):
                     model.zero_grad(set_to_none=True)
 
                     # sends targets and inputs to cuda
-                    aud, vid, targets = prepare_inputs(batch, device, phase)
+                    aud, vid, targets = prepare_inputs(
+                        batch, device, phase,
+                        post_collate_transforms=post_collate_transforms['train' if phase == 'train' else 'test'])
 
                     num_samples += len(vid) * cfg.training.world_size
 
                     # saves recontructed input to the model during the first iteration (detects bugs)
                     # doing it before torch.no_grad because some reconstruction transforms require it
-                    if iter_step == 0 and phase in ['train', 'valid']:
+                    # (not for the precomputed segment features of `dataset.feature_store.FeatureStoreDataset`)
+                    if iter_step == 0 and phase in ['train', 'valid'] and not precomputed_feats:
                         if is_master(global_rank):
                             logger.vizualize_input(vid, aud, batch, iter_step, phase, cfg)
                         # just wait for the master to finish
@@ -177,7 +202,8 @@ def train(cfg):
                     # gradient and half-precision toggles
                     with torch.autocast('cuda', enabled=cfg.training.use_half_precision):
                         with torch.set_grad_enabled(phase == 'train'):
-                            loss, logits = model(vid, aud, targets[target_key], loss_fn=loss_fn)
+                            loss, logits = model(vid, aud, targets[target_key], loss_fn=loss_fn,
+                                             precomputed_feats=precomputed_feats)
 
                     if phase == 'train':
                         make_backward_and_optim_step(cfg, loss, model, optimizer, scaler, lr_scheduler)
@@ -205,6 +231,13 @@ def train(cfg):
                         logger.log_iter_loss(iter_loss, iter_step, phase, prefix='total')
                         if phase == 'train':
                             logger.add_scalar('lr', lr_scheduler.get_last_lr()[0], iter_step)
+                        phase_transforms = getattr(datasets[phase], 'transforms', None)
+                        if cfg.logging.get('profile_transforms', False) and hasattr(phase_transforms, 'get_stats'):
+                            logger.log_transform_stats(phase_transforms, iter_step, phase)
+                        if scratch_cache is not None:
+                            logger.log_scratch_cache_stats(scratch_cache, iter_step)
+                        if getattr(datasets[phase], 'preprocessed_cache', None) is not None:
+                            logger.log_preprocessed_cache_stats(datasets[phase].preprocessed_cache, iter_step, phase)
                         if cfg.logging.get('vis_segment_sim', False) and phase in ['train', 'valid']:
                             # visualize segments (but 10 times less often coarsely)
                             if i % (cfg.logging.log_frequency * 10) == 0:
@@ -315,7 +348,10 @@ def train(cfg):
     data_time_m = AverageMeter()
     end = time.time()
 
-    if dist.is_initialized():
+    if isinstance(loaders[phase].dataset, torch.utils.data.IterableDataset):
+        # shards split across ranks and shuffled inside of the dataset (see `dataset/sharded.py`)
+        loaders[phase].dataset.set_epoch(ckpt_epoch)
+    elif dist.is_initialized():
         loaders[phase].sampler.set_epoch(ckpt_epoch)
 
     # how many times to iterate through a evaluation dataset (makes estimates more robust for small datasets)
@@ -329,14 +365,16 @@ def train(cfg):
         num_samples = 0
         for i, batch in enumerate(loaders[phase]):
             # sends inputs and targets to cuda
-            aud, vid, targets = prepare_inputs(batch, device, phase)
+            aud, vid, targets = prepare_inputs(batch, device, phase,
+                                               post_collate_transforms=post_collate_transforms['test'])
             # zero the parameter gradients
             data_time_m.update(time.time() - end)
             optimizer.zero_grad()
             # gradient and half-precision toggles
             with torch.set_grad_enabled(False):
                 with torch.autocast('cuda', enabled=cfg.training.use_half_precision):
-                    loss, logits = model(vid, aud, targets[target_key], loss_fn=loss_fn)
+                    loss, logits = model(vid, aud, targets[target_key], loss_fn=loss_fn,
+                                         precomputed_feats=precomputed_feats)
 
             num_samples += len(vid) * cfg.training.world_size
             batch_time_m.update(time.time() - end)
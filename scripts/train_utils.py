@@ -21,6 +21,7 @@ from sklearn.metrics import (top_k_accuracy_score, average_precision_score, roc_
 from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader, DistributedSampler
 
+from dataset.transforms import InstrumentedCompose
 from utils.utils import (fix_prefix, get_obj_from_str, get_transform_instance_from_compose,
                          instantiate_from_config, show_cfg_diffs)
 
@@ -96,11 +97,32 @@ def get_device(cfg):
 
 
 def get_transforms(cfg, which_transforms=['train', 'test']):
+    '''`valid` (if asked for) gets its own instance of the `test` sequence, e.g. to profile it separately'''
     transforms = {}
     for mode in which_transforms:
-        ts_cfg = cfg.get(f'transform_sequence_{mode}', None)
+        ts_cfg = cfg.get(f'transform_sequence_{"test" if mode == "valid" else mode}', None)
         ts = [lambda x: x] if ts_cfg is None else [instantiate_from_config(c) for c in ts_cfg]
-        transforms[mode] = torchvision.transforms.Compose(ts)
+        if cfg.get('logging', {}).get('profile_transforms', False):
+            # time, memory and allocations per transform (see `LoggerWithTBoard.log_transform_stats`)
+            transforms[mode] = InstrumentedCompose(ts, cfg.get('training', {}).get('num_workers', 0))
+        else:
+            transforms[mode] = torchvision.transforms.Compose(ts)
+    return transforms
+
+
+def get_post_collate_transforms(cfg, device, which_transforms=['train', 'test']):
+    '''The transforms from `transform_sequence_{mode}_post_collate` are applied to the whole batch on `device`
+    in `prepare_inputs` rather than to each item in the dataloader workers (e.g. the audio features).
+    The buffers of the transforms (e.g. mel filterbanks) are moved to `device` once here.
+    Returns None for a mode if the config has no such sequence.'''
+    transforms = {}
+    for mode in which_transforms:
+        ts_cfg = cfg.get(f'transform_sequence_{mode}_post_collate', None)
+        if ts_cfg is None:
+            transforms[mode] = None
+        else:
+            ts = [instantiate_from_config(c).to(device) for c in ts_cfg]
+            transforms[mode] = torchvision.transforms.Compose(ts)
     return transforms
 
 
@@ -117,6 +139,8 @@ def get_datasets(cfg, transforms, which_datasets=['train', 'valid', 'test']):
     vids_path = cfg.data.vids_path
     attr_annot_path = cfg.data.dataset.params.get('attr_annot_path', None)
     max_attr_per_vid = cfg.data.dataset.params.get('max_attr_per_vid', None)
+    windowed_decode = cfg.data.dataset.params.get('windowed_decode', False)
+    preprocessed_cache_dir = cfg.data.dataset.params.get('preprocessed_cache_dir', None)
 
     datasets = dict()
     if 'train' in which_datasets:
@@ -124,21 +148,24 @@ def get_datasets(cfg, transforms, which_datasets=['train', 'valid', 'test']):
             split='train', vids_dir=vids_path, transforms=transforms['train'],
             load_fixed_offsets_on=load_fixed_offsets_on, vis_load_backend=vis_load_backend,
             size_ratio=size_ratios['train'], attr_annot_path=attr_annot_path,
-            max_attr_per_vid=max_attr_per_vid)
+            max_attr_per_vid=max_attr_per_vid, windowed_decode=windowed_decode,
+            preprocessed_cache_dir=preprocessed_cache_dir)
         logging.info(f'Loaded {len(datasets["train"])} train samples')
     if 'valid' in which_datasets:
         datasets['valid'] = DatasetClass(
-            split='valid', vids_dir=vids_path, transforms=transforms['test'],
+            split='valid', vids_dir=vids_path, transforms=transforms.get('valid', transforms['test']),
             load_fixed_offsets_on=load_fixed_offsets_on, vis_load_backend=vis_load_backend,
             size_ratio=size_ratios['valid'], attr_annot_path=attr_annot_path,
-            max_attr_per_vid=max_attr_per_vid)
+            max_attr_per_vid=max_attr_per_vid, windowed_decode=windowed_decode,
+            preprocessed_cache_dir=preprocessed_cache_dir)
         logging.info(f'Loaded {len(datasets["valid"])} valid samples')
     if 'test' in which_datasets:
         datasets['test'] = DatasetClass(
             split='test', vids_dir=vids_path, transforms=transforms['test'],
             load_fixed_offsets_on=load_fixed_offsets_on, vis_load_backend=vis_load_backend,
             size_ratio=size_ratios['test'], attr_annot_path=attr_annot_path,
-            max_attr_per_vid=max_attr_per_vid)
+            max_attr_per_vid=max_attr_per_vid, windowed_decode=windowed_decode,
+            preprocessed_cache_dir=preprocessed_cache_dir)
         logging.info(f'Loaded {len(datasets["test"])} test samples')
     return datasets
 
@@ -167,6 +194,12 @@ def get_batch_sizes(cfg, num_gpus=None):
 def get_loaders(cfg, datasets, batch_sizes):
     loaders = dict()
     for phase, dataset in datasets.items():
+        if isinstance(dataset, torch.utils.data.IterableDataset):
+            # splits the shards across ranks and shuffles by itself (e.g. `dataset.sharded.ShardedSyncDataset`)
+            loaders[phase] = DataLoader(dataset, batch_sizes['train' if phase == 'train' else 'test'],
+                                        num_workers=cfg.training.num_workers)
+            continue
+
         if dist.is_initialized():
             sampler = DistributedSampler(datasets[phase], shuffle=phase == 'train')
         else:
@@ -356,7 +389,7 @@ def apply_fn_recursive(obj, fn: callable):
     else:
         raise NotImplementedError(f'obj type: {type(obj)}')
 
-def prepare_inputs(batch, device, phase=None, get_targets=True):
+def prepare_inputs(batch, device, phase=None, get_targets=True, post_collate_transforms=None):
     targets = None
     if get_targets:
         targets = batch['targets']
@@ -368,6 +401,12 @@ def prepare_inputs(batch, device, phase=None, get_targets=True):
     aud = batch['audio'].to(device)
     vid = batch['video'].to(device)
 
+    if post_collate_transforms is not None:
+        # see `get_post_collate_transforms`
+        batch['audio'], batch['video'] = aud, vid
+        batch = post_collate_transforms(batch)
+        aud, vid = batch['audio'], batch['video']
+
     return aud, vid, targets
 
 def make_backward_and_optim_step(cfg, loss, model, optimizer, scaler, lr_scheduler):
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the tests import the repo modules as the scripts do (`sys.path.insert(0, '.')`), from any working dir
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+from model.modules.feat_extractors.audio.hf_src.modeling_ast import (ASTConfig, ASTSdpaSelfAttention,
+                                                                     ASTSelfAttention)
+
+HIDDEN_SIZE, NUM_HEADS, SEQ_LEN, BATCH_SIZE = 768, 12, 214, 3
+ATOL = 1e-5
+
+
+@pytest.fixture(scope='module')
+def attns():
+    '''The eager and the sdpa attention with the same random weights'''
+    torch.manual_seed(0)
+    config = ASTConfig(hidden_size=HIDDEN_SIZE, num_attention_heads=NUM_HEADS, qkv_bias=True,
+                       attention_probs_dropout_prob=0.0)
+    eager = ASTSelfAttention(config).eval()
+    sdpa = ASTSdpaSelfAttention(config).eval()
+    sdpa.load_state_dict(eager.state_dict())
+    return eager, sdpa
+
+
+@pytest.fixture(scope='module')
+def padded_batch():
+    '''Hidden states of the clips of different lengths padded to `SEQ_LEN` and their token mask'''
+    torch.manual_seed(0)
+    hidden_states = torch.randn(BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE)
+    tok_mask = torch.ones(BATCH_SIZE, SEQ_LEN, dtype=torch.long)
+    for i, n_pad in enumerate([0, 37, SEQ_LEN // 2]):
+        tok_mask[i, SEQ_LEN - n_pad:] = 0
+        hidden_states[i, SEQ_LEN - n_pad:] = 0
+    return hidden_states, tok_mask
+
+
+@pytest.mark.parametrize('masked', [False, True], ids=['no_mask', 'tok_mask'])
+def test_sdpa_matches_eager(attns, padded_batch, masked):
+    eager, sdpa = attns
+    hidden_states, tok_mask = padded_batch
+    mask = tok_mask if masked else None
+    with torch.no_grad():
+        out_eager = eager(hidden_states, mask)[0]
+        out_sdpa = sdpa(hidden_states, mask)[0]
+    assert out_sdpa.shape == out_eager.shape
+    assert (out_sdpa - out_eager).abs().max().item() < ATOL
+
+
+@pytest.mark.parametrize('head_mask, output_attentions', [(True, False), (False, True)],
+                         ids=['head_mask', 'output_attentions'])
+def test_sdpa_falls_back_to_eager(attns, padded_batch, monkeypatch, head_mask, output_attentions):
+    eager, sdpa = attns
+    hidden_states, tok_mask = padded_batch
+    head_mask = torch.rand(1, NUM_HEADS, 1, 1) if head_mask else None
+
+    def fail(*args, **kwargs):
+        raise AssertionError('the sdpa kernel is used with head_mask or output_attentions')
+    monkeypatch.setattr(torch.nn.functional, 'scaled_dot_product_attention', fail)
+
+    with torch.no_grad():
+        out_eager = eager(hidden_states, tok_mask, head_mask, output_attentions)
+        out_sdpa = sdpa(hidden_states, tok_mask, head_mask, output_attentions)
+    assert len(out_sdpa) == len(out_eager) == (2 if output_attentions else 1)
+    for o_sdpa, o_eager in zip(out_sdpa, out_eager):
+        assert torch.equal(o_sdpa, o_eager)
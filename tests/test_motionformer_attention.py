@@ -0,0 +1,55 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from model.modules.feat_extractors.visual.motionformer_src.vit_helper import DividedAttention, TrajectoryAttention
+
+DIM, NUM_HEADS, NUM_FRAMES, SEQ_LEN, BATCH_SIZE = 768, 12, 8, 196, 2
+ATOL = 1e-4
+
+
+def _make_pair(attn_cls):
+    '''The reference (einsum) and the sdpa backends of `attn_cls` with the same random weights'''
+    ref = attn_cls(DIM, num_heads=NUM_HEADS, qkv_bias=True, attn_backend='reference').eval()
+    fused = attn_cls(DIM, num_heads=NUM_HEADS, qkv_bias=True, attn_backend='sdpa').eval()
+    # the divided attention inits the weights to constants
+    for p in ref.parameters():
+        nn.init.normal_(p, std=0.02)
+    fused.load_state_dict(ref.state_dict())
+    return ref, fused
+
+
+@pytest.fixture(scope='module')
+def inputs():
+    torch.manual_seed(0)
+    x = torch.randn(BATCH_SIZE, 1 + NUM_FRAMES * SEQ_LEN, DIM)
+    tok_mask = torch.rand(BATCH_SIZE, x.shape[1]) > 0.3
+    tok_mask[:, 0] = True
+    return x, tok_mask
+
+
+def test_default_backend_is_reference():
+    assert DividedAttention(DIM, num_heads=NUM_HEADS).attn_backend == 'reference'
+    assert TrajectoryAttention(DIM, num_heads=NUM_HEADS).attn_backend == 'reference'
+
+
+@pytest.mark.parametrize('pattern, dims', [('(b n) f d', {'n': SEQ_LEN}), ('(b f) n d', {'f': NUM_FRAMES})],
+                         ids=['time', 'space'])
+@pytest.mark.parametrize('masked', [False, True], ids=['no_mask', 'tok_mask'])
+def test_divided_attention_backends_match(inputs, pattern, dims, masked):
+    x, tok_mask = inputs
+    ref, fused = _make_pair(DividedAttention)
+    mask = tok_mask if masked else None
+    with torch.no_grad():
+        out_ref = ref(x, 'b (f n) d', pattern, tok_mask=mask, **dims)
+        out = fused(x, 'b (f n) d', pattern, tok_mask=mask, **dims)
+    assert (out - out_ref).abs().max().item() < ATOL
+
+
+def test_trajectory_attention_backends_match(inputs):
+    x, _ = inputs
+    ref, fused = _make_pair(TrajectoryAttention)
+    with torch.no_grad():
+        out_ref = ref(x, seq_len=SEQ_LEN, num_frames=NUM_FRAMES)[0]
+        out = fused(x, seq_len=SEQ_LEN, num_frames=NUM_FRAMES)[0]
+    assert (out - out_ref).abs().max().item() < ATOL
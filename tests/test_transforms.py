@@ -0,0 +1,192 @@
+import pytest
+import torch
+import torchvision
+
+from dataset.transforms import (ApplyColorJitterFrameWise, RandomApplyColorDistortion, RandomHorizontalFlip, Resize,
+                                RGBSpatialCrop, apply_color_jitter, get_color_jitter_params, get_resized_crop_roi)
+
+# the sample size of the distribution tests
+N = 4000
+# ~ the 0.999 quantile of the two-sample KS statistic (and > 3 std of the difference of two rates)
+TOL = 2 * (2 / N) ** 0.5
+
+
+class RandomApplyColorDistortionLoop(torch.nn.Module):
+    '''The per-clip loop that `RandomApplyColorDistortion` replaced, kept as the reference for the
+    tests below. Note: changes `item['video']` in-place.'''
+
+    def __init__(self, p_gray_scale=0., p_color_jitter=0., s=1.) -> None:
+        super().__init__()
+        self.p_gray_scale = p_gray_scale
+        self.p_color_jitter = p_color_jitter
+        self.s = s
+        assert 0 <= self.p_color_jitter <= 1 and 0 <= self.p_gray_scale <= 1, (p_color_jitter, p_gray_scale)
+        # SimCLR params
+        color_jitter = torchvision.transforms.ColorJitter(0.8*s, 0.8*s, 0.8*s, 0.2*s)
+        rand_color_jitter = torchvision.transforms.RandomApply([color_jitter], p_color_jitter)
+        rand_gray = torchvision.transforms.RandomGrayscale(p_gray_scale)
+        self.transforms = torchvision.transforms.Compose([rand_color_jitter, rand_gray])
+
+    def apply_to_single_clip(self, clip):
+        return self.transforms(clip)
+
+    def apply_to_each_clip(self, clips):
+        for i, clip in enumerate(clips):
+            clips[i] = self.apply_to_single_clip(clip)
+        return clips
+
+    def forward(self, item):
+        has_batch_dim = len(item['video'].shape) == 5
+        if has_batch_dim:
+            fn = self.apply_to_each_clip
+        else:
+            fn = self.apply_to_single_clip
+        item['video'] = fn(item['video'])
+        return item
+
+
+class ApplyColorJitterFrameWiseLoop(torch.nn.Module):
+    '''The per-frame loop that `ApplyColorJitterFrameWise` replaced, kept as the reference for the
+    tests below. Note: changes `item['video']` in-place.'''
+
+    def __init__(self, s=1.) -> None:
+        super().__init__()
+        self.s = s
+        # SimCLR params
+        self.transform = torchvision.transforms.ColorJitter(0.8*s, 0.8*s, 0.8*s, 0.2*s)
+
+    def apply_to_single_clip(self, clip):
+        for i, frame in enumerate(clip):
+            clip[i] = self.transform(frame)
+        return clip
+
+    def apply_to_each_clip(self, clips):
+        for i, clip in enumerate(clips):
+            clips[i] = self.apply_to_single_clip(clip)
+        return clips
+
+    def forward(self, item):
+        has_batch_dim = len(item['video'].shape) == 5
+        if has_batch_dim:
+            fn = self.apply_to_each_clip
+        else:
+            fn = self.apply_to_single_clip
+        item['video'] = fn(item['video'])
+        return item
+
+
+class RandomHorizontalFlipLoop(torchvision.transforms.RandomHorizontalFlip):
+    '''The per-clip loop that `RandomHorizontalFlip` replaced, kept as the reference for the
+    tests below. Note: changes `item['video']` in-place.'''
+
+    def __init__(self, p=0.5):
+        super().__init__(p)
+
+    def apply_to_single_clip(self, clip):
+        return super().forward(clip)
+
+    def apply_to_each_clip(self, clips):
+        for i, clip in enumerate(clips):
+            clips[i] = self.apply_to_single_clip(clip)
+        return clips
+
+    def forward(self, item):
+        has_batch_dim = len(item['video'].shape) == 5
+        if has_batch_dim:
+            fn = self.apply_to_each_clip
+        else:
+            fn = self.apply_to_single_clip
+        item['video'] = fn(item['video'])
+        return item
+
+
+def _ks_distance(a, b):
+    '''The max distance between the empirical CDFs of the samples `a` and `b`'''
+    a, b = a.double().sort().values, b.double().sort().values
+    x = torch.cat([a, b])
+    cdf_a = torch.searchsorted(a, x, right=True) / len(a)
+    cdf_b = torch.searchsorted(b, x, right=True) / len(b)
+    return (cdf_a - cdf_b).abs().max().item()
+
+
+def _get_color_jitter():
+    cj = torchvision.transforms.ColorJitter(0.8, 0.8, 0.8, 0.2)
+    return cj, [cj.brightness, cj.contrast, cj.saturation, cj.hue]
+
+
+def test_color_jitter_params_distribution():
+    '''The order of the jitter ops and the factors follow the distributions of `ColorJitter.get_params`'''
+    torch.manual_seed(0)
+    cj, ranges = _get_color_jitter()
+    ref = [cj.get_params(*ranges) for _ in range(N)]
+    ref_order = torch.stack([p[0] for p in ref])
+    ref_factors = [torch.tensor([p[i] for p in ref]) for i in range(1, 5)]
+    order, factors = get_color_jitter_params(N, *ranges)
+    codes = torch.tensor([4 ** 3, 4 ** 2, 4, 1])
+    dist = _ks_distance((ref_order * codes).sum(1), (order * codes).sum(1))
+    assert dist < TOL, f'order of the ops: {dist:.4f}'
+    for name, ref_f, f in zip(['brightness', 'contrast', 'saturation', 'hue'], ref_factors, factors):
+        dist = _ks_distance(ref_f, f)
+        assert dist < TOL, f'{name} factor: {dist:.4f}'
+
+
+@pytest.mark.parametrize('ref_cls, cls, kwargs', [
+    (RandomApplyColorDistortionLoop, RandomApplyColorDistortion, dict(p_gray_scale=0.2, p_color_jitter=0.8)),
+    (RandomHorizontalFlipLoop, RandomHorizontalFlip, dict(p=0.5)),
+])
+def test_augmented_clip_rates(ref_cls, cls, kwargs):
+    '''The same shares of the clips get jittered, gray, flipped'''
+    torch.manual_seed(0)
+    clips = torch.randint(0, 256, (N, 1, 3, 4, 4), dtype=torch.uint8)
+
+    def get_rates(out):
+        is_gray = (out == out[:, :, :1]).flatten(1).all(1)
+        is_changed = (out != clips).flatten(1).any(1)
+        is_flipped = (out == clips.flip(-1)).flatten(1).all(1)
+        return torch.stack([is_gray, is_changed & ~is_gray, is_flipped]).float().mean(1)
+
+    ref_rates = get_rates(ref_cls(**kwargs)({'video': clips.clone()})['video'])
+    rates = get_rates(cls(**kwargs)({'video': clips.clone()})['video'])
+    assert (ref_rates - rates).abs().max() < TOL, f'{ref_rates} vs {rates} (gray, jitter, flip)'
+
+
+@pytest.mark.parametrize('ref', [RandomApplyColorDistortionLoop(p_color_jitter=1.0), ApplyColorJitterFrameWiseLoop()],
+                         ids=['per_clip', 'per_frame'])
+def test_color_jitter_outputs_match_loops(ref):
+    '''For the parameters that the reference loop sampled, the vectorized ops give the same outputs'''
+    torch.manual_seed(0)
+    clips = torch.randint(0, 256, (64, 4, 3, 32, 32), dtype=torch.uint8)
+    ref_cj = ref.transform if hasattr(ref, 'transform') else ref.transforms.transforms[0].transforms[0]
+    sampled = []
+
+    def get_params(*args, get_params=ref_cj.get_params):
+        sampled.append(get_params(*args))
+        return sampled[-1]
+
+    ref_cj.get_params = get_params
+    ref_out = ref({'video': clips.clone()})['video']
+    order = torch.stack([p[0] for p in sampled])
+    factors = [torch.tensor([p[i] for p in sampled]) for i in range(1, 5)]
+    # (clips or frames, ..., C, H, W)
+    out = apply_color_jitter(clips.view(len(order), -1, *clips.shape[-3:]), order, factors)
+    assert torch.equal(out.view(clips.shape), ref_out)
+
+
+def test_frame_wise_jitter_keeps_shape():
+    video = torch.randint(0, 256, (2, 4, 3, 8, 8), dtype=torch.uint8)
+    out = ApplyColorJitterFrameWise()({'video': video.clone()})['video']
+    assert out.shape == video.shape and out.dtype == video.dtype
+
+
+@pytest.mark.parametrize('frame_size', [(360, 640), (720, 1280), (640, 360), (256, 256)])
+def test_resized_crop_roi_matches_resize_then_crop(frame_size):
+    # a smooth frame, so that the order of the crop and the resize changes only the interpolation
+    torch.manual_seed(0)
+    frame = torch.nn.functional.interpolate(torch.rand(1, 3, 9, 16), size=frame_size, mode='bilinear')[0]
+    crop = RGBSpatialCrop(224, is_random=False)
+    roi, size = get_resized_crop_roi(frame_size, 256, [crop])
+    top, left, height, width = roi
+    assert size == (224, 224) and top + height <= frame_size[0] and left + width <= frame_size[1]
+    ref = crop(Resize(256, antialias=True)({'video': frame, 'meta': {}}))['video']
+    out = torchvision.transforms.functional.resize(frame[:, top:top+height, left:left+width], size, antialias=True)
+    assert (out - ref).abs().mean().item() < 0.01
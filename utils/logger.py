@@ -1,4 +1,5 @@
 from matplotlib import pyplot as plt
+import json
 import logging
 import os
 from pathlib import Path
@@ -111,6 +112,26 @@ class LoggerWithTBoard(SummaryWriter):
             self.add_scalar('num_params', param_num, 0)
             return param_num
 
+    def log_transform_stats(self, transforms, iter, phase):
+        '''The per-transform stats of `InstrumentedCompose` (summed over the dataloader workers since the start)
+        to tboard and to `transform_stats_{phase}.json` in the logdir'''
+        stats = transforms.get_stats()
+        for name, metrics in stats.items():
+            for metric, val in metrics.items():
+                self.add_scalar(f'{phase}_transforms/{name}/{metric}', val, iter)
+        with open(os.path.join(self.logdir, f'transform_stats_{phase}.json'), 'w') as f:
+            json.dump({'iter': iter, 'stats': stats}, f, indent=2)
+
+    def log_scratch_cache_stats(self, cache, iter):
+        '''The counters of `ScratchCache` (this rank and its dataloader workers since the start) to tboard'''
+        for metric, val in cache.get_stats().items():
+            self.add_scalar(f'scratch_cache/{metric}', val, iter)
+
+    def log_preprocessed_cache_stats(self, cache, iter, phase):
+        '''The counters of `PreprocessedCache` (this rank and its dataloader workers since the start) to tboard'''
+        for metric, val in cache.get_stats().items():
+            self.add_scalar(f'{phase}_preprocessed_cache/{metric}', val, iter)
+
     def log_iter_loss(self, loss, iter, phase, prefix: str = ''):
         self.add_scalar(f'{phase}/{fix_prefix(prefix)}loss_iter', loss, iter)
 
@@ -181,10 +202,16 @@ class LoggerWithTBoard(SummaryWriter):
             vid_rec = vid_rec.view(B, S * Tv, C, H, W)
             aud_rec = aud_rec.permute(0, 1, 4, 2, 3).contiguous().view(B, S * Ta, 1, F).permute(0, 2, 3, 1)
 
-        a_means = batch['meta']['audio']['norm_stats']['mean'].view(orig_B, 1, -1, 1)[:max_vids_per_batch]
-        a_stds = batch['meta']['audio']['norm_stats']['std'].view(orig_B, 1, -1, 1)[:max_vids_per_batch]
-        v_means = batch['meta']['video']['norm_stats']['mean'].view(orig_B, 1, 3, 1, 1)[:max_vids_per_batch]
-        v_stds = batch['meta']['video']['norm_stats']['std'].view(orig_B, 1, 3, 1, 1)[:max_vids_per_batch]
+        norm_stats = {}
+        for stream, item_dims in [('audio', 0), ('video', 1)]:
+            for k in ['mean', 'std']:
+                stats = torch.as_tensor(batch['meta'][stream]['norm_stats'][k]).cpu()
+                # the stats are not collated if the stream was normalized after collation (post-collate transforms)
+                norm_stats[stream, k] = stats.expand(orig_B, *stats.shape) if stats.dim() == item_dims else stats
+        a_means = norm_stats['audio', 'mean'].reshape(orig_B, 1, -1, 1)[:max_vids_per_batch]
+        a_stds = norm_stats['audio', 'std'].reshape(orig_B, 1, -1, 1)[:max_vids_per_batch]
+        v_means = norm_stats['video', 'mean'].reshape(orig_B, 1, 3, 1, 1)[:max_vids_per_batch]
+        v_stds = norm_stats['video', 'std'].reshape(orig_B, 1, 3, 1, 1)[:max_vids_per_batch]
 
         # AudioStandardNormalize  (AST normaliization is done by (x - m) / (2*s) )
         if is_input_segmented:
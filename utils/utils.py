@@ -75,6 +75,32 @@ def which_ffmpeg() -> str:
     ffmpeg_path = result.stdout.decode('utf-8').replace('\n', '')
     return ffmpeg_path
 
+def get_reencode_cmd(path, new_path, new_wav_path, vfps=25, afps=16000, in_size=256, ffmpeg_path=None):
+    '''A single ffmpeg call with two outputs: the re-encoded .mp4 and the mono pcm_s16le .wav next to it.
+    Returns the list of arguments for `subprocess` (so paths with spaces are fine)'''
+    ffmpeg_path = which_ffmpeg() if ffmpeg_path is None else ffmpeg_path
+    cmd = [ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y', '-i', str(path)]
+    # 1) change fps, 2) resize: min(H,W)=MIN_SIDE (vertical vids are supported), 3) change audio framerate
+    vf = f"fps={vfps},scale=iw*{in_size}/'min(iw,ih)':ih*{in_size}/'min(iw,ih)',crop='trunc(iw/2)'*2:'trunc(ih/2)'*2"
+    # the audio track is resampled once and split to the .mp4 (aac) and the .wav (`-ar` per output would
+    # resample it for each of them)
+    cmd += ['-filter_complex', f'[0:v]{vf}[v];[0:a]aresample={afps},asplit=2[a1][a2]']
+    cmd += ['-map', '[v]', '-map', '[a1]', str(new_path)]
+    cmd += ['-map', '[a2]', '-acodec', 'pcm_s16le', '-ac', '1', str(new_wav_path)]
+    return cmd
+
+def reencode_video(path, vfps=25, afps=16000, in_size=256):
+    '''Re-encodes the video with ffmpeg to `vfps`, min(H, W)=`in_size` and `afps` (and the .wav next to it) into
+    ./vis. Returns the path to the new .mp4'''
+    assert which_ffmpeg() != '', 'Is ffmpeg installed? Check if the conda environment is activated.'
+    new_path = Path.cwd() / 'vis' / f'{Path(path).stem}_{vfps}fps_{in_size}side_{afps}hz.mp4'
+    new_path.parent.mkdir(exist_ok=True)
+    new_path = str(new_path)
+    # one pass for both the .mp4 and the .wav
+    subprocess.run(get_reencode_cmd(path, new_path, new_path.replace('.mp4', '.wav'), vfps, afps, in_size),
+                   check=True)
+    return new_path
+
 def get_obj_from_str(string, reload=False):
     module, cls = string.rsplit('.', 1)
     if reload:
@@ -147,6 +173,16 @@ def cfg_sanity_check_and_patch(cfg):
     if afeat_extractor.endswith('ResNet18AudioFeatures') and vfeat_extractor.endswith('S3DVisualFeatures'):
         assert cfg.logging.vis_segment_sim is False, 'logger.vizualize_segment_sim mults pre-proj features'
 
+def patch_config(cfg):
+    '''Patches the config of a released checkpoint for inference'''
+    # the FE ckpts are already in the model ckpt
+    cfg.model.params.afeat_extractor.params.ckpt_path = None
+    cfg.model.params.vfeat_extractor.params.ckpt_path = None
+    # old checkpoints have different names
+    cfg.model.params.transformer.target = cfg.model.params.transformer.target\
+                                             .replace('.modules.feature_selector.', '.sync_model.')
+    return cfg
+
 def get_fixed_off_fname(data_transforms, split):
     '''data_transforms: should be transforms.Compose'''
     for t in data_transforms.transforms: